@@ -0,0 +1,212 @@
+#! /usr/bin/python
+
+""" Micro-benchmarks for performance critical parts of the HFTS grasp planner. """
+
+import argparse
+import os
+import time
+import numpy as np
+
+DEFAULT_DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')
+
+
+def measure_runtime(function, num_repetitions=1):
+    """ Returns the average runtime of function() in seconds. """
+    start_time = time.time()
+    for i in range(num_repetitions):
+        function()
+    return (time.time() - start_time) / num_repetitions
+
+
+def load_object_points(data_path, obj_id):
+    """ Returns the contact points of the given object, preferably from a previously generated HFTS. """
+    model_file = os.path.join(data_path, obj_id, 'hftsModel.hfts')
+    if os.path.exists(model_file):
+        from hfts_grasp_planner.hfts_store import read_hfts_model
+        return np.array(read_hfts_model(model_file).get_hfts()[:, :6])
+    from hfts_grasp_planner.utils import ObjectFileIO
+    points, com = ObjectFileIO(data_path).get_points(obj_id)
+    return points
+
+
+def benchmark_spatial_index(args):
+    from hfts_grasp_planner.spatial_index import SpatialIndex
+    call_sites = []
+    # HFTSSampler.get_real_contacts queries one contact position at a time
+    object_points = load_object_points(args.data_path, args.object)[:, :3]
+    query_idx = np.random.randint(object_points.shape[0], size=args.num_queries)
+    object_queries = object_points[query_idx] + np.random.normal(scale=0.001, size=(args.num_queries, 3))
+    call_sites.append(('object index (get_real_contacts)', object_points, object_queries, 1))
+    # RobotiqHandKDTreeManifold.predict_hand_conf_batch queries max_iters codes per SHC step
+    if args.hand_cache_file is not None:
+        codes = np.load(args.hand_cache_file)[:, :6]
+        query_idx = np.random.randint(codes.shape[0], size=args.num_queries)
+        code_queries = codes[query_idx] + np.random.normal(scale=0.01, size=(args.num_queries, 6))
+        call_sites.append(('hand manifold (predict_hand_conf)', codes, code_queries, args.batch_size))
+    for name, points, queries, batch_size in call_sites:
+        print '%s: %i points, batch size %i' % (name, points.shape[0], batch_size)
+        for backend in SpatialIndex.BACKENDS:
+            for leaf_size in args.leaf_sizes:
+                build_time = measure_runtime(lambda: SpatialIndex(points, backend=backend, leaf_size=leaf_size))
+                index = SpatialIndex(points, backend=backend, leaf_size=leaf_size)
+                if batch_size == 1:
+                    query_time = measure_runtime(lambda: [index.query(q) for q in queries])
+                else:
+                    batches = [queries[i:i + batch_size] for i in range(0, queries.shape[0], batch_size)]
+                    query_time = measure_runtime(lambda: [index.query(batch) for batch in batches])
+                print '    %-8s leaf_size=%-3i build: %8.3f ms, %12.0f queries/s' % \
+                      (backend, leaf_size, 1000.0 * build_time, queries.shape[0] / query_time)
+
+
+def load_mesh_faces(data_path, obj_id):
+    """ Returns vertices (v0, v1, v2) and normals of all faces of the mesh of the given object or None. """
+    import stl
+    from hfts_grasp_planner.external.plyfile import PlyData
+    file_prefix = os.path.join(data_path, obj_id, 'objectModel')
+    if os.path.exists(file_prefix + '.stl'):
+        stl_mesh = stl.mesh.Mesh.from_file(file_prefix + '.stl', calculate_normals=False)
+        return stl_mesh.v0, stl_mesh.v1, stl_mesh.v2, stl_mesh.normals
+    if os.path.exists(file_prefix + '.ply'):
+        ply_data = PlyData.read(file_prefix + '.ply')
+        vertices = np.column_stack([ply_data['vertex'][t] for t in ['x', 'y', 'z', 'nx', 'ny', 'nz']])
+        faces = np.array([face[0][:3] for face in ply_data['face']])
+        v0, v1, v2 = vertices[faces[:, 0]], vertices[faces[:, 1]], vertices[faces[:, 2]]
+        normals = np.mean([v0[:, 3:], v1[:, 3:], v2[:, 3:]], axis=0)
+        return v0[:, :3], v1[:, :3], v2[:, :3], normals
+    return None
+
+
+def benchmark_sampling(args):
+    from hfts_grasp_planner.hfts_generation import sample_face, sample_faces
+    obj_ids = args.objects
+    if obj_ids is None:
+        obj_ids = sorted(obj_id for obj_id in os.listdir(args.data_path)
+                         if os.path.isdir(os.path.join(args.data_path, obj_id)))
+    for obj_id in obj_ids:
+        faces = load_mesh_faces(args.data_path, obj_id)
+        if faces is None:
+            continue
+        v0, v1, v2, normals = faces
+        start_time = time.time()
+        reference_points = []
+        for face_idx in range(len(v0)):
+            reference_points.extend(sample_face(v0[face_idx], v1[face_idx], v2[face_idx], normals[face_idx],
+                                                density=args.density))
+        reference_points = np.array(reference_points)
+        loop_time = time.time() - start_time
+        slices_time = measure_runtime(lambda: sample_faces(v0, v1, v2, normals, args.density), args.repetitions)
+        points = sample_faces(v0, v1, v2, normals, args.density)
+        random_time = measure_runtime(lambda: sample_faces(v0, v1, v2, normals, args.density,
+                                                           method='random', seed=0), args.repetitions)
+        num_random_points = sample_faces(v0, v1, v2, normals, args.density, method='random', seed=0).shape[0]
+        if points.shape == reference_points.shape:
+            max_error = np.max(np.abs(points - reference_points)) if points.size > 0 else 0.0
+            comparison = 'max deviation %g' % max_error
+        else:
+            comparison = 'DIFFERENT number of points (%i)' % reference_points.shape[0]
+        print '%s: %i faces, %i points' % (obj_id, len(v0), points.shape[0])
+        print '    sample_face loop: %10.3f s' % loop_time
+        print '    sample_faces (slices): %10.3f s, speedup %.1f, %s' % (slices_time, loop_time / slices_time,
+                                                                      comparison)
+        print '    sample_faces (random): %10.3f s, %i points' % (random_time, num_random_points)
+
+
+def filter_object_part_points_loop(points, part_description, distance_threshold=0.01):
+    """ The previous implementation of hfts_generation.filter_object_part_points (one query per point). """
+    import sklearn.neighbors
+    kdt = sklearn.neighbors.KDTree(part_description, metric='euclidean')
+    idx = np.ones(points.shape[0], dtype=bool)
+    for i in range(len(points)):
+        neighbors_in_part = kdt.query_radius(points[i, :3].reshape((1, 3)), distance_threshold, count_only=True)
+        idx[i] = neighbors_in_part > 0
+    return points[idx, :]
+
+
+def benchmark_part_filter(args):
+    from hfts_grasp_planner.hfts_generation import filter_object_part_points, read_object_part_description
+    points = load_object_points(args.data_path, args.object)
+    if args.part_file is not None:
+        part_description = read_object_part_description(args.part_file)
+    else:
+        # use all points within part_radius of a random object point as part
+        center = points[np.random.randint(points.shape[0]), :3]
+        part_description = points[np.linalg.norm(points[:, :3] - center, axis=1) <= args.part_radius, :3]
+    print '%s: %i points, %i part points, threshold %f' % (args.object, points.shape[0],
+                                                           part_description.shape[0], args.threshold)
+    loop_time = measure_runtime(lambda: filter_object_part_points_loop(points, part_description, args.threshold))
+    reference = filter_object_part_points_loop(points, part_description, args.threshold)
+    print '    per point queries: %8.3f s, %i points kept' % (loop_time, reference.shape[0])
+    for b_voxel_hash in [False, True]:
+        batch_time = measure_runtime(lambda: filter_object_part_points(points, part_description, args.threshold,
+                                                                       b_voxel_hash=b_voxel_hash),
+                                     args.repetitions)
+        result = filter_object_part_points(points, part_description, args.threshold, b_voxel_hash=b_voxel_hash)
+        b_same = result.shape == reference.shape and np.all(result == reference)
+        print '    batched (voxel hash %s): %8.3f s, speedup %.1f, %s result' % \
+              (str(b_voxel_hash), batch_time, loop_time / batch_time, 'same' if b_same else 'DIFFERENT')
+
+
+# (name, clustering method, n_init, max_iter) of the clustering settings to compare
+CLUSTERING_SETTINGS = [('kmeans', 'kmeans', None, None),
+                       ('kmeans n_init=3', 'kmeans', 3, None),
+                       ('kmeans n_init=1', 'kmeans', 1, None),
+                       ('minibatch_kmeans', 'minibatch_kmeans', None, None),
+                       ('lloyd max_iter=10', 'lloyd', None, 10),
+                       ('lloyd max_iter=30', 'lloyd', None, 30)]
+
+
+def benchmark_clustering(args):
+    from hfts_grasp_planner.hfts_generation import HFTSGenerator
+    points = load_object_points(args.data_path, args.object)
+    com = np.mean(points[:, :3], axis=0)
+    print '%s: %i points' % (args.object, points.shape[0])
+    for name, method, n_init, max_iter in CLUSTERING_SETTINGS:
+        hfts_gen = HFTSGenerator(points, com)
+        hfts_gen.set_clustering_method(method, n_init=n_init, max_iter=max_iter)
+        hfts_gen.set_random_seed(args.seed)
+        hfts_gen.set_num_workers(args.num_workers)
+        hfts_gen.set_balanced(args.balanced)
+        start_time = time.time()
+        hfts_gen.run()
+        run_time = time.time() - start_time
+        stats = hfts_gen.get_clustering_stats()
+        offsets = hfts_gen.get_hfts_offsets()
+        min_leaf_size = np.min(np.diff(offsets[-1])) if len(offsets) > 0 else 0
+        print '    %-20s total: %8.3f s, clustering: %8.3f s, inertia: %12.4f, levels: %i, min leaf size: %i' % \
+              (name, run_time, stats['time'], stats['inertia'], len(offsets), min_leaf_size)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-benchmarks for the HFTS grasp planner.')
+    parser.add_argument('--data_path', type=str, default=DEFAULT_DATA_PATH, help='Path to the object data base')
+    parser.add_argument('--object', type=str, default='bunny', help='Object to run benchmarks on')
+    subparsers = parser.add_subparsers()
+    index_parser = subparsers.add_parser('index', help='Query throughput of spatial index backends')
+    index_parser.add_argument('--hand_cache_file', type=str, default=None,
+                              help='Hand manifold cache file (e.g. data/cache/robotiq_hand.npy)')
+    index_parser.add_argument('--num_queries', type=int, default=10000)
+    index_parser.add_argument('--batch_size', type=int, default=40, help='Number of codes queried per SHC step')
+    index_parser.add_argument('--leaf_sizes', type=int, nargs='+', default=[8, 16, 32])
+    index_parser.set_defaults(function=benchmark_spatial_index)
+    sampling_parser = subparsers.add_parser('sampling', help='Surface sampling of object meshes')
+    sampling_parser.add_argument('--objects', type=str, nargs='+', default=None,
+                                 help='Objects to sample (default: all objects in the data base)')
+    sampling_parser.add_argument('--density', type=float, default=300, help='Sample density in points/meter')
+    sampling_parser.add_argument('--repetitions', type=int, default=3)
+    sampling_parser.set_defaults(function=benchmark_sampling)
+    part_filter_parser = subparsers.add_parser('part_filter', help='Filtering of points by object part')
+    part_filter_parser.add_argument('--part_file', type=str, default=None,
+                                    help='Object part description (default: a random patch of the object)')
+    part_filter_parser.add_argument('--part_radius', type=float, default=0.03,
+                                    help='Radius of the random patch used as part')
+    part_filter_parser.add_argument('--threshold', type=float, default=0.01, help='Distance threshold')
+    part_filter_parser.add_argument('--repetitions', type=int, default=10)
+    part_filter_parser.set_defaults(function=benchmark_part_filter)
+    clustering_parser = subparsers.add_parser('clustering', help='HFTS generation with different clustering methods')
+    clustering_parser.add_argument('--seed', type=int, default=0, help='Random seed for clustering')
+    clustering_parser.add_argument('--num_workers', type=int, default=1,
+                                   help='Number of threads that partition the nodes of a level')
+    clustering_parser.add_argument('--balanced', action='store_true', help='Partition into clusters of equal size')
+    clustering_parser.set_defaults(function=benchmark_clustering)
+    arguments = parser.parse_args()
+    arguments.function(arguments)
@@ -2,6 +2,7 @@
 
 import rospy
 import rospkg
+import numpy as np
 from hfts_grasp_planner.utils import *
 from hfts_grasp_planner.core import HFTSSampler, HFTSNode
 from hfts_grasp_planner.srv import PlanGrasp, PlanGraspRequest, PlanGraspResponse
@@ -26,6 +27,11 @@ class HandlerClass(object):
         self._params = {}
         # Update static parameters
         b_visualize = rospy.get_param(rospy.get_name() + '/visualize', default=False)
+        # if positive, the planner samples grasps for this many seconds and returns the best one
+        self._planning_time_budget = rospy.get_param(rospy.get_name() + '/planning_time_budget', default=0.0)
+        self._num_sampling_workers = rospy.get_param(rospy.get_name() + '/num_sampling_workers', default=1)
+        self._point_cloud_time_budget = rospy.get_param(rospy.get_name() + '/point_cloud_time_budget',
+                                                        default=DEFAULT_POINT_CLOUD_TIME_BUDGET)
         # Update dynamic parameters
         # Create planner
         self._object_loader = ObjectFileIO(package_path + '/data/')
@@ -34,6 +40,9 @@ class HandlerClass(object):
         hand_file = package_path + rospy.get_param(rospy.get_name() + '/hand_file')
         hand_cache_file = package_path + '/' + rospy.get_param(rospy.get_name() + '/hand_cache_file')
         self._planner.load_hand(hand_file, hand_cache_file)
+        if self._num_sampling_workers > 1:
+            # set up the sampling processes now rather than on the first request
+            self._planner.start_worker_pool(self._num_sampling_workers)
         or_hand = self._planner.get_or_hand()
         joints = or_hand.GetJoints()
         self._joint_names = []
@@ -42,66 +51,71 @@ class HandlerClass(object):
 
     def handle_plan_request(self, req):
         """ Callback function for a grasp planning servce request. """
-        # TODO generate HFTS from point cloud if point cloud is specified
-        # pointCloud = req.point_cloud
         rospy.loginfo('Executing planner with parameters: ' + str(self._params))
-        # Load the requested object first
+        # Set the parameters first, so that the object's hfts is checked against (and if needed generated with)
+        # the current generation parameters
         # TODO setting this boolean parameter should be solved in a more elegant manner
         self._object_loader._b_var_filter = self._params['hfts_filter_points']
-        self._planner.load_object(req.object_identifier)
-        hfts_gen_params = {'max_normal_variance': self._params['max_normal_variance'],
-                           'contact_density': self._params['contact_density'],
-                           'min_contact_patch_radius': self._params['min_contact_patch_radius'],
-                           'max_num_points': self._params['max_num_points'],
-                           'position_weight': self._params['hfts_position_weight'],
-                           'branching_factor': self._params['hfts_branching_factor'],
-                           'first_level_branching_factor': self._params['hfts_first_level_branching_factor']}
         self._planner.set_parameters(max_iters=self._params['num_hfts_iterations'],
                                      reachability_weight=self._params['reachability_weight'],
                                      com_center_weight=self._params['com_center_weight'],
-                                     hfts_generation_params=hfts_gen_params,
+                                     hfts_generation_params=create_hfts_generation_params(self._params),
                                      b_force_new_hfts=self._params['force_new_hfts'])
+        # Then load the requested object
+        model_id = None
+        if len(req.point_cloud.points) > 0:
+            # The object is given as point cloud (in the object frame), generate an HFTS from it
+            positions = np.array([[point.x, point.y, point.z] for point in req.point_cloud.points])
+            model_id = self._object_loader.add_point_cloud(positions, time_budget=self._point_cloud_time_budget)
+            if model_id is None:
+                rospy.logerr('[HandlerClass::handle_plan_request] Could not generate an HFTS from the point cloud.')
+                return PlanGraspResponse(False, PoseStamped(), JointState())
+        self._planner.load_object(req.object_identifier, model_id)
         # We always start from the root node, so create a root node
         root_hfts_node = HFTSNode()
-        num_planning_attempts = self._params['num_planning_attempts']
-        rospy.loginfo('[HandlerClass::handle_plan_request] Planning grasp, running %i attempts.' % num_planning_attempts)
-        iteration = 0
-        # Iterate until either shutdown, max_iterations reached or a good grasp was found
-        while iteration < num_planning_attempts and not rospy.is_shutdown():
-            return_node = self._planner.sample_grasp(root_hfts_node,
-                                                     self._planner.get_maximum_depth(),
-                                                     post_opt=True)
-            iteration += 1
-            if return_node.is_goal():
-                rospy.loginfo('[HandlerClass::handle_plan_request] Found a grasp after %i attempts.' % iteration)
-                grasp_pose = return_node.get_hand_transform()
-                pose_quaternion = tff.quaternion_from_matrix(grasp_pose)
-                pose_position = grasp_pose[:3, -1]
-                # Save pose in ROS pose
-                ros_grasp_pose = Pose()
-                ros_grasp_pose.position.x = pose_position[0]
-                ros_grasp_pose.position.y = pose_position[1]
-                ros_grasp_pose.position.z = pose_position[2]
-                ros_grasp_pose.orientation.x = pose_quaternion[0]
-                ros_grasp_pose.orientation.y = pose_quaternion[1]
-                ros_grasp_pose.orientation.z = pose_quaternion[2]
-                ros_grasp_pose.orientation.w = pose_quaternion[3]
-                # Make a header for the message
-                header = Header()
-                header.frame_id = req.object_identifier
-                header.stamp = rospy.Time.now()
-                # Create stamped pose
-                stamped_ros_grasp_pose = PoseStamped()
-                stamped_ros_grasp_pose.pose = ros_grasp_pose
-                stamped_ros_grasp_pose.header = header
-                # Create JointState message to send hand configuration
-                hand_conf = return_node.get_hand_config()
-                ros_hand_joint_state = JointState()
-                ros_hand_joint_state.header = header
-                ros_hand_joint_state.position = hand_conf
-                ros_hand_joint_state.name = self._joint_names
-                # Return the response
-                return PlanGraspResponse(True, stamped_ros_grasp_pose, ros_hand_joint_state)
+        if self._planning_time_budget > 0.0:
+            rospy.loginfo('[HandlerClass::handle_plan_request] Planning grasp for %f s.' % self._planning_time_budget)
+            best_grasps = self._planner.sample_grasps_anytime(root_hfts_node, self._planner.get_maximum_depth(),
+                                                              self._planning_time_budget, num_best=1, post_opt=True)
+            return_node = best_grasps[0] if len(best_grasps) > 0 else None
+        else:
+            num_planning_attempts = self._params['num_planning_attempts']
+            rospy.loginfo('[HandlerClass::handle_plan_request] Planning grasp, running %i attempts.' %
+                          num_planning_attempts)
+            # Run attempts until either shutdown, all attempts failed or a good grasp was found
+            return_node = self._planner.sample_grasps(root_hfts_node, self._planner.get_maximum_depth(),
+                                                      num_planning_attempts, num_workers=self._num_sampling_workers,
+                                                      mode='first', post_opt=True)
+        if return_node is not None and return_node.is_goal():
+            rospy.loginfo('[HandlerClass::handle_plan_request] Found a grasp.')
+            grasp_pose = return_node.get_hand_transform()
+            pose_quaternion = tff.quaternion_from_matrix(grasp_pose)
+            pose_position = grasp_pose[:3, -1]
+            # Save pose in ROS pose
+            ros_grasp_pose = Pose()
+            ros_grasp_pose.position.x = pose_position[0]
+            ros_grasp_pose.position.y = pose_position[1]
+            ros_grasp_pose.position.z = pose_position[2]
+            ros_grasp_pose.orientation.x = pose_quaternion[0]
+            ros_grasp_pose.orientation.y = pose_quaternion[1]
+            ros_grasp_pose.orientation.z = pose_quaternion[2]
+            ros_grasp_pose.orientation.w = pose_quaternion[3]
+            # Make a header for the message
+            header = Header()
+            header.frame_id = req.object_identifier
+            header.stamp = rospy.Time.now()
+            # Create stamped pose
+            stamped_ros_grasp_pose = PoseStamped()
+            stamped_ros_grasp_pose.pose = ros_grasp_pose
+            stamped_ros_grasp_pose.header = header
+            # Create JointState message to send hand configuration
+            hand_conf = return_node.get_hand_config()
+            ros_hand_joint_state = JointState()
+            ros_hand_joint_state.header = header
+            ros_hand_joint_state.position = hand_conf
+            ros_hand_joint_state.name = self._joint_names
+            # Return the response
+            return PlanGraspResponse(True, stamped_ros_grasp_pose, ros_hand_joint_state)
         # In case of failure or shutdown return a response indicating failure.
         rospy.loginfo('[HandlerClass::handle_plan_request] Failed to find a grasp.')
         return PlanGraspResponse(False, PoseStamped(), JointState())
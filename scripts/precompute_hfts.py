@@ -0,0 +1,148 @@
+#! /usr/bin/python
+
+""" Generates or refreshes the HFTS models of all objects in an object data base ahead of time
+    and writes a manifest (JSON) with the generation parameters, timings, point counts and level counts.
+    Objects whose stored HFTS is up to date (same mesh and generation parameters) are skipped,
+    unless --force is given.
+    By default, the generation parameters are the ones the hfts planner node uses, i.e. the defaults of
+    cfg/hfts_planner.cfg overwritten by the node's parameters on the parameter server (if a master is running),
+    so that the precomputed models are up to date when the node receives its first request.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import time
+import numpy as np
+import rospy
+from hfts_grasp_planner.utils import ObjectFileIO, create_hfts_generation_params
+from hfts_grasp_planner.cfg.HFTSPlannerConfig import defaults as PLANNER_CONFIG_DEFAULTS
+
+DEFAULT_DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')
+MANIFEST_FILE_NAME = 'hfts_manifest.json'
+DEFAULT_NODE_NAME = '/hfts_planner_node'
+
+
+def load_planner_config(node_name):
+    """ Returns the configuration of the hfts planner node with the given name. Parameters that are not
+        on the parameter server (or all, if no master is running) take the defaults of cfg/hfts_planner.cfg.
+    """
+    config = dict(PLANNER_CONFIG_DEFAULTS)
+    try:
+        node_params = rospy.get_param(node_name, {})
+    except (socket.error, rospy.ROSException) as e:
+        print 'Could not read the parameters of %s (%s), using the defaults of cfg/hfts_planner.cfg' % \
+            (node_name, str(e))
+        node_params = {}
+    if isinstance(node_params, dict):
+        config.update(node_params)
+    return config
+
+
+def find_objects(data_path):
+    """ Returns the ids of all objects in the data base that have a mesh. """
+    obj_ids = []
+    for obj_id in sorted(os.listdir(data_path)):
+        obj_file = os.path.join(data_path, obj_id, 'objectModel')
+        if os.path.isfile(obj_file + '.ply') or os.path.isfile(obj_file + '.stl'):
+            obj_ids.append(obj_id)
+    return obj_ids
+
+
+def process_object(task):
+    """ Generates (if needed) the HFTS of a single object and returns (obj_id, manifest entry). """
+    data_path, obj_id, params, b_var_filter, b_force, num_generation_workers, num_filter_processes = task
+    object_io = ObjectFileIO(data_path, var_filter=b_var_filter, hfts_generation_parameters=params,
+                             num_generation_workers=num_generation_workers,
+                             num_filter_processes=num_filter_processes)
+    b_up_to_date = not b_force and object_io.is_hfts_up_to_date(obj_id)
+    start_time = time.time()
+    try:
+        hfts, hfts_param, obj_com = object_io.get_hfts(obj_id, force_new=b_force)
+    except Exception as e:
+        return obj_id, {'status': 'failed', 'error': str(e)}
+    run_time = time.time() - start_time
+    if hfts is None:
+        return obj_id, {'status': 'failed', 'error': 'Could not load or generate HFTS'}
+    offsets = object_io.get_hfts_offsets(obj_id)
+    return obj_id, {'status': 'up_to_date' if b_up_to_date else 'generated',
+                    'time': run_time,
+                    'num_points': int(hfts.shape[0]),
+                    'branching_factors': [int(b) for b in hfts_param],
+                    # number of non-empty nodes on each level
+                    'level_counts': [int(np.count_nonzero(np.diff(level_offsets))) for level_offsets in offsets],
+                    'generation_params': object_io.get_hfts_generation_parameters(),
+                    'model_file': object_io.get_hfts_model_file_name(obj_id)}
+
+
+def load_manifest(manifest_file):
+    if os.path.isfile(manifest_file):
+        with open(manifest_file, 'r') as input_file:
+            return json.load(input_file)
+    return {'objects': {}}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Precomputes the HFTS models of an object data base.')
+    parser.add_argument('--data_path', type=str, default=DEFAULT_DATA_PATH, help='Path to the object data base')
+    parser.add_argument('--objects', type=str, nargs='+', default=None,
+                        help='Objects to process (default: all objects in the data base)')
+    parser.add_argument('--params', type=str, default=None,
+                        help='HFTS generation parameters as JSON dictionary, e.g. \'{"branching_factor": 4}\'. '
+                             'Parameters not given take the values of the planner node.')
+    parser.add_argument('--var-filter', '--var_filter', dest='var_filter', type=str, default=None,
+                        choices=['true', 'false'],
+                        help='Whether to filter points with high normal variance '
+                             '(default: hfts_filter_points of the planner node)')
+    parser.add_argument('--node_name', type=str, default=DEFAULT_NODE_NAME,
+                        help='Name of the planner node whose parameters to use')
+    parser.add_argument('--force', action='store_true', help='Regenerate also up-to-date HFTS models')
+    parser.add_argument('--num_processes', type=int, default=multiprocessing.cpu_count(),
+                        help='Number of objects to process in parallel')
+    parser.add_argument('--num_generation_workers', type=int, default=1,
+                        help='Number of threads used to generate a single HFTS')
+    parser.add_argument('--manifest', type=str, default=None,
+                        help='Manifest file (default: %s in the data base)' % MANIFEST_FILE_NAME)
+    args = parser.parse_args()
+    planner_config = load_planner_config(args.node_name)
+    params = create_hfts_generation_params(planner_config)
+    if args.params is not None:
+        params.update(json.loads(args.params))
+    if args.var_filter is not None:
+        b_var_filter = args.var_filter == 'true'
+    else:
+        b_var_filter = bool(planner_config['hfts_filter_points'])
+    obj_ids = args.objects if args.objects is not None else find_objects(args.data_path)
+    manifest_file = args.manifest if args.manifest is not None else os.path.join(args.data_path, MANIFEST_FILE_NAME)
+    b_pool = args.num_processes > 1 and len(obj_ids) > 1
+    # workers of a pool are daemonic and may not start processes themselves, so they filter serially
+    num_filter_processes = 1 if b_pool else None
+    tasks = [(args.data_path, obj_id, params, b_var_filter, args.force, args.num_generation_workers,
+              num_filter_processes) for obj_id in obj_ids]
+    start_time = time.time()
+    if b_pool:
+        pool = multiprocessing.Pool(min(args.num_processes, len(tasks)))
+        try:
+            results = pool.map(process_object, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(process_object, tasks)
+    manifest = load_manifest(manifest_file)
+    # parameters of the last run, entries of objects not processed in this run may differ
+    manifest['generation_params'] = ObjectFileIO(args.data_path, var_filter=b_var_filter,
+                                                 hfts_generation_parameters=params).get_hfts_generation_parameters()
+    manifest['time'] = time.time() - start_time
+    for obj_id, entry in results:
+        manifest['objects'][obj_id] = entry
+        if entry['status'] == 'failed':
+            print '%-30s failed: %s' % (obj_id, entry['error'])
+        else:
+            print '%-30s %-10s %8.2f s, %6i points, levels %s' % (obj_id, entry['status'], entry['time'],
+                                                                 entry['num_points'], str(entry['level_counts']))
+    with open(manifest_file, 'w') as output_file:
+        json.dump(manifest, output_file, indent=2, sort_keys=True)
+    print 'Processed %i objects in %.2f s, manifest written to %s' % (len(results), manifest['time'], manifest_file)
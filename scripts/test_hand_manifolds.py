@@ -0,0 +1,107 @@
+#! /usr/bin/python
+
+""" Checks that the vectorized methods of the Robotiq hand manifolds return the same
+    results as their scalar counterparts. """
+
+import argparse
+import numpy as np
+import openravepy as orpy
+from hfts_grasp_planner.robotiqloader import RobotiqHand, RobotiqHandVirtualManifold
+
+
+def create_random_grasps(num_grasps, degenerate_fraction=0.1, invalid_fraction=0.05):
+    positions = 0.1 * np.random.rand(num_grasps, 3, 3)
+    normals = np.random.randn(num_grasps, 3, 3)
+    normals /= np.linalg.norm(normals, axis=2)[:, :, np.newaxis]
+    # Include grasps with identical contacts 0 and 1 to check the special cases in the encodings
+    num_degenerate = int(degenerate_fraction * num_grasps)
+    positions[:num_degenerate, 1] = positions[:num_degenerate, 0]
+    normals[:num_degenerate, 1] = normals[:num_degenerate, 0]
+    # and grasps with a contact without normal, whose codes contain NaN and are hence invalid
+    num_invalid = int(invalid_fraction * num_grasps)
+    normals[num_grasps - num_invalid:, 2] = np.nan
+    return np.concatenate((positions, normals), axis=2)
+
+
+def get_configs(predictions, dof):
+    # predict_hand_conf returns None for invalid codes, the batch versions NaN
+    return [p[1] if p[1] is not None else np.full(dof, np.nan) for p in predictions]
+
+
+def compare_results(name, scalar_values, batch_values, tolerance=1e-9):
+    scalar_values = np.asarray(scalar_values, dtype=float)
+    batch_values = np.asarray(batch_values, dtype=float)
+    b_both_nan = np.logical_and(np.isnan(scalar_values), np.isnan(batch_values))
+    with np.errstate(invalid='ignore'):
+        # equality for infinite values
+        b_close = np.logical_or(scalar_values == batch_values, np.abs(scalar_values - batch_values) <= tolerance)
+    b_match = np.logical_or(b_both_nan, b_close)
+    if b_match.ndim > 1:
+        b_match = b_match.all(axis=tuple(range(1, b_match.ndim)))
+    print '%s: %i/%i results match' % (name, np.sum(b_match), len(b_match))
+    return bool(b_match.all())
+
+
+def test_kd_tree_manifold(manifold, grasps, obj_com):
+    b_success = True
+    codes = np.array([manifold.encode_grasp(grasp) for grasp in grasps])
+    b_success &= compare_results('RobotiqHandKDTreeManifold.encode_grasp', codes,
+                                 manifold.encode_grasp_batch(grasps))
+    qualities = [manifold.compute_grasp_quality(obj_com, grasp) for grasp in grasps]
+    b_success &= compare_results('RobotiqHandKDTreeManifold.compute_grasp_quality', qualities,
+                                 manifold.compute_grasp_quality_batch(obj_com, grasps))
+    predictions = [manifold.predict_hand_conf(code) for code in codes]
+    distances, configs = manifold.predict_hand_conf_batch(codes)
+    b_success &= compare_results('RobotiqHandKDTreeManifold.predict_hand_conf (residual)',
+                                 [p[0] for p in predictions], distances)
+    b_success &= compare_results('RobotiqHandKDTreeManifold.predict_hand_conf (config)',
+                                 get_configs(predictions, configs.shape[1]), configs)
+    return b_success
+
+
+def test_virtual_manifold(manifold, grasps, obj_com):
+    b_success = True
+    codes = np.array([manifold.encode_grasp(grasp) for grasp in grasps])
+    b_success &= compare_results('RobotiqHandVirtualManifold.encode_grasp', codes,
+                                 manifold.encode_grasp_batch(grasps))
+    qualities = [manifold.compute_grasp_quality(obj_com, grasp) for grasp in grasps]
+    b_success &= compare_results('RobotiqHandVirtualManifold.compute_grasp_quality', qualities,
+                                 manifold.compute_grasp_quality_batch(obj_com, grasps))
+    # get_pred_res is only defined for valid codes
+    valid_codes = codes[np.logical_not(np.isnan(codes).any(axis=1))]
+    b_success &= compare_results('RobotiqHandVirtualManifold.get_pred_res',
+                                 [manifold.get_pred_res(code) for code in valid_codes],
+                                 manifold.get_pred_res_batch(valid_codes))
+    predictions = [manifold.predict_hand_conf(code) for code in codes]
+    residuals, configs = manifold.predict_hand_conf_batch(codes)
+    b_success &= compare_results('RobotiqHandVirtualManifold.predict_hand_conf (residual)',
+                                 [p[0] for p in predictions], residuals)
+    b_success &= compare_results('RobotiqHandVirtualManifold.predict_hand_conf (config)',
+                                 get_configs(predictions, configs.shape[1]), configs)
+    distances = np.concatenate((np.linspace(-0.1, 0.3, 50), [np.nan]))
+    b_success &= compare_results('RobotiqHandVirtualManifold.exp_distance_range',
+                                 [manifold.exp_distance_range(d, [0.0255, 0.122]) for d in distances],
+                                 manifold.exp_distance_range_batch(distances, [0.0255, 0.122]))
+    return b_success
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares scalar and vectorized hand manifold functions.')
+    parser.add_argument('hand_file', type=str, help='OpenRAVE model of the Robotiq hand')
+    parser.add_argument('hand_cache_file', type=str, help='Cache file for the hand manifold')
+    parser.add_argument('--num_grasps', type=int, default=1000, help='Number of random grasps to test')
+    args = parser.parse_args()
+    env = orpy.Environment()
+    hand = RobotiqHand(env=env, hand_cache_file=args.hand_cache_file, hand_file=args.hand_file)
+    kd_tree_manifold = hand.get_hand_manifold()
+    kd_tree_manifold.load()
+    virtual_manifold = RobotiqHandVirtualManifold(hand)
+    test_grasps = create_random_grasps(args.num_grasps)
+    test_com = np.array([0.05, 0.05, 0.05])
+    b_kd_tree_ok = test_kd_tree_manifold(kd_tree_manifold, test_grasps, test_com)
+    b_virtual_ok = test_virtual_manifold(virtual_manifold, test_grasps, test_com)
+    if b_kd_tree_ok and b_virtual_ok:
+        print 'All vectorized hand manifold functions agree with their scalar versions.'
+    else:
+        print 'Some vectorized hand manifold functions do NOT agree with their scalar versions!'
+    orpy.RaveDestroy()
@@ -2,15 +2,21 @@
 
 import numpy as np
 import math
-from scipy.spatial import KDTree
 import openravepy as orpy
 import transformations
 from robotiqloader import RobotiqHand, InvalidTriangleException
-import sys, time, logging, copy
+import sys, time, logging, copy, os, hashlib
+import cPickle as pickle
+import heapq
 import itertools
-from utils import ObjectFileIO, clamp, compute_grasp_stability, normal_distance, position_distance, dist_in_range
+import multiprocessing
+from hfts_generation import compute_node_indices
+from spatial_index import load_or_build_index
+from utils import ObjectFileIO, LRUCache, compute_memory_size, clamp, compute_grasp_stability, normal_distance, \
+    position_distance, dist_in_range
 import rospy
 import scipy.optimize
+from scipy.spatial import ConvexHull
 
 
 class PlanningSceneInterface(object):
@@ -66,7 +72,255 @@ class PlanningSceneInterface(object):
         return b_sol_col_free, sol, pre_grasp_conf
 
 
+class HFTSClusterTable(object):
+    """ Dense per-level lookup table of the clusters (nodes) of an HFTS.
+        A node on level l with label [c_0, ..., c_l] is stored at the flat index
+        (...(c_0 * b_1 + c_1) * b_2 + ...) * b_l + c_l, where b_i are the branching factors.
+        For each node the table stores the mean position, the normalized mean normal,
+        the number of points and the range of its points in the label-sorted HFTS data.
+    """
+
+    def __init__(self, data_labeled, branching_factors):
+        """ Builds the table for the given HFTS.
+            @param data_labeled Array where each row is [position, normal, labels] (as stored by ObjectFileIO).
+                If the rows are sorted by labels (see hfts_generation.sort_hfts), the table references
+                the data without copying it.
+            @param branching_factors List of branching factors, one for each level of the HFTS
+        """
+        self._branching_factors = [int(b) for b in branching_factors]
+        num_levels = len(self._branching_factors)
+        labels = data_labeled[:, 6:6 + num_levels].astype(int)
+        b_valid = np.logical_and(labels >= 0, labels < np.array(self._branching_factors)).all(axis=1)
+        if not b_valid.all():
+            data_labeled = data_labeled[b_valid]
+            labels = labels[b_valid]
+        node_indices = compute_node_indices(labels, self._branching_factors)
+        if num_levels > 0 and np.any(node_indices[-1][1:] < node_indices[-1][:-1]):
+            order = np.argsort(node_indices[-1], kind='mergesort')
+            data_labeled = data_labeled[order]
+            node_indices = [level_indices[order] for level_indices in node_indices]
+        self._data = data_labeled
+        self._positions = []
+        self._normals = []
+        self._counts = []
+        self._offsets = []
+        num_nodes = 1
+        for level in range(num_levels):
+            num_nodes *= self._branching_factors[level]
+            counts = np.bincount(node_indices[level], minlength=num_nodes)
+            pos_sums = np.empty((num_nodes, 3))
+            normal_sums = np.empty((num_nodes, 3))
+            for dim in range(3):
+                pos_sums[:, dim] = np.bincount(node_indices[level], weights=self._data[:, dim],
+                                               minlength=num_nodes)
+                normal_sums[:, dim] = np.bincount(node_indices[level], weights=self._data[:, 3 + dim],
+                                                  minlength=num_nodes)
+            # empty nodes get NaN representatives, just like an average over no points would
+            with np.errstate(invalid='ignore', divide='ignore'):
+                self._positions.append(pos_sums / counts[:, np.newaxis].astype(float))
+                self._normals.append(-normal_sums / np.linalg.norm(normal_sums, axis=1)[:, np.newaxis])
+            self._counts.append(counts)
+            self._offsets.append(np.searchsorted(node_indices[level], np.arange(num_nodes + 1)))
+
+    def get_num_levels(self):
+        return len(self._branching_factors)
+
+    def get_data(self):
+        """ Returns the label-sorted HFTS data the table refers to. """
+        return self._data
+
+    def get_flat_index(self, label):
+        """ Returns the flat index of the node with the given label or -1 if there is no such node. """
+        index = 0
+        for c, b in itertools.izip(label, self._branching_factors):
+            if c < 0 or c >= b:
+                return -1
+            index = index * b + int(c)
+        return index
+
+    def get_repr(self, label):
+        """ Returns the representative (mean position, inverted normalized mean normal) of the given node.
+            For labels of non-existing nodes, NaN vectors are returned.
+        """
+        level = len(label) - 1
+        index = self.get_flat_index(label)
+        if index < 0:
+            return np.full(3, np.nan), np.full(3, np.nan)
+        return self._positions[level][index], self._normals[level][index]
+
+    def get_reprs(self, labels):
+        """ Vectorized version of get_repr.
+            @param labels Integer array of shape (..., l + 1) containing labels of nodes on level l
+            @return Array of shape (..., 6), where each entry is [position, normal] as returned by get_repr
+        """
+        labels = np.asarray(labels, dtype=int)
+        level = labels.shape[-1] - 1
+        index = np.zeros(labels.shape[:-1], dtype=int)
+        b_valid = np.ones(labels.shape[:-1], dtype=bool)
+        for l in range(level + 1):
+            b = self._branching_factors[l]
+            b_valid &= np.logical_and(labels[..., l] >= 0, labels[..., l] < b)
+            index = index * b + labels[..., l]
+        index = np.where(b_valid, index, 0)
+        reprs = np.concatenate((self._positions[level][index], self._normals[level][index]), axis=-1)
+        reprs[np.logical_not(b_valid)] = np.nan
+        return reprs
+
+    def get_count(self, label):
+        """ Returns the number of points in the given node. """
+        index = self.get_flat_index(label)
+        if index < 0:
+            return 0
+        return self._counts[len(label) - 1][index]
+
+    def get_range(self, label):
+        """ Returns (start, end) such that get_data()[start:end] are all points of the given node. """
+        index = self.get_flat_index(label)
+        if index < 0:
+            return 0, 0
+        offsets = self._offsets[len(label) - 1]
+        return offsets[index], offsets[index + 1]
+
+    def get_points(self, label):
+        """ Returns all points of the given node as a view on the HFTS data. """
+        start, end = self.get_range(label)
+        return self._data[start:end]
+
+    def get_memory_size(self):
+        """ Returns the number of bytes occupied by the table (excluding the HFTS data it references). """
+        return compute_memory_size(self._positions, self._normals, self._counts, self._offsets)
+
+
+# Default memory budget in bytes for the grasp simulation results HFTSSampler keeps per object
+DEFAULT_GRASP_SIMULATION_CACHE_SIZE = 16 * 1024 * 1024
+# Approximate number of bytes of a grasp simulation result besides its arrays (key, tuples)
+GRASP_SIMULATION_ENTRY_OVERHEAD = 256
+# Version of the files grasp simulation results are persisted in
+GRASP_SIMULATION_FILE_VERSION = 1
+
+
+class HFTSObjectData(object):
+    """ Everything the HFTSSampler needs to plan grasps on an object: the object's HFTS, the nearest neighbor
+        index of its points, its cluster table and its OpenRAVE KinBody. The HFTSSampler keeps instances of
+        this class for recently used objects, so that switching between them does not require to rebuild them.
+    """
+    def __init__(self, model_id, data_labeled, branching_factors, obj_com, kd_tree, cluster_table, kinbody):
+        self.model_id = model_id
+        self.data_labeled = data_labeled
+        self.branching_factors = branching_factors
+        self.obj_com = obj_com
+        self.kd_tree = kd_tree
+        self.cluster_table = cluster_table
+        self.kinbody = kinbody
+        # results of hand-only grasp simulations of leaves, see HFTSSampler._simulate_leaf_grasp
+        self.grasp_simulations = LRUCache(DEFAULT_GRASP_SIMULATION_CACHE_SIZE)
+        self.b_grasp_simulations_changed = False
+        self._checksum = None
+
+    def get_checksum(self):
+        """ Returns a checksum of the object's hfts, which identifies the object's data across processes. """
+        if self._checksum is None:
+            self._checksum = hashlib.sha1(np.ascontiguousarray(self.data_labeled, dtype=float)).hexdigest()
+        return self._checksum
+
+    def get_memory_size(self):
+        """ Returns the approximate number of bytes occupied by this object's data. A memory-mapped hfts is not
+            counted, since it is owned (and accounted for) by the ObjectIO.
+        """
+        return compute_memory_size(self.data_labeled) + self.kd_tree.get_memory_size() + \
+            self.cluster_table.get_memory_size() + self.grasp_simulations.get_size()
+
+    def add_grasp_simulation(self, key, value):
+        self.grasp_simulations.put(key, value, size=compute_memory_size(value) + GRASP_SIMULATION_ENTRY_OVERHEAD)
+
+
+# Default memory budget in bytes of the HFTSSampler cache of per-object data
+DEFAULT_OBJECT_CACHE_SIZE = 256 * 1024 * 1024
+
+# Default maximal number of grasp evaluations HFTSSampler memoizes per object, see evaluate_grasp
+DEFAULT_GRASP_EVALUATION_CACHE_SIZE = 100000
+
+# Default number of grasps HFTSSampler.sample_grasps_anytime returns
+DEFAULT_NUM_BEST_GRASPS = 5
+
+# Parameters of HFTSSampler.set_parameters that affect sampling and are hence passed on to worker samplers.
+# The others concern the hfts generation, persistence and caching, which are up to the parent sampler.
+WORKER_PARAMETER_NAMES = ['max_iters', 'reachability_weight', 'com_center_weight', 'b_batch_shc',
+                          'object_index_params', 'hand_index_params', 'grasp_evaluation_cache_size']
+
+# State of the worker processes of HFTSSampler.sample_grasps. Every worker process has its own sampler
+# with its own OpenRAVE environment and hand.
+_worker_sampler = None
+_worker_stop_event = None
+_worker_object_key = None
+_worker_parameters = None
+
+
+def _init_sampler_worker(object_io_interface, num_hops, hand_file, hand_cache_file, stop_event):
+    global _worker_sampler, _worker_stop_event
+    _worker_sampler = HFTSSampler(object_io_interface, num_hops=num_hops)
+    _worker_sampler.load_hand(hand_file, hand_cache_file)
+    _worker_stop_event = stop_event
+
+
+def _load_worker_object(object_key):
+    """ Loads the object identified by object_key = (model_id, checksum of its hfts) in the worker's sampler.
+        The hfts is read from the data base the parent sampler stored it in (memory-mapped), and is reread
+        if the worker's cached version differs, e.g. because the parent regenerated it.
+    """
+    model_id, checksum = object_key
+    for b_reload in [False, True]:
+        data_labeled, branching_factors, obj_com = \
+            _worker_sampler._object_io_interface.get_stored_hfts(model_id, b_reload)
+        if data_labeled is None:
+            break
+        _worker_sampler._set_object(model_id, model_id, data_labeled, branching_factors, obj_com)
+        if _worker_sampler._object_data.get_checksum() == checksum:
+            return
+    raise RuntimeError('[HFTSSampler::sample_grasps] Worker could not load the HFTS of model %s' % model_id)
+
+
+def _sample_grasps_worker(task):
+    """ Runs num_samples chains in a worker process and returns the results of all chains that were not
+        aborted, and the grasp simulations of leaves that were computed on the way (key, value).
+    """
+    global _worker_object_key, _worker_parameters
+    object_key, parameters, node, depth_limit, num_samples, b_first, post_opt, seed = task
+    # all workers are forked from the same process, so they need different seeds to run independent chains
+    np.random.seed(seed)
+    if object_key != _worker_object_key:
+        _worker_object_key = None
+        _load_worker_object(object_key)
+        _worker_object_key = object_key
+    if parameters != _worker_parameters:
+        _worker_sampler.set_parameters(**parameters)
+        _worker_parameters = parameters
+    _worker_sampler._new_grasp_simulations = []
+    results = []
+    try:
+        for i in range(num_samples):
+            if _worker_stop_event.is_set():
+                break
+            result = _worker_sampler.sample_grasp(node, depth_limit, post_opt=post_opt,
+                                                  stop_event=_worker_stop_event)
+            # an aborted chain returns the node it started from
+            if result is node or result.get_depth() == 0 or \
+                    (not result.is_goal() and _worker_stop_event.is_set()):
+                continue
+            results.append(result)
+            if b_first and result.is_goal():
+                # stop all other workers
+                _worker_stop_event.set()
+                break
+        return results, _worker_sampler._new_grasp_simulations
+    finally:
+        _worker_sampler._new_grasp_simulations = None
+
+
 class HFTSSampler:
+    # Available modes of sample_grasps
+    SAMPLE_MODES = ['first', 'best']
+
     def __init__(self, object_io_interface, scene_interface=None, verbose=False, num_hops=2, vis=False):
         self._verbose = verbose
         self._sampler_viewer = vis
@@ -83,27 +337,50 @@ class HFTSSampler:
         self._scene_interface = scene_interface
         self._obj_loaded = False
         self._max_iters = 40
+        # running estimate of the time in seconds sample_grasp takes to simulate a leaf and check the arm
+        self._grasp_check_time = 0.0
+        self._b_batch_shc = True
         self._reachability_weight = 1.0
+        self._com_center_weight = None
+        # memo of evaluate_grasp results of the current object, each entry has size 1
+        self._grasp_evaluation_cache = LRUCache(DEFAULT_GRASP_EVALUATION_CACHE_SIZE)
         self._mu = 2.0
         self._min_stability = 0.0
         self._b_force_new_hfts = False
         self._object_kd_tree = None
+        self._object_index_params = {}
         self._object_points = None
         # self._hops = num_hops
         # TODO remove this aga
         self._hops = 2
         self._robot = None
         self._obj = None
+        self._model_id = None
+        self._object_data = None
+        self._b_persist_grasp_simulations = False
+        self._object_cache = LRUCache(DEFAULT_OBJECT_CACHE_SIZE, on_evict=self._release_object)
         self._obj_com = None
         self._data_labeled = None
+        self._cluster_table = None
         self._hand_manifold = None
         self._num_contacts = None
         self._contact_combinations = []
         self._num_levels = 0
         self._branching_factors = []
         self._object_io_interface = object_io_interface
+        # if a list, _simulate_leaf_grasp appends every new simulation result (see _sample_grasps_worker)
+        self._new_grasp_simulations = None
+        self._hand_file = None
+        self._hand_cache_file = None
+        # all parameters set with set_parameters, so that worker samplers can be configured alike
+        self._parameters = {}
+        self._worker_pool = None
+        self._num_pool_workers = 0
+        self._worker_stop_event = None
 
     def __del__(self):
+        self.close_worker_pool()
+        self.save_grasp_simulations()
         orpy.RaveDestroy()
 
     def check_arm_grasp_validity(self, grasp_conf, grasp_pose, seed, open_hand_offset=0.1):
@@ -130,8 +407,8 @@ class HFTSSampler:
                                             mu=self._mu)
         return stability > self._min_stability and self.is_grasp_collision_free()
 
-    def create_object_kd_tree(self, points):
-        self._object_kd_tree = KDTree(points[:, :3])
+    def create_object_kd_tree(self, points, cache_prefix=None):
+        self._object_kd_tree = load_or_build_index(points[:, :3], cache_prefix, **self._object_index_params)
         self._object_points = points
 
     def compute_allowed_contact_combinations(self, depth, label_cache):
@@ -211,6 +488,17 @@ class HFTSSampler:
         self._or_handles[handle_index] = arrow_handles
 
     def evaluate_grasp(self, contact_label):
+        """ Returns the tuple (s, r, o) of stability, reachability residual and objective of the grasp with
+            the given contact labels. Results are memoized per object.
+        """
+        key = tuple(int(c) for c in itertools.chain.from_iterable(contact_label))
+        result = self._grasp_evaluation_cache.get(key)
+        if result is None:
+            result = self._compute_grasp_evaluation(contact_label)
+            self._grasp_evaluation_cache.put(key, result, size=1)
+        return result
+
+    def _compute_grasp_evaluation(self, contact_label):
         contacts = [] # a list of contact positions and normals
         for i in range(self._num_contacts):
             p, n = self.get_cluster_repr(contact_label[i])
@@ -228,6 +516,39 @@ class HFTSSampler:
         # return s_tmp, r_tmp, o_tmp
         return s_tmp, r_tmp, -r_tmp
 
+    def evaluate_grasp_batch(self, contact_labels):
+        """ Vectorized version of evaluate_grasp. Only grasps that are not memoized yet are evaluated.
+            @param contact_labels Integer array of shape (n, num_contacts, depth) containing n grasp labels
+            @return tuple (s, r, o) of arrays of shape (n,), see evaluate_grasp
+        """
+        contact_labels = np.asarray(contact_labels, dtype=int)
+        num_grasps = contact_labels.shape[0]
+        keys = [tuple(row) for row in contact_labels.reshape((num_grasps, -1)).tolist()]
+        s_tmp, r_tmp, o_tmp = np.empty(num_grasps), np.empty(num_grasps), np.empty(num_grasps)
+        miss_indices = []
+        for i, key in enumerate(keys):
+            result = self._grasp_evaluation_cache.get(key)
+            if result is None:
+                miss_indices.append(i)
+            else:
+                s_tmp[i], r_tmp[i], o_tmp[i] = result
+        if len(miss_indices) > 0:
+            miss_indices = np.array(miss_indices)
+            s_miss, r_miss, o_miss = self._compute_grasp_evaluation_batch(contact_labels[miss_indices])
+            s_tmp[miss_indices], r_tmp[miss_indices], o_tmp[miss_indices] = s_miss, r_miss, o_miss
+            for i, s, r, o in itertools.izip(miss_indices, s_miss, r_miss, o_miss):
+                self._grasp_evaluation_cache.put(keys[i], (s, r, o), size=1)
+        return s_tmp, r_tmp, o_tmp
+
+    def _compute_grasp_evaluation_batch(self, contact_labels):
+        contacts = self._cluster_table.get_reprs(contact_labels)
+        s_tmp = self._hand_manifold.compute_grasp_quality_batch(self._obj_com, contacts)
+        code_tmp = self._hand_manifold.encode_grasp_batch(contacts)
+        r_tmp, dummy = self._hand_manifold.predict_hand_conf_batch(code_tmp)
+        o_tmp = s_tmp - self._reachability_weight * r_tmp
+        assert not np.isnan(o_tmp).any() and not np.isinf(o_tmp).any()
+        return s_tmp, r_tmp, -r_tmp
+
     def extend_hfts_node(self, old_labels, allowed_finger_combos=None):
         new_depth = len(old_labels[0])  # a label has length depth + 1
         if allowed_finger_combos is not None:
@@ -255,15 +576,7 @@ class HFTSSampler:
         return possible_num_children, possible_num_leaves
 
     def get_cluster_repr(self, label):
-        level = len(label) - 1 # indexed from 0
-        idx = np.where((self._data_labeled[:, 6:7 + level] == label).all(axis=1))
-        points = [self._data_labeled[t, 0:3] for t in idx][0]
-        normals = [self._data_labeled[t, 3:6] for t in idx][0]
-
-        pos = np.sum(points, axis=0) / len(idx[0])
-        normal = np.sum(normals, axis=0) / len(idx[0])
-        normal /= np.linalg.norm(normal)
-        return pos, -normal
+        return self._cluster_table.get_repr(label)
 
     def get_maximum_depth(self):
         return self._num_levels
@@ -297,6 +610,28 @@ class HFTSSampler:
                 labels_tmp.append(tmp)
         return labels_tmp
 
+    def get_random_sibling_labels_batch(self, curr_labels, num_samples, allowed_finger_combos=None):
+        """ Draws num_samples random sibling labels at once, see get_random_sibling_labels.
+            @return Integer array of shape (num_samples, num_contacts, depth)
+        """
+        curr_labels = np.asarray(curr_labels, dtype=int)
+        depth = curr_labels.shape[1]
+        labels_tmp = np.empty((num_samples, self._num_contacts, depth), dtype=int)
+        labels_tmp[:] = curr_labels
+        if allowed_finger_combos is None:
+            if depth <= self._hops / 2:
+                match_len = 0
+            else:
+                match_len = depth - self._hops / 2
+            for i in range(match_len, depth):
+                labels_tmp[:, :, i] = np.random.randint(self._branching_factors[i],
+                                                        size=(num_samples, self._num_contacts))
+        else:
+            finger_combos = np.asarray(allowed_finger_combos, dtype=int)
+            combo_idx = np.random.randint(len(finger_combos), size=num_samples)
+            labels_tmp[:, :, -1] = finger_combos[combo_idx]
+        return labels_tmp
+
     def get_real_contacts(self):
         collision_report = orpy.CollisionReport()
         real_contacts = []
@@ -310,7 +645,8 @@ class HFTSSampler:
             # TODO the normals reported by the collision check are wrong, so instead we use a nearest
             # TODO neighbor lookup. Should see what's wrong with OpenRAVE here...
             position = collision_report.contacts[0].pos
-            normal = self._object_points[self._object_kd_tree.query(position), 3:][1]
+            distance, point_idx = self._object_kd_tree.query(position)
+            normal = self._object_points[point_idx, 3:]
             # normal = collision_report.contacts[0].norm
             real_contacts.append(np.concatenate((position, normal)))
         real_contacts = np.asarray(real_contacts)
@@ -333,6 +669,8 @@ class HFTSSampler:
             # TODO make this Robotiq hand independent (external hand loader)
             self._robot = RobotiqHand(hand_cache_file=hand_cache_file,
                                       env=self._orEnv, hand_file=hand_file)
+            self._hand_file = hand_file
+            self._hand_cache_file = hand_cache_file
             self._hand_manifold = self._robot.get_hand_manifold()
             self._hand_manifold.load()
             self._num_contacts = self._robot.get_contact_number()
@@ -345,29 +683,337 @@ class HFTSSampler:
     def load_object(self, obj_id, model_id=None):
         if model_id is None:
             model_id = obj_id
-        self._data_labeled, self._branching_factors, self._obj_com = \
+        data_labeled, branching_factors, obj_com = \
             self._object_io_interface.get_hfts(model_id, self._b_force_new_hfts)
-        if self._data_labeled is None:
+        if data_labeled is None:
             raise RuntimeError('Could not load HFTS model for model ' + model_id)
-        self.create_object_kd_tree(self._data_labeled[:, :6])
-        self._num_levels = len(self._branching_factors)
-        # First, delete old object if there is any
+        self._set_object(obj_id, model_id, data_labeled, branching_factors, obj_com)
+
+    def _set_object(self, obj_id, model_id, data_labeled, branching_factors, obj_com):
+        # memoized grasp evaluations are only valid for the object they were computed on
+        self._grasp_evaluation_cache.clear()
+        if self._object_data is not None:
+            self._save_grasp_simulations(self._object_data)
+        # First, deactivate the old object if there is any. It stays in the environment as long as it is cached.
         if self._obj_loaded:
-            self._orEnv.Remove(self._obj)
-        or_file_name = self._object_io_interface.get_openrave_file_name(model_id)
-        self._obj_loaded = self._orEnv.Load(or_file_name)
-        if not self._obj_loaded:
-            raise RuntimeError('Could not load object model %s in OpenRAVE' % model_id)
-        self._obj = self._orEnv.GetKinBody('objectModel')
-        rospy.loginfo('Object loaded in OpenRAVE environment')
+            self._obj.Enable(False)
+            self._obj.SetVisible(False)
+            self._obj_loaded = False
+        object_data = self._object_cache.get(model_id)
+        if object_data is not None and object_data.data_labeled is not data_labeled:
+            # the object's hfts changed since we cached it
+            self._object_cache.remove(model_id)
+            object_data = None
+        if object_data is None:
+            object_data = self._create_object_data(model_id, data_labeled, branching_factors, obj_com)
+            self._object_cache.put(model_id, object_data, size=object_data.get_memory_size())
+        else:
+            rospy.loginfo('Object %s loaded from cache' % model_id)
+        self._model_id = model_id
+        self._object_data = object_data
+        self._data_labeled = object_data.data_labeled
+        self._branching_factors = object_data.branching_factors
+        self._obj_com = object_data.obj_com
+        self._object_kd_tree = object_data.kd_tree
+        self._object_points = self._data_labeled[:, :6]
+        self._num_levels = len(self._branching_factors)
+        self._cluster_table = object_data.cluster_table
+        self._obj = object_data.kinbody
+        self._obj.Enable(True)
+        self._obj.SetVisible(True)
         if self._scene_interface is not None:
             self._scene_interface.set_target_object(obj_id)
         self.compute_contact_combinations()
         self._obj_loaded = True
-        import IPython
-        IPython.embed()
 
-    def sample_grasp(self, node, depth_limit, post_opt=False, label_cache=None, open_hand_offset=0.1):
+    def _create_object_data(self, model_id, data_labeled, branching_factors, obj_com):
+        kd_tree = load_or_build_index(data_labeled[:, :3], self._object_io_interface.get_index_cache_prefix(model_id),
+                                      **self._object_index_params)
+        cluster_table = HFTSClusterTable(data_labeled, branching_factors)
+        or_file_name = self._object_io_interface.get_openrave_file_name(model_id)
+        # Cached objects remain in the environment, hence every object needs a unique name
+        if or_file_name is None:
+            # objects given as point clouds have no model file, so we represent them by their convex hull
+            kinbody = self._create_convex_hull_kinbody(data_labeled[:, :3], 'objectModel_' + model_id)
+        else:
+            if not self._orEnv.Load(or_file_name):
+                raise RuntimeError('Could not load object model %s in OpenRAVE' % model_id)
+            kinbody = self._orEnv.GetKinBody('objectModel')
+            kinbody.SetName('objectModel_' + model_id)
+        rospy.loginfo('Object loaded in OpenRAVE environment')
+        object_data = HFTSObjectData(model_id, data_labeled, branching_factors, obj_com, kd_tree, cluster_table,
+                                     kinbody)
+        self._load_grasp_simulations(object_data)
+        return object_data
+
+    def _create_convex_hull_kinbody(self, points, name):
+        hull = ConvexHull(points)
+        kinbody = orpy.RaveCreateKinBody(self._orEnv, '')
+        kinbody.SetName(name)
+        kinbody.InitFromTrimesh(orpy.TriMesh(hull.points[hull.vertices], np.searchsorted(hull.vertices,
+                                                                                           hull.simplices)), True)
+        self._orEnv.Add(kinbody)
+        return kinbody
+
+    def _release_object(self, model_id, object_data):
+        # called by the object cache whenever an object is evicted
+        self._save_grasp_simulations(object_data)
+        if object_data is self._object_data:
+            self._object_data = None
+        self._orEnv.Remove(object_data.kinbody)
+        if object_data.kinbody is self._obj:
+            self._obj = None
+            self._obj_loaded = False
+
+    def _compute_grasp_simulations_fingerprint(self, object_data):
+        # Simulation results are only valid for the hfts and hand they were computed with
+        hasher = hashlib.sha1(np.ascontiguousarray(object_data.data_labeled, dtype=float))
+        hasher.update(str((GRASP_SIMULATION_FILE_VERSION, self._hand_file, self._hand_cache_file)).encode('utf-8'))
+        return hasher.hexdigest()
+
+    def _load_grasp_simulations(self, object_data):
+        file_name = self._object_io_interface.get_grasp_simulations_file_name(object_data.model_id)
+        if not self._b_persist_grasp_simulations or file_name is None or not os.path.isfile(file_name):
+            return
+        try:
+            with open(file_name, 'rb') as input_file:
+                fingerprint, entries = pickle.load(input_file)
+        except Exception as e:
+            rospy.logwarn('[HFTSSampler::_load_grasp_simulations] Could not read %s: %s' % (file_name, str(e)))
+            return
+        if fingerprint != self._compute_grasp_simulations_fingerprint(object_data):
+            rospy.loginfo('[HFTSSampler::_load_grasp_simulations] Grasp simulations in %s are outdated' % file_name)
+            return
+        for key, value in entries:
+            object_data.add_grasp_simulation(key, value)
+
+    def _save_grasp_simulations(self, object_data):
+        file_name = self._object_io_interface.get_grasp_simulations_file_name(object_data.model_id)
+        if not self._b_persist_grasp_simulations or file_name is None or not object_data.b_grasp_simulations_changed:
+            return
+        entries = object_data.grasp_simulations.items()
+        tmp_file_name = file_name + '.tmp%i' % os.getpid()
+        try:
+            with open(tmp_file_name, 'wb') as output_file:
+                pickle.dump((self._compute_grasp_simulations_fingerprint(object_data), entries), output_file,
+                            pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_file_name, file_name)
+            object_data.b_grasp_simulations_changed = False
+        except (IOError, OSError) as e:
+            rospy.logwarn('[HFTSSampler::_save_grasp_simulations] Could not write %s: %s' % (file_name, str(e)))
+
+    def save_grasp_simulations(self):
+        """ Persists the grasp simulation results of the current object, if persistence is enabled
+            (see set_parameters). Results of other objects are persisted when switching objects.
+        """
+        if self._object_data is not None:
+            self._save_grasp_simulations(self._object_data)
+
+    def get_grasp_simulation_stats(self):
+        """ Returns statistics of the grasp simulation results of the current object,
+            see utils.LRUCache.get_stats.
+        """
+        if self._object_data is None:
+            return None
+        return self._object_data.grasp_simulations.get_stats()
+
+    def get_object_transform(self):
+        """ Returns the pose of the current object in the environment grasps are planned in, i.e. the frame of
+            the hand transforms of sampled nodes.
+        """
+        if not self._obj_loaded:
+            raise RuntimeError('[HFTSSampler::get_object_transform] No object loaded')
+        return self._obj.GetTransform()
+
+    def get_object_cache_stats(self):
+        """ Returns statistics of the cache of per-object data, see utils.LRUCache.get_stats. """
+        return self._object_cache.get_stats()
+
+    def get_grasp_evaluation_stats(self):
+        """ Returns statistics of the memo of grasp evaluations (see utils.LRUCache.get_stats)
+            including the hit rate.
+        """
+        stats = self._grasp_evaluation_cache.get_stats()
+        num_lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = float(stats['hits']) / num_lookups if num_lookups > 0 else 0.0
+        return stats
+
+    def sample_grasps(self, node, depth_limit, num_samples, num_workers=1, mode='first', post_opt=False):
+        """ Runs up to num_samples independent stochastic hill climbing chains from node, see sample_grasp.
+            @param node - the node to start from
+            @param depth_limit - see sample_grasp
+            @param num_samples - maximal number of chains
+            @param num_workers - number of processes to run chains in. Each process has its own sampler with its
+                own OpenRAVE environment and hand, see start_worker_pool. If no pool is running, one with
+                num_workers processes is started. At most as many processes as the pool has are used.
+                Arm reachability checks require the scene of this process, so if there is a scene interface,
+                all chains are run in this process.
+            @param mode - 'first': stop all chains as soon as a goal is found and return it
+                          'best': run all chains and return the goal of the highest quality
+            @param post_opt - see sample_grasp
+            @return the selected node. If no goal was found, the sample of highest quality is returned
+                (None if num_samples is 0).
+        """
+        if mode not in self.SAMPLE_MODES:
+            raise ValueError('[HFTSSampler::sample_grasps] Unknown mode %s. Supported are %s' %
+                             (str(mode), str(self.SAMPLE_MODES)))
+        b_first = mode == 'first'
+        if num_workers > 1 and num_samples > 1 and self._scene_interface is None:
+            results = self._sample_grasps_parallel(node, depth_limit, num_samples, num_workers, b_first, post_opt)
+        else:
+            results = []
+            while len(results) < num_samples and not rospy.is_shutdown():
+                results.append(self.sample_grasp(node, depth_limit, post_opt=post_opt))
+                if b_first and results[-1].is_goal():
+                    break
+        goals = [result for result in results if result.is_goal()]
+        if b_first and len(goals) > 0:
+            return goals[0]
+        candidates = goals if len(goals) > 0 else results
+        if len(candidates) == 0:
+            return None
+        return max(candidates, key=lambda result: result.get_quality())
+
+    def generate_grasps_anytime(self, node, depth_limit, deadline, post_opt=False):
+        """ Generator that repeatedly samples grasps from node (see sample_grasp) until deadline and yields
+            every valid grasp that is better than all grasps yielded before. A chain that is running when the
+            deadline is reached is aborted.
+            @param node - the node to start from
+            @param depth_limit - see sample_grasp
+            @param deadline - time (as returned by time.time()) at which sampling stops
+            @param post_opt - see sample_grasp
+        """
+        best_quality = -np.inf
+        for result in self.iter_grasps(node, depth_limit, filters=[valid_filter], deadline=deadline,
+                                       post_opt=post_opt):
+            if result.get_quality() > best_quality:
+                best_quality = result.get_quality()
+                yield result
+
+    def sample_grasps_anytime(self, node, depth_limit, time_budget, num_best=DEFAULT_NUM_BEST_GRASPS,
+                              post_opt=False, callback=None):
+        """ Samples grasps from node until time_budget is used up and returns the best valid grasps found.
+            @param node - the node to start from
+            @param depth_limit - see sample_grasp
+            @param time_budget - time in seconds
+            @param num_best - maximal number of grasps to return
+            @param post_opt - see sample_grasp
+            @param callback - (optional) function that is called with every grasp that is better than all
+                grasps found before, as soon as it is found
+            @return list of at most num_best valid grasps, sorted by quality (best first)
+        """
+        deadline = time.time() + time_budget
+        # min-heap of (quality, index, node), so that the worst of the best grasps is replaced first
+        ranked_grasps = []
+        best_quality = -np.inf
+        valid_grasps = self.iter_grasps(node, depth_limit, filters=[valid_filter], deadline=deadline,
+                                        post_opt=post_opt)
+        for index, result in enumerate(valid_grasps):
+            entry = (result.get_quality(), index, result)
+            if len(ranked_grasps) < num_best:
+                heapq.heappush(ranked_grasps, entry)
+            elif entry[0] > ranked_grasps[0][0]:
+                heapq.heapreplace(ranked_grasps, entry)
+            if entry[0] > best_quality:
+                best_quality = entry[0]
+                if callback is not None:
+                    callback(result)
+        return [entry[2] for entry in sorted(ranked_grasps, reverse=True)]
+
+    def iter_grasps(self, node, depth_limit, filters=None, max_samples=None, deadline=None, post_opt=False,
+                    open_hand_offset=0.1):
+        """ Generator that lazily samples grasps from node (see sample_grasp) and yields every goal that
+            passes all filters. Every leaf (i.e. label) is yielded at most once.
+            @param node - the node to start from
+            @param depth_limit - see sample_grasp
+            @param filters - (optional) list of functions that map an HFTSNode to a bool, see e.g.
+                min_quality_filter. Filters are applied in the given order and a grasp is rejected by the first
+                filter it fails, so cheap filters should come first.
+            @param max_samples - (optional) maximal number of grasps to sample (None for no limit)
+            @param deadline - (optional) time (as returned by time.time()) at which sampling stops. No grasp is
+                yielded after the deadline.
+            @param post_opt - see sample_grasp
+            @param open_hand_offset - see sample_grasp
+        """
+        if filters is None:
+            filters = []
+        sampled_labels = set()
+        num_samples = 0
+        while (max_samples is None or num_samples < max_samples) and not rospy.is_shutdown():
+            if deadline is not None and time.time() >= deadline:
+                break
+            result = self.sample_grasp(node, depth_limit, post_opt=post_opt, open_hand_offset=open_hand_offset,
+                                       deadline=deadline)
+            num_samples += 1
+            if not result.is_goal():
+                continue
+            label = result.get_unique_label()
+            if label in sampled_labels:
+                continue
+            sampled_labels.add(label)
+            if all(grasp_filter(result) for grasp_filter in filters):
+                # grasps that were completed (or filtered) after the deadline are dropped
+                if deadline is not None and time.time() > deadline:
+                    break
+                yield result
+
+    def _sample_grasps_parallel(self, node, depth_limit, num_samples, num_workers, b_first, post_opt):
+        if not self._obj_loaded:
+            raise RuntimeError('[HFTSSampler::sample_grasps] No object loaded')
+        if not self._hand_loaded:
+            raise RuntimeError('[HFTSSampler::sample_grasps] No hand loaded')
+        if self._worker_pool is None:
+            self.start_worker_pool(num_workers)
+        # the pool keeps its size, so only the number of tasks depends on the request
+        num_tasks = min(num_workers, self._num_pool_workers, num_samples)
+        self._worker_stop_event.clear()
+        # workers load the object from the data base themselves and only if its hfts changed
+        object_key = (self._model_id, self._object_data.get_checksum())
+        parameters = dict((name, value) for name, value in self._parameters.items()
+                          if name in WORKER_PARAMETER_NAMES)
+        tasks = []
+        for task in range(num_tasks):
+            # distribute the chains as evenly as possible
+            task_num_samples = num_samples / num_tasks + (1 if task < num_samples % num_tasks else 0)
+            tasks.append((object_key, parameters, node, depth_limit, task_num_samples, b_first, post_opt,
+                          np.random.randint(2 ** 31 - 1)))
+        worker_results = self._worker_pool.map(_sample_grasps_worker, tasks, chunksize=1)
+        # the simulations of the workers are kept (and persisted) by this sampler's per-object cache
+        new_simulations = [entry for results, simulations in worker_results for entry in simulations
+                           if entry[0] not in self._object_data.grasp_simulations]
+        for key, value in new_simulations:
+            self._object_data.add_grasp_simulation(key, value)
+        if len(new_simulations) > 0:
+            self._object_data.b_grasp_simulations_changed = True
+            self._object_cache.update_size(self._model_id, self._object_data.get_memory_size())
+        return list(itertools.chain.from_iterable(results for results, simulations in worker_results))
+
+    def start_worker_pool(self, num_workers):
+        """ Starts num_workers processes for sample_grasps, each with its own sampler, OpenRAVE environment
+            and hand, so that none of them needs to be set up when sampling. A running pool is replaced,
+            if it has a different number of processes. The hand must be loaded.
+        """
+        if not self._hand_loaded:
+            raise RuntimeError('[HFTSSampler::start_worker_pool] No hand loaded')
+        if self._worker_pool is not None and self._num_pool_workers == num_workers:
+            return
+        self.close_worker_pool()
+        self._worker_stop_event = multiprocessing.Event()
+        self._worker_pool = multiprocessing.Pool(num_workers, initializer=_init_sampler_worker,
+                                                 initargs=(self._object_io_interface, self._hops, self._hand_file,
+                                                           self._hand_cache_file, self._worker_stop_event))
+        self._num_pool_workers = num_workers
+
+    def close_worker_pool(self):
+        """ Terminates the worker processes of sample_grasps, if there are any. """
+        if self._worker_pool is not None:
+            self._worker_pool.terminate()
+            self._worker_pool.join()
+            self._worker_pool = None
+            self._num_pool_workers = 0
+
+    def sample_grasp(self, node, depth_limit, post_opt=False, label_cache=None, open_hand_offset=0.1,
+                     stop_event=None, deadline=None):
         if depth_limit < 0:
             raise ValueError('HFTSSampler::sample_grasp depth limit must be greater or equal to zero.')
 
@@ -408,29 +1054,45 @@ class HFTSSampler:
         rospy.logdebug('[HFTSSampler::sample_grasp] Sampling a grasp; %i number of iterations' % self._max_iters)
         # Do stochastic optimization until depth_limit is reached
         while depth_limit >= 0:
+            # Another chain found a goal already (see sample_grasps)
+            if stop_event is not None and stop_event.is_set():
+                return node
+            # The time for sampling is up (see sample_grasps_anytime)
+            if deadline is not None and time.time() > deadline:
+                return node
             # Randomly select siblings to optimize the objective function
-            for iter_now in range(self._max_iters):
-                labels_tmp = self.get_random_sibling_labels(curr_labels=contact_label,
-                                                            allowed_finger_combos=allowed_finger_combos)
-                s_tmp, r_tmp, o_tmp = self.evaluate_grasp(labels_tmp)
-                if self.shc_evaluation(o_tmp, best_o):
-                    contact_label = labels_tmp
-                    best_o = o_tmp
-                    # self._debug_visualize(labels_tmp, handle_index=0)
+            if self._b_batch_shc:
+                # All siblings share the same ancestors, so we can draw and evaluate all of them at once
+                # and accept the best one.
+                labels_batch = self.get_random_sibling_labels_batch(curr_labels=contact_label,
+                                                                    num_samples=self._max_iters,
+                                                                    allowed_finger_combos=allowed_finger_combos)
+                s_batch, r_batch, o_batch = self.evaluate_grasp_batch(labels_batch)
+                best_idx = np.argmax(o_batch)
+                if self.shc_evaluation(o_batch[best_idx], best_o):
+                    contact_label = labels_batch[best_idx].tolist()
+                    best_o = o_batch[best_idx]
+            else:
+                for iter_now in range(self._max_iters):
+                    labels_tmp = self.get_random_sibling_labels(curr_labels=contact_label,
+                                                                allowed_finger_combos=allowed_finger_combos)
+                    s_tmp, r_tmp, o_tmp = self.evaluate_grasp(labels_tmp)
+                    if self.shc_evaluation(o_tmp, best_o):
+                        contact_label = labels_tmp
+                        best_o = o_tmp
+                        # self._debug_visualize(labels_tmp, handle_index=0)
             # Descend to next level if we iterate at least once more
             if depth_limit > 0:
                 best_o, contact_label = self.extend_hfts_node(contact_label)
             depth_limit -= 1
 
+        # Do not start simulating the grasp if it is not expected to finish before the deadline
+        if deadline is not None and time.time() + self._grasp_check_time > deadline:
+            return node
+        grasp_check_start_time = time.time()
         # Evaluate grasp on robot hand
-        # First, determine a hand configuration and the contact locations
-        grasp_conf, object_contacts, hand_contacts = self.compose_grasp_info(contact_label)
-        # Simulate the grasp and do local adjustments
-        b_robotiq_ok, grasp_conf, grasp_pose = self.simulate_grasp(grasp_conf=grasp_conf,
-                                                                   hand_contacts=hand_contacts,
-                                                                   object_contacts=object_contacts,
-                                                                   post_opt=post_opt,
-                                                                   swap_contacts=label_cache is None)
+        b_robotiq_ok, grasp_conf, grasp_pose = self._simulate_leaf_grasp(contact_label, post_opt=post_opt,
+                                                                         swap_contacts=label_cache is None)
         if b_robotiq_ok:
             sample_q = 0
             stability = best_o
@@ -467,13 +1129,17 @@ class HFTSSampler:
             arm_conf = None
             pre_grasp_conf = None
 
+        self._grasp_check_time = 0.5 * (self._grasp_check_time + time.time() - grasp_check_start_time)
+        # The grasp was completed after the deadline
+        if deadline is not None and time.time() > deadline:
+            return node
         depth = len(contact_label[0])
         possible_num_children, possible_num_leaves = self.get_branch_information(depth)
         return HFTSNode(labels=contact_label, hand_conf=np.asarray(grasp_conf),
                         pre_grasp_conf=pre_grasp_conf, arm_conf=arm_conf,
                         is_goal=is_goal_sample, is_leaf=is_leaf, is_valid=collision_free_arm_ik,
                         num_possible_children=possible_num_children, num_possible_leaves=possible_num_leaves,
-                        hand_transform=self._robot.GetTransform())
+                        hand_transform=self._robot.GetTransform(), quality=stability)
 
     def set_max_iter(self, m):
         assert m > 0
@@ -481,16 +1147,57 @@ class HFTSSampler:
 
     def set_parameters(self, max_iters=None, reachability_weight=None,
                        com_center_weight=None, hfts_generation_params=None,
-                       b_force_new_hfts=None):
+                       b_force_new_hfts=None, b_batch_shc=None,
+                       object_index_params=None, hand_index_params=None, object_cache_size=None,
+                       grasp_evaluation_cache_size=None, b_persist_grasp_simulations=None):
         # TODO some of these parameters are Robotiq hand specific. We probably wanna pass them as dictionary
+        parameters = {'max_iters': max_iters, 'reachability_weight': reachability_weight,
+                      'com_center_weight': com_center_weight, 'hfts_generation_params': hfts_generation_params,
+                      'b_force_new_hfts': b_force_new_hfts, 'b_batch_shc': b_batch_shc,
+                      'object_index_params': object_index_params, 'hand_index_params': hand_index_params,
+                      'object_cache_size': object_cache_size,
+                      'grasp_evaluation_cache_size': grasp_evaluation_cache_size,
+                      'b_persist_grasp_simulations': b_persist_grasp_simulations}
+        self._parameters = dict(self._parameters)
+        self._parameters.update((name, value) for name, value in parameters.items() if value is not None)
+        # memoized grasp evaluations depend on the weights of the objective and the hand manifold
+        if (reachability_weight is not None and reachability_weight != self._reachability_weight) or \
+                (com_center_weight is not None and com_center_weight != self._com_center_weight) or \
+                hand_index_params is not None:
+            self._grasp_evaluation_cache.clear()
+        if com_center_weight is not None:
+            self._com_center_weight = com_center_weight
+        if grasp_evaluation_cache_size is not None:
+            self._grasp_evaluation_cache.set_max_size(grasp_evaluation_cache_size)
+        if b_persist_grasp_simulations is not None:
+            # see ObjectIO.get_grasp_simulations_file_name
+            self._b_persist_grasp_simulations = b_persist_grasp_simulations
         if max_iters is not None:
             self._max_iters = max_iters
             assert self._max_iters > 0
+        if b_batch_shc is not None:
+            self._b_batch_shc = b_batch_shc
         if reachability_weight is not None:
             self._reachability_weight = reachability_weight
             assert self._reachability_weight >= 0.0
+        if object_index_params is not None:
+            # see spatial_index.SpatialIndex for available parameters
+            self._object_index_params = object_index_params
+            # indices of cached objects were built with the old parameters, so only keep the current object
+            for model_id in self._object_cache.keys():
+                if model_id != self._model_id:
+                    self._object_cache.remove(model_id)
+            if self._obj_loaded:
+                self.create_object_kd_tree(self._object_points,
+                                           self._object_io_interface.get_index_cache_prefix(self._model_id))
+                self._object_data.kd_tree = self._object_kd_tree
+                self._object_cache.update_size(self._model_id, self._object_data.get_memory_size())
+        if object_cache_size is not None:
+            self._object_cache.set_max_size(object_cache_size)
         # TODO this is Robotiq hand specific, and outdated
         self._hand_manifold.set_parameters(com_center_weight)
+        if hand_index_params is not None:
+            self._hand_manifold.set_parameters(index_params=hand_index_params)
         if hfts_generation_params is not None:
             self._object_io_interface.set_hfts_generation_parameters(hfts_generation_params)
         if b_force_new_hfts is not None:
@@ -520,6 +1227,43 @@ class HFTSSampler:
             return True, self._robot.GetDOFValues(), self._robot.GetTransform()
         return False, self._robot.GetDOFValues(), self._robot.GetTransform()
 
+    def _simulate_leaf_grasp(self, contact_label, post_opt, swap_contacts):
+        """ Determines a hand configuration and the contact locations for the given labels and simulates
+            the grasp (see simulate_grasp). The simulation only involves the hand and the object, so the results
+            for leaves are cached per object. On a cache hit, the hand is set to the cached configuration and pose.
+        """
+        b_leaf = len(contact_label[0]) == self._num_levels and self._object_data is not None
+        if b_leaf:
+            key = (tuple(int(c) for c in itertools.chain.from_iterable(contact_label)), post_opt, swap_contacts)
+            result = self._object_data.grasp_simulations.get(key)
+            if result is not None:
+                b_grasp_valid, grasp_conf, object_grasp_pose = result
+                self._robot.SetDOFValues(grasp_conf)
+                if object_grasp_pose is None:
+                    return b_grasp_valid, np.array(grasp_conf), None
+                grasp_pose = np.dot(self._obj.GetTransform(), object_grasp_pose)
+                self._robot.SetTransform(grasp_pose)
+                return b_grasp_valid, np.array(grasp_conf), grasp_pose
+        grasp_conf, object_contacts, hand_contacts = self.compose_grasp_info(contact_label)
+        # Simulate the grasp and do local adjustments
+        b_grasp_valid, grasp_conf, grasp_pose = self.simulate_grasp(grasp_conf=grasp_conf,
+                                                                    hand_contacts=hand_contacts,
+                                                                    object_contacts=object_contacts,
+                                                                    post_opt=post_opt,
+                                                                    swap_contacts=swap_contacts)
+        if b_leaf:
+            # store the pose in the object frame
+            object_grasp_pose = None
+            if grasp_pose is not None:
+                object_grasp_pose = np.dot(np.linalg.inv(self._obj.GetTransform()), grasp_pose)
+            simulation = (b_grasp_valid, np.array(grasp_conf), object_grasp_pose)
+            self._object_data.add_grasp_simulation(key, simulation)
+            self._object_data.b_grasp_simulations_changed = True
+            if self._new_grasp_simulations is not None:
+                self._new_grasp_simulations.append((key, simulation))
+            self._object_cache.update_size(self._model_id, self._object_data.get_memory_size())
+        return b_grasp_valid, grasp_conf, grasp_pose
+
     def simulate_grasp(self, grasp_conf, hand_contacts, object_contacts, post_opt=False, swap_contacts=True):
         # TODO this method as it is right now is only useful for the Robotiq hand.
         b_grasp_valid, grasp_conf, grasp_pose = self._simulate_grasp(grasp_conf, hand_contacts, object_contacts, post_opt)
@@ -557,11 +1301,7 @@ class HFTSSampler:
         self.cloud_plot = []
         colors = [np.array((1,0,0)), np.array((0,1,0)), np.array((0,0,1))]
         for i in range(3):
-            label = contact_labels[i]
-            level = len(label) - 1 # indexed from 0
-            idx = np.where((self._data_labeled[:, 6:7 + level] == label).all(axis=1))
-            points = [self._data_labeled[t, 0:3] for t in idx][0]
-            points = np.asarray(points)
+            points = self._cluster_table.get_points(contact_labels[i])[:, 0:3]
             self.cloud_plot.append(self._orEnv.plot3(points=points, pointsize=0.006, colors=colors[i], drawstyle=1))
 
     def _post_optimization(self, grasp_contacts):
@@ -623,6 +1363,48 @@ class HFTSSampler:
         return pos_err + normal_err
 
 
+def valid_filter(node):
+    """ Grasp filter (see HFTSSampler.iter_grasps) that accepts grasps whose arm configuration is
+        collision-free, or that are not checked for an arm at all (no scene interface).
+    """
+    return node.is_valid()
+
+
+def ik_feasible_filter(node):
+    """ Grasp filter (see HFTSSampler.iter_grasps) that accepts only grasps with a collision-free
+        arm configuration. This requires the sampler to have a scene interface.
+    """
+    return node.is_valid() and node.get_arm_configuration() is not None
+
+
+def min_quality_filter(min_quality):
+    """ Returns a grasp filter (see HFTSSampler.iter_grasps) that accepts grasps with a quality of
+        at least min_quality.
+    """
+    return lambda node: node.get_quality() >= min_quality
+
+
+def approach_direction_filter(direction, max_angle, object_transform, approach_axis=2):
+    """ Returns a grasp filter (see HFTSSampler.iter_grasps) that accepts grasps whose approach direction
+        deviates by at most max_angle from direction.
+        @param direction - desired approach direction in the object frame
+        @param max_angle - maximal angle in radians
+        @param object_transform - pose of the object in the frame of the hand transforms of the sampled nodes,
+            see HFTSSampler.get_object_transform
+        @param approach_axis - axis of the hand frame that points towards the object (0 = x, 1 = y, 2 = z)
+    """
+    direction = np.asarray(direction, dtype=float)
+    direction = direction / np.linalg.norm(direction)
+    # the hand transforms of nodes are in the world frame, so rotate the direction into it
+    direction = np.dot(np.asarray(object_transform)[:3, :3], direction)
+    min_cos = math.cos(max_angle)
+
+    def accept(node):
+        approach = node.get_hand_transform()[:3, approach_axis]
+        return np.dot(approach, direction) >= min_cos * np.linalg.norm(approach)
+    return accept
+
+
 class HFTSNode:
     def __init__(self, labels=None, hand_conf=None, hand_transform=None,
                  pre_grasp_conf=None, arm_conf=None, is_leaf=False, is_valid=False, is_goal=False,
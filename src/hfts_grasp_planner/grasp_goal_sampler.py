@@ -52,6 +52,20 @@ class GraspGoalSampler:
                                                        post_opt=post_opt,
                                                        label_cache=label_cache,
                                                        open_hand_offset=self.open_hand_offset)
+        return self._create_sampling_result(sampled_node)
+
+    def iter_samples(self, depth_limit, filters=None, max_samples=None, post_opt=True):
+        """ Generator that lazily yields goal grasps from the root level on, see HFTSSampler.iter_grasps.
+            @param depth_limit Maximal depth to descend in the hierarchy
+            @param filters (optional) List of grasp filters, e.g. core.ik_feasible_filter
+            @param max_samples (optional) Maximal number of grasps to sample
+        """
+        for sampled_node in self.grasp_planner.iter_grasps(self.root_node, depth_limit, filters=filters,
+                                                           max_samples=max_samples, post_opt=post_opt,
+                                                           open_hand_offset=self.open_hand_offset):
+            yield self._create_sampling_result(sampled_node)
+
+    def _create_sampling_result(self, sampled_node):
         config = sampled_node.get_arm_configuration()
         if config is not None:
             config = numpy.concatenate((config, sampled_node.get_pre_grasp_config()))
@@ -1,16 +1,28 @@
-import itertools
 import stl as stl_mesh_module
 import numpy as np
 import rospy
 import sklearn.neighbors
 import sklearn.cluster
+import itertools
 import math
+import multiprocessing
+import threading
 import time
+from multiprocessing.pool import ThreadPool
 from external.plyfile import PlyData
+from spatial_index import SpatialIndex
+
+# Number of points filter_unsmooth_points processes at once
+FILTER_CHUNK_SIZE = 4096
+# Minimal number of points for which filter_unsmooth_points distributes its work on multiple processes
+PARALLEL_FILTER_MIN_POINTS = 200000
+# Number of neighbors estimate_normals fits a plane to
+DEFAULT_NORMAL_NUM_NEIGHBORS = 16
 
 
 def sample_face(v0, v1, v2, normal, density):
     """ Samples the face of a triangle face uniformly.
+        This is the per-face reference implementation of sample_faces(..., method='slices').
         :param v0 - vertex 0 of the triangle
         :param v1 - vertex 1 of the triangle
         :param v2 - vertex 2 of the triangle
@@ -54,101 +66,414 @@ def sample_face(v0, v1, v2, normal, density):
     return points
 
 
-def create_contact_points_from_stl(file_name, density=300):
+def _repeat_ranges(counts):
+    """ For an array of counts [n_0, n_1, ...] returns the group index and the index within the group
+        of every element of the concatenation of the ranges [0, n_0), [0, n_1), ...
+    """
+    counts = np.asarray(counts, dtype=int)
+    group_idx = np.repeat(np.arange(len(counts)), counts)
+    starts = np.cumsum(counts) - counts
+    return group_idx, np.arange(len(group_idx)) - starts[group_idx]
+
+
+def sample_faces(v0, v1, v2, normals, density, method='slices', seed=None, vertex_normals=None):
+    """ Samples all faces of a triangle mesh at once.
+        :param v0 - (n, 3) array of the first vertices of the triangles
+        :param v1 - (n, 3) array of the second vertices of the triangles
+        :param v2 - (n, 3) array of the third vertices of the triangles
+        :param normals - (n, 3) array of the normals of the triangles (may be None if vertex_normals are given)
+        :param density - sample density in points/meter
+        :param method - 'slices': Every face is cut into slices parallel to its longest edge, which are sampled
+                            at equal distances. The result is the same (up to floating point rounding) as
+                            calling sample_face for each face.
+                        'random': Every face is sampled uniformly at random, on average with area * density^2
+                            points.
+        :param seed - (optional) seed for method 'random'
+        :param vertex_normals - (optional) tuple (n0, n1, n2) of (n, 3) arrays of the normals at the vertices.
+            If provided, the normal of each point is interpolated from these instead of using the face normal.
+        :return (m, 6) array of points [position, normal], ordered by faces
+    """
+    v0, v1, v2 = np.asarray(v0), np.asarray(v1), np.asarray(v2)
+    if method == 'slices':
+        positions, face_idx, weights = _sample_faces_slices(v0, v1, v2, density)
+    elif method == 'random':
+        positions, face_idx, weights = _sample_faces_random(v0, v1, v2, density, np.random.RandomState(seed))
+    else:
+        raise ValueError('[hfts_generation::sample_faces] Unknown sampling method ' + str(method))
+    if vertex_normals is None:
+        point_normals = np.asarray(normals)[face_idx]
+    else:
+        point_normals = sum(weights[:, i, np.newaxis] * np.asarray(vertex_normals[i])[face_idx] for i in range(3))
+        normal_lengths = np.linalg.norm(point_normals, axis=1)
+        b_valid = normal_lengths > 0.0
+        point_normals[b_valid] /= normal_lengths[b_valid, np.newaxis]
+    return np.concatenate((positions, point_normals.astype(positions.dtype)), axis=1)
+
+
+def _sample_faces_slices(v0, v1, v2, density):
+    """ Returns positions, face indices and barycentric coordinates of the samples of all faces. """
+    # This mirrors sample_face step by step (including its floating point operations and types),
+    # so that the results are the same.
+    def compute_edges(v0, v1, v2):
+        a, b, c = v2 - v0, v2 - v1, v1 - v0
+        return a, b, c, np.linalg.norm(a, axis=1), np.linalg.norm(b, axis=1), np.linalg.norm(c, axis=1)
+    a, b, c, a_length, b_length, c_length = compute_edges(v0, v1, v2)
+    # We want c to be the longest edge, so rotate the triangles through until this is true.
+    # vertex_order keeps track of the original index of each vertex.
+    vertex_order = np.tile(np.arange(3), (len(v0), 1))
+    for i in range(2):
+        b_rotate_left = c_length < b_length
+        b_rotate_right = np.logical_and(np.logical_not(b_rotate_left), c_length < a_length)
+        left, right = b_rotate_left[:, np.newaxis], b_rotate_right[:, np.newaxis]
+        v0, v1, v2 = np.where(left, v1, np.where(right, v2, v0)), np.where(left, v2, np.where(right, v0, v1)), \
+            np.where(left, v0, np.where(right, v1, v2))
+        vertex_order = np.where(left, vertex_order[:, [1, 2, 0]], np.where(right, vertex_order[:, [2, 0, 1]],
+                                                                             vertex_order))
+        a, b, c, a_length, b_length, c_length = compute_edges(v0, v1, v2)
+    assert np.all(c_length >= b_length) and np.all(c_length >= a_length)
+    dtype = v0.dtype
+    c_normalized = c / c_length[:, np.newaxis]
+    h = a - np.sum(a * c_normalized, axis=1)[:, np.newaxis] * a
+    height = np.linalg.norm(h, axis=1)
+    number_height_slices = (height * density).astype(int)
+    # Slices of all faces: face index and slice index j within the face
+    slice_face_idx, slice_idx = _repeat_ranges(number_height_slices)
+    t = (slice_idx.astype(float) / number_height_slices[slice_face_idx]).astype(dtype)[:, np.newaxis]
+    slice_start = v0[slice_face_idx] + t * a[slice_face_idx]
+    c_shortened = (v1[slice_face_idx] + t * b[slice_face_idx]) - slice_start
+    slice_width = np.linalg.norm(c_shortened, axis=1)
+    number_points = (slice_width * density).astype(int)
+    # Points of all slices: slice index and point index i within the slice
+    point_slice_idx, point_idx = _repeat_ranges(number_points)
+    s = (point_idx.astype(float) / number_points[point_slice_idx]).astype(dtype)[:, np.newaxis]
+    positions = slice_start[point_slice_idx] + s * c_shortened[point_slice_idx]
+    point_face_idx = slice_face_idx[point_slice_idx]
+    # The position of a point is v0 + t * a + s * (1 - t) * c
+    point_t = t[point_slice_idx]
+    point_weights = np.concatenate(((1.0 - s) * (1.0 - point_t), s * (1.0 - point_t), point_t), axis=1)
+    # In case a triangle is really small, we just add the center of the face
+    small_face_idx = np.where(number_height_slices == 0)[0]
+    centers = (v0[small_face_idx] + v1[small_face_idx] + v2[small_face_idx]) / 3.0
+    positions = np.concatenate((positions, centers))
+    face_idx = np.concatenate((point_face_idx, small_face_idx))
+    rotated_weights = np.concatenate((point_weights, np.full((len(small_face_idx), 3), 1.0 / 3.0)))
+    order = np.argsort(face_idx, kind='mergesort')
+    positions, face_idx, rotated_weights = positions[order], face_idx[order], rotated_weights[order]
+    # Express the barycentric coordinates with respect to the original vertex order
+    weights = np.empty(rotated_weights.shape)
+    weights[np.arange(len(face_idx))[:, np.newaxis], vertex_order[face_idx]] = rotated_weights
+    return positions, face_idx, weights
+
+
+def _sample_faces_random(v0, v1, v2, density, random_state):
+    """ Returns positions, face indices and barycentric coordinates of random samples of all faces. """
+    areas = 0.5 * np.linalg.norm(np.cross(v1 - v0, v2 - v0), axis=1)
+    # stochastic rounding, so that also faces with less than one expected sample are represented
+    expected_numbers = areas * density ** 2
+    numbers = np.floor(expected_numbers + random_state.rand(len(areas))).astype(int)
+    face_idx = np.repeat(np.arange(len(areas)), numbers)
+    # uniform samples in barycentric coordinates
+    sqrt_r1 = np.sqrt(random_state.rand(len(face_idx), 1))
+    r2 = random_state.rand(len(face_idx), 1)
+    weights = np.concatenate((1.0 - sqrt_r1, sqrt_r1 * (1.0 - r2), sqrt_r1 * r2), axis=1)
+    positions = weights[:, 0:1] * v0[face_idx] + weights[:, 1:2] * v1[face_idx] + weights[:, 2:3] * v2[face_idx]
+    return positions.astype(v0.dtype), face_idx, weights
+
+
+def create_contact_points_from_stl(file_name, density=300, method='slices', seed=None):
     """ Create a contact point list from an stl mesh.
         The mesh is read in and the faces are sampled to acquire a dense point cloud with normals.
         :param str file_name: the filename of the stl file to read
         :param float density: number of samples per meter
+        :param str method: sampling method, see sample_faces
+        :param seed: (optional) random seed, see sample_faces
         :return a list of contact points (numpy array) of the shape [pos, normal], i.e. (1, 6)
     """
     stl_mesh = stl_mesh_module.Mesh.from_file(file_name, calculate_normals=False)
-    contact_points = []
+    normals = np.array(stl_mesh.normals)
     # yes, len(stl_mesh.points) is the number of faces and NOT vertices
-    for face_idx in range(len(stl_mesh.points)):
-        normal_length = np.linalg.norm(stl_mesh.normals[face_idx])
-        if normal_length == 0.0:
-            stl_mesh.update_normals()
-            normal_length = np.linalg.norm(stl_mesh.normals[face_idx])
-            if normal_length == 0.0:
-                raise IOError('[hfts_generation.py::create_contact_points_from_stl] Could not extract valid normals from the given file ' \
-                              + str(file_name))
-        points_on_face = sample_face(stl_mesh.v0[face_idx], stl_mesh.v1[face_idx], stl_mesh.v2[face_idx],
-                                     stl_mesh.normals[face_idx], density=density)
-        contact_points.extend(points_on_face)
-    return np.array(contact_points)
-
-
-def create_contact_points_from_ply(file_name, density=300):
+    b_invalid_normals = np.linalg.norm(normals, axis=1) == 0.0
+    if b_invalid_normals.any():
+        # Faces up to the first one without normal keep the normals stored in the file
+        first_invalid = np.argmax(b_invalid_normals)
+        stl_mesh.update_normals()
+        normals[first_invalid:] = stl_mesh.normals[first_invalid:]
+        if np.any(np.linalg.norm(normals[first_invalid:], axis=1) == 0.0):
+            raise IOError('[hfts_generation.py::create_contact_points_from_stl] Could not extract valid normals from the given file ' \
+                          + str(file_name))
+    return sample_faces(stl_mesh.v0, stl_mesh.v1, stl_mesh.v2, normals, density=density, method=method, seed=seed)
+
+
+def create_contact_points_from_ply(file_name, density=300, method='slices', seed=None,
+                                   b_interpolate_normals=False):
+    """ Create a contact point list from a ply mesh with vertex normals.
+        :param str file_name: the filename of the ply file to read
+        :param float density: number of samples per meter
+        :param str method: sampling method, see sample_faces
+        :param seed: (optional) random seed, see sample_faces
+        :param bool b_interpolate_normals: if True, the normal of each point is interpolated from the vertex
+            normals, else all points of a face have the mean of its vertex normals
+        :return a numpy array of contact points of the shape (n, 6), where each row is [pos, normal]
+    """
     ply_data = PlyData.read(file_name)
-    contact_points = []
-    faces = ply_data['face']
-    vertices = ply_data['vertex']
-    for face in faces:
-        v0 = np.array([vertices[face[0][0]][t] for t in ['x', 'y', 'z', 'nx', 'ny', 'nz']])
-        v1 = np.array([vertices[face[0][1]][t] for t in ['x', 'y', 'z', 'nx', 'ny', 'nz']])
-        v2 = np.array([vertices[face[0][2]][t] for t in ['x', 'y', 'z', 'nx', 'ny', 'nz']])
-        # TODO we are throwing information away here. We could instead interpolate vertex normals
-        face_normal = np.mean([v0[3:6], v1[3:6], v2[3:6]], axis=0)
-        points_on_face = sample_face(v0[:3], v1[:3], v2[:3], face_normal, density=density)
-        contact_points.extend(points_on_face)
-    return np.array(contact_points)
-
-
-def filter_unsmooth_points(points, radius, max_variance):
+    vertex_data = ply_data['vertex'].data
+    vertex_positions = np.column_stack([vertex_data[t] for t in ['x', 'y', 'z']])
+    vertex_normals = np.column_stack([vertex_data[t] for t in ['nx', 'ny', 'nz']])
+    # the first property of a face is its list of vertex indices
+    face_data = ply_data['face'].data
+    vertex_indices = face_data[face_data.dtype.names[0]]
+    try:
+        # fast path if all faces have the same number of vertices
+        triangles = np.vstack(vertex_indices)[:, :3]
+    except ValueError:
+        triangles = np.array([face[:3] for face in vertex_indices]).reshape((-1, 3))
+    triangles = triangles.astype(int)
+    v0, v1, v2 = [vertex_positions[triangles[:, i]] for i in range(3)]
+    n0, n1, n2 = [vertex_normals[triangles[:, i]] for i in range(3)]
+    if b_interpolate_normals:
+        return sample_faces(v0, v1, v2, None, density=density, method=method, seed=seed,
+                            vertex_normals=(n0, n1, n2))
+    face_normals = np.mean([n0, n1, n2], axis=0)
+    return sample_faces(v0, v1, v2, face_normals, density=density, method=method, seed=seed)
+
+
+def estimate_normals(positions, num_neighbors=DEFAULT_NORMAL_NUM_NEIGHBORS, chunk_size=FILTER_CHUNK_SIZE):
+    """ Estimates the normal of each point of a point cloud as the direction of least variance of its
+        num_neighbors nearest neighbors (PCA of the neighborhood). The neighborhoods are processed in chunks
+        of chunk_size points. Normals are oriented away from the centroid of the point cloud, which is
+        correct for (approximately) convex objects.
+        :param positions: numpy array of shape (n, 3)
+        :param num_neighbors: number of neighbors (including the point itself) to fit a plane to
+        :param chunk_size: number of points processed at once
+        :return numpy array of shape (n, 3) with unit normals
+    """
+    positions = np.asarray(positions, dtype=float)
+    num_neighbors = min(num_neighbors, positions.shape[0])
+    index = SpatialIndex(positions)
+    normals = np.empty_like(positions)
+    for start in range(0, positions.shape[0], chunk_size):
+        chunk = positions[start:start + chunk_size]
+        _, neighbor_idx = index.query(chunk, k=num_neighbors)
+        neighbor_idx = neighbor_idx.reshape((chunk.shape[0], num_neighbors))
+        neighbors = positions[neighbor_idx]
+        neighbors -= np.mean(neighbors, axis=1)[:, np.newaxis, :]
+        covariances = np.einsum('nki,nkj->nij', neighbors, neighbors)
+        # eigenvalues are in ascending order, so the first eigenvector is the direction of least variance
+        _, eigenvectors = np.linalg.eigh(covariances)
+        normals[start:start + chunk_size] = eigenvectors[:, :, 0]
+    b_inward = np.einsum('ij,ij->i', normals, positions - np.mean(positions, axis=0)) < 0.0
+    normals[b_inward] *= -1.0
+    return normals
+
+
+def create_contact_points_from_point_cloud(positions, num_neighbors=DEFAULT_NORMAL_NUM_NEIGHBORS):
+    """ Create a contact point list from a point cloud without normals, e.g. from a depth sensor.
+        :param positions: numpy array of shape (n, 3)
+        :param num_neighbors: number of neighbors used to estimate normals, see estimate_normals
+        :return a numpy array of contact points of the shape (n, 6), where each row is [pos, normal]
+    """
+    positions = np.asarray(positions, dtype=float)[:, :3]
+    return np.c_[positions, estimate_normals(positions, num_neighbors)]
+
+
+def filter_unsmooth_points(points, radius, max_variance, chunk_size=FILTER_CHUNK_SIZE, num_processes=None):
     """ Filter contact points in the given list of points based on the normal variance in their
         Euclidean neighborhood.
         :param points - list/array of points to filter
         :param float radius: size of neighborhood to consider
         :param float max_variance: threshold for maximum allowed variance
+        :param int chunk_size: number of points whose neighborhoods are processed at once
+        :param int num_processes: number of processes to distribute the chunks on. By default, multiple
+            processes are only used for clouds with more than PARALLEL_FILTER_MIN_POINTS points and never
+            in daemonic processes (e.g. workers of a multiprocessing.Pool), which may not have children.
         :return a subset of points for which the variance of normals is below the given threshold
     """
     start_time = time.time()
-    kdt = sklearn.neighbors.KDTree(points[:, :3], leaf_size=6, metric='euclidean')
-    vld_idx = np.ones(points.shape[0], dtype=bool)
-    for i in range(len(points)):
-        point = points[i]
-        nbs_indices = kdt.query_radius(point[:3], radius)[0]
-        if len(nbs_indices) == 0:
-            continue
-        nb_points_normals = points[nbs_indices, 3:]
-        var = np.var(nb_points_normals, axis=0)
-        if max(var) > max_variance:
-            vld_idx[i] = False
-    points = points[vld_idx, :]
+    points = np.asarray(points)
+    if num_processes is None:
+        if len(points) > PARALLEL_FILTER_MIN_POINTS and not multiprocessing.current_process().daemon:
+            num_processes = multiprocessing.cpu_count()
+        else:
+            num_processes = 1
+    chunks = [np.arange(start, min(start + chunk_size, len(points))) for start in range(0, len(points), chunk_size)]
+    if num_processes > 1 and len(chunks) > 1:
+        pool = multiprocessing.Pool(num_processes, initializer=_init_filter_worker, initargs=(points, radius))
+        try:
+            max_variances = pool.map(_filter_worker, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        index = SpatialIndex(points[:, :3])
+        max_variances = [_compute_max_normal_variances(index, points, chunk, radius) for chunk in chunks]
+    if len(max_variances) > 0:
+        vld_idx = np.concatenate(max_variances) <= max_variance
+        points = points[vld_idx, :]
     print 'filtering points took %fs' % (time.time() - start_time)
     return points
 
 
-def filter_object_part_points(points, part_description, distance_threshold=0.01):
+def _compute_max_normal_variances(index, points, query_idx, radius):
+    """ Computes for each of the points points[query_idx] the variances of the normals (per dimension)
+        in its radius-neighborhood and returns the maximum of these for each point (0 for empty neighborhoods).
+    """
+    neighborhoods = index.query_ball_point(points[query_idx, :3], radius)
+    counts = np.array([len(neighborhood) for neighborhood in neighborhoods], dtype=int)
+    max_variances = np.zeros(len(query_idx))
+    b_non_empty = counts > 0
+    if not np.any(b_non_empty):
+        return max_variances
+    neighbor_idx = np.concatenate([neighborhood for neighborhood in neighborhoods]).astype(int)
+    # neighbor_idx consists of segments, one per neighborhood. Compute mean and variance of each segment.
+    counts = counts[b_non_empty]
+    starts = np.cumsum(counts) - counts
+    segment_idx = np.repeat(np.arange(len(counts)), counts)
+    neighbor_normals = points[neighbor_idx, 3:6]
+    means = np.add.reduceat(neighbor_normals, starts, axis=0) / counts[:, np.newaxis].astype(float)
+    deviations = neighbor_normals - means[segment_idx]
+    variances = np.add.reduceat(deviations ** 2, starts, axis=0) / counts[:, np.newaxis].astype(float)
+    max_variances[b_non_empty] = np.max(variances, axis=1)
+    return max_variances
+
+
+# Data of filter_unsmooth_points worker processes
+_filter_worker_data = {}
+
+
+def _init_filter_worker(points, radius):
+    _filter_worker_data['points'] = points
+    _filter_worker_data['radius'] = radius
+    _filter_worker_data['index'] = SpatialIndex(points[:, :3])
+
+
+def _filter_worker(query_idx):
+    return _compute_max_normal_variances(_filter_worker_data['index'], _filter_worker_data['points'],
+                                         query_idx, _filter_worker_data['radius'])
+
+
+def filter_object_part_points(points, part_description, distance_threshold=0.01, b_voxel_hash=False):
     """ Filters points based on a part description. Points which are further away from a
         the given object part than the given threshold are filter out.
         :param points - array/list of contact points
         :param part_description - set of points describing the object part to keep
         :param distance_threshold - maximal distance a contact point in points is allowed to have to its closest point
             in part_description
+        :param b_voxel_hash - if True, points that are not in a voxel (of size distance_threshold) next to a voxel
+            containing part points are rejected before the nearest neighbor query
         :return filtered subset of points, for which each point is within distance_threshold to a point from
             part_description
     """
-    kdt = sklearn.neighbors.KDTree(part_description, metric='euclidean')
-    idx = np.ones(points.shape[0], dtype=bool)
-    for i in range(len(points)):
-        point = points[i]
-        neighbors_in_part = kdt.query_radius(point[:3], distance_threshold, count_only=True)
-        idx[i] = neighbors_in_part > 0
+    points = np.asarray(points)
+    part_description = np.asarray(part_description, dtype=float).reshape((-1, 3))
+    idx = np.zeros(points.shape[0], dtype=bool)
+    if part_description.shape[0] == 0:
+        return points[idx, :]
+    candidate_idx = np.arange(points.shape[0])
+    if b_voxel_hash:
+        candidate_idx = candidate_idx[_compute_voxel_neighborhood_mask(points[:, :3], part_description,
+                                                                       distance_threshold)]
+    index = SpatialIndex(part_description)
+    # query with a slightly larger bound, so that points at exactly distance_threshold are included
+    distances, _ = index.query(points[candidate_idx, :3], distance_upper_bound=distance_threshold * (1.0 + 1e-6))
+    idx[candidate_idx] = distances <= distance_threshold
     return points[idx, :]
 
 
-def down_sample_points(points, num_points):
-    """ Uniformly down samples the set points to the given amount of points.
-        Note that the sampling is done in index space, i.e. it is not guaranteed that the
-        returned list of points represents a uniform distribution over an object's surface.
+def _compute_voxel_neighborhood_mask(positions, part_positions, voxel_size):
+    """ Returns a mask of the positions that lie in a voxel adjacent to (or equal to) a voxel containing a
+        part position. All positions within voxel_size of a part position are in this set.
+    """
+    origin = np.min(part_positions, axis=0) - voxel_size
+    # part voxels have coordinates in [1, grid_size - 2], so all their neighbors are in [0, grid_size - 1]
+    part_voxels = np.floor((part_positions - origin) / voxel_size).astype(int)
+    grid_size = np.max(part_voxels, axis=0) + 2
+
+    def compute_keys(voxels):
+        return (voxels[:, 0] * grid_size[1] + voxels[:, 1]) * grid_size[2] + voxels[:, 2]
+    occupied_keys = np.unique(compute_keys(part_voxels))
+    voxels = np.floor((positions - origin) / voxel_size).astype(int)
+    b_in_grid = np.logical_and(voxels >= 0, voxels < grid_size).all(axis=1)
+    voxels = voxels[b_in_grid]
+    b_near_part = np.zeros(voxels.shape[0], dtype=bool)
+    for offset in itertools.product([-1, 0, 1], repeat=3):
+        neighbor_voxels = voxels + np.array(offset)
+        # neighbors outside of the grid can not be occupied
+        b_valid = np.logical_and(neighbor_voxels >= 0, neighbor_voxels < grid_size).all(axis=1)
+        b_near_part[b_valid] |= np.in1d(compute_keys(neighbor_voxels[b_valid]), occupied_keys)
+    mask = np.zeros(positions.shape[0], dtype=bool)
+    mask[b_in_grid] = b_near_part
+    return mask
+
+
+def down_sample_points(points, num_points, method='random'):
+    """ Down samples the set points to the given amount of points.
         :param points - set of points to down sample
         :param num_points - number of points to return
+        :param method - 'random': Uniform sampling in index space, i.e. it is not guaranteed that the
+                            returned list of points represents a uniform distribution over an object's surface.
+                        'voxel': Spatially uniform sampling. The points are binned into a voxel grid, whose
+                            resolution is chosen such that there are at most num_points occupied voxels
+                            (and as close to num_points as possible). From each voxel the point closest to
+                            the mean of its points is kept, so positions and normals are original points.
     """
     if len(points) <= num_points:
         return points
-    idx = np.random.choice(range(len(points)), num_points, replace=False)
-    return points[idx]
+    if method == 'random':
+        idx = np.random.choice(range(len(points)), num_points, replace=False)
+        return points[idx]
+    elif method == 'voxel':
+        return points[_voxel_grid_down_sample(np.asarray(points)[:, :3], num_points)]
+    raise ValueError('[hfts_generation::down_sample_points] Unknown down sampling method ' + str(method))
+
+
+def _compute_voxel_ids(positions, voxel_size):
+    """ Returns for each position the index of its voxel among all occupied voxels of a grid with the given
+        voxel size and the number of occupied voxels.
+    """
+    voxels = np.floor((positions - np.min(positions, axis=0)) / voxel_size).astype(np.int64)
+    grid_size = np.max(voxels, axis=0) + 1
+    keys = (voxels[:, 0] * grid_size[1] + voxels[:, 1]) * grid_size[2] + voxels[:, 2]
+    unique_keys, voxel_ids = np.unique(keys, return_inverse=True)
+    return voxel_ids, len(unique_keys)
+
+
+def _voxel_grid_down_sample(positions, num_points, num_iterations=20, max_grid_resolution=1e6):
+    """ Returns the indices of at most num_points positions that are spatially uniformly distributed,
+        see down_sample_points.
+    """
+    extent = np.max(np.max(positions, axis=0) - np.min(positions, axis=0))
+    if extent == 0.0:
+        return np.array([0])
+    # Find voxel sizes with too many (lower) and at most num_points (upper) occupied voxels,
+    # then bisect between them (on a log scale, since the number of voxels grows polynomially).
+    min_voxel_size = extent / max_grid_resolution
+    # for voxels larger than the extent there is only a single occupied voxel
+    upper = 2.0 * extent
+    upper_ids, num_voxels = _compute_voxel_ids(positions, upper)
+    lower = upper / 2.0
+    while lower > min_voxel_size:
+        voxel_ids, num_voxels = _compute_voxel_ids(positions, lower)
+        if num_voxels > num_points:
+            break
+        upper, upper_ids = lower, voxel_ids
+        lower /= 2.0
+    for i in range(num_iterations):
+        voxel_size = math.sqrt(lower * upper)
+        voxel_ids, num_voxels = _compute_voxel_ids(positions, voxel_size)
+        if num_voxels > num_points:
+            lower = voxel_size
+        else:
+            upper, upper_ids = voxel_size, voxel_ids
+            if num_voxels == num_points:
+                break
+    # For each voxel select the point closest to the mean of its points
+    counts = np.bincount(upper_ids).astype(float)
+    means = np.column_stack([np.bincount(upper_ids, weights=positions[:, dim]) / counts for dim in range(3)])
+    distances = np.linalg.norm(positions - means[upper_ids], axis=1)
+    order = np.lexsort((distances, upper_ids))
+    sorted_ids = upper_ids[order]
+    b_first = np.concatenate(([True], sorted_ids[1:] != sorted_ids[:-1]))
+    return np.sort(order[b_first])
 
 
 def read_object_part_description(file_name, part_value=1):
@@ -171,7 +496,153 @@ def read_object_part_description(file_name, part_value=1):
     return np.array(positions)
 
 
+def compute_node_indices(labels, branching_factors):
+    """ Computes for each point the flat index of the HFTS node it belongs to on each level.
+        The node with label [c_0, ..., c_l] has the flat index (...(c_0 * b_1 + c_1) * b_2 + ...) * b_l + c_l,
+        where b_i is the branching factor of level i. Hence, the flat indices of the deepest level
+        order points lexicographically by their labels.
+        :param labels - (n, num_levels) array of labels
+        :param branching_factors - list of branching factors, one for each level
+        :return a list containing an integer array of flat indices for each level
+    """
+    labels = np.asarray(labels).astype(int)
+    node_indices = []
+    flat_idx = np.zeros(labels.shape[0], dtype=int)
+    for level in range(len(branching_factors)):
+        flat_idx = flat_idx * int(branching_factors[level]) + labels[:, level]
+        node_indices.append(flat_idx)
+    return node_indices
+
+
+def is_hfts_sorted(hfts, hfts_param):
+    """ Returns whether the rows of the given hfts are sorted lexicographically by their labels. """
+    if len(hfts_param) == 0 or hfts.shape[0] < 2:
+        return True
+    node_indices = compute_node_indices(hfts[:, 6:6 + len(hfts_param)], hfts_param)[-1]
+    return bool(np.all(node_indices[1:] >= node_indices[:-1]))
+
+
+def sort_hfts(hfts, hfts_param):
+    """ Sorts the rows of the given hfts lexicographically by their labels, so that the points of every
+        node in the hierarchy form a contiguous block of rows.
+        :param hfts - array where each row is [position, normal, labels]
+        :param hfts_param - branching factors of the hfts
+        :return sorted copy of hfts
+    """
+    if len(hfts_param) == 0:
+        return np.array(hfts)
+    node_indices = compute_node_indices(hfts[:, 6:6 + len(hfts_param)], hfts_param)[-1]
+    return hfts[np.argsort(node_indices, kind='mergesort')]
+
+
+def compute_hfts_offsets(hfts, hfts_param):
+    """ Computes the offsets table of a label-sorted hfts (see sort_hfts).
+        :param hfts - array where each row is [position, normal, labels], sorted by labels
+        :param hfts_param - branching factors of the hfts
+        :return a list with one integer array per level. For level l the array offsets has
+            prod(hfts_param[:l + 1]) + 1 entries and the points of the node with flat index i
+            (see compute_node_indices) are hfts[offsets[i]:offsets[i + 1]].
+    """
+    node_indices = compute_node_indices(hfts[:, 6:6 + len(hfts_param)], hfts_param)
+    offsets = []
+    num_nodes = 1
+    for level in range(len(hfts_param)):
+        num_nodes *= int(hfts_param[level])
+        if np.any(node_indices[level][1:] < node_indices[level][:-1]):
+            raise ValueError('[hfts_generation::compute_hfts_offsets] The given hfts is not sorted by labels')
+        offsets.append(np.searchsorted(node_indices[level], np.arange(num_nodes + 1)))
+    return offsets
+
+
+def kmeans_lloyd(points, num_clusters, max_iter=20, random_state=None):
+    """ Clusters the given points with k-means++ seeding followed by at most max_iter Lloyd iterations.
+        :param points - (n, d) array of points
+        :param num_clusters - number of clusters
+        :param max_iter - maximal number of Lloyd iterations
+        :param random_state - (optional) np.random.RandomState used for seeding
+        :return (labels, inertia, centers), where labels is an array containing the cluster of each point,
+            inertia the sum of squared distances of all points to their cluster centers and centers
+            a (num_clusters, d) array of the cluster centers
+    """
+    if random_state is None:
+        random_state = np.random.RandomState()
+    num_points = points.shape[0]
+    # k-means++ seeding: every further center is a point drawn with probability proportional to the
+    # squared distance to its closest center
+    centers = np.empty((num_clusters, points.shape[1]))
+    centers[0] = points[random_state.randint(num_points)]
+    closest_sq_distances = np.sum((points - centers[0]) ** 2, axis=1)
+    for c in range(1, num_clusters):
+        cumulative_sq_distances = np.cumsum(closest_sq_distances)
+        if cumulative_sq_distances[-1] > 0.0:
+            idx = np.searchsorted(cumulative_sq_distances, random_state.rand() * cumulative_sq_distances[-1])
+            idx = min(idx, num_points - 1)
+        else:
+            idx = random_state.randint(num_points)
+        centers[c] = points[idx]
+        closest_sq_distances = np.minimum(closest_sq_distances, np.sum((points - centers[c]) ** 2, axis=1))
+
+    def assign(centers):
+        sq_distances = np.sum((points[:, np.newaxis, :] - centers[np.newaxis, :, :]) ** 2, axis=2)
+        labels = np.argmin(sq_distances, axis=1)
+        return labels, np.sum(sq_distances[np.arange(num_points), labels])
+    labels, inertia = assign(centers)
+    for i in range(max_iter):
+        counts = np.bincount(labels, minlength=num_clusters)
+        b_non_empty = counts > 0
+        for dim in range(points.shape[1]):
+            sums = np.bincount(labels, weights=points[:, dim], minlength=num_clusters)
+            # empty clusters keep their center
+            centers[b_non_empty, dim] = sums[b_non_empty] / counts[b_non_empty]
+        new_labels, inertia = assign(centers)
+        if np.all(new_labels == labels):
+            break
+        labels = new_labels
+    return labels, inertia, centers
+
+
+def balance_partition(points, centers, labels=None):
+    """ Assigns the given points to the clusters with the given centers such that all clusters have the
+        same size (up to one point). Points are assigned greedily: in every round each unassigned point
+        proposes to its closest cluster that is not full yet, and each cluster accepts the closest proposals
+        up to its remaining capacity.
+        :param points - (n, d) array of points
+        :param centers - (k, d) array of cluster centers
+        :param labels - (optional) unconstrained labels of the points. The clusters with the most points
+            in this labeling receive the additional points if n is not a multiple of k.
+        :return (labels, inertia) of the balanced partition
+    """
+    num_points, num_clusters = points.shape[0], centers.shape[0]
+    sq_distances = np.sum((points[:, np.newaxis, :] - centers[np.newaxis, :, :]) ** 2, axis=2)
+    capacities = np.full(num_clusters, num_points // num_clusters, dtype=int)
+    if labels is not None:
+        largest_clusters = np.argsort(-np.bincount(labels, minlength=num_clusters), kind='mergesort')
+    else:
+        largest_clusters = np.arange(num_clusters)
+    capacities[largest_clusters[:num_points % num_clusters]] += 1
+    balanced_labels = np.full(num_points, -1, dtype=int)
+    unassigned = np.arange(num_points)
+    while len(unassigned) > 0:
+        candidate_sq_distances = sq_distances[unassigned]
+        candidate_sq_distances[:, capacities == 0] = np.inf
+        proposals = np.argmin(candidate_sq_distances, axis=1)
+        proposal_sq_distances = candidate_sq_distances[np.arange(len(unassigned)), proposals]
+        # sort proposals by cluster and distance and accept the first ones of each cluster
+        order = np.lexsort((proposal_sq_distances, proposals))
+        sorted_proposals = proposals[order]
+        ranks = np.arange(len(order)) - np.searchsorted(sorted_proposals, sorted_proposals, side='left')
+        b_accepted = ranks < capacities[sorted_proposals]
+        balanced_labels[unassigned[order[b_accepted]]] = sorted_proposals[b_accepted]
+        capacities -= np.bincount(sorted_proposals[b_accepted], minlength=num_clusters)
+        unassigned = unassigned[order[np.logical_not(b_accepted)]]
+    inertia = np.sum(sq_distances[np.arange(num_points), balanced_labels])
+    return balanced_labels, inertia
+
+
 class HFTSGenerator:
+    # Available clustering methods, see set_clustering_method
+    CLUSTERING_METHODS = ['kmeans', 'minibatch_kmeans', 'lloyd']
+
     # 6 dim of positions and normals + labels
     def __init__(self, points, com):
         self._point_n = points.shape[0]
@@ -180,9 +651,21 @@ class HFTSGenerator:
         self._pos_weight = 10
         self._branch_factor = 4
         self._first_level_factor = 3
+        self._clustering_method = 'kmeans'
+        self._clustering_n_init = None
+        self._clustering_max_iter = None
+        self._seed = None
+        self._num_workers = 1
+        self._b_balanced = False
+        self._max_levels = None
+        self._time_budget = None
+        self._stats_lock = threading.Lock()
+        self._clustering_time = 0.0
+        self._inertia = 0.0
         self._level_n = None
         self._hfts = None
         self._hfts_param = None
+        self._hfts_offsets = None
 
     def set_position_weight(self, w):
         self._pos_weight = w
@@ -190,39 +673,150 @@ class HFTSGenerator:
     def set_branch_factor(self, b):
         self._branch_factor = b
 
-    def _cal_levels(self):
-        self._level_n = int(math.log(self._point_n / self._first_level_factor, self._branch_factor)) - 1
+    def set_clustering_method(self, method, n_init=None, max_iter=None):
+        """ Sets the clustering method used to partition the points of each node.
+            :param method - 'kmeans': sklearn.cluster.KMeans
+                            'minibatch_kmeans': sklearn.cluster.MiniBatchKMeans
+                            'lloyd': k-means++ seeding and a fixed budget of Lloyd iterations (see kmeans_lloyd)
+            :param n_init - (optional) number of initializations of kmeans and minibatch_kmeans
+                (None for sklearn's default)
+            :param max_iter - (optional) maximal number of iterations (None for the method's default)
+        """
+        if method not in self.CLUSTERING_METHODS:
+            raise ValueError('[HFTSGenerator::set_clustering_method] Unknown clustering method %s. Supported are %s'
+                             % (str(method), str(self.CLUSTERING_METHODS)))
+        self._clustering_method = method
+        self._clustering_n_init = n_init
+        self._clustering_max_iter = max_iter
+
+    def set_random_seed(self, seed):
+        """ Sets the seed for clustering (None for unseeded clustering). The clustering of each node is
+            seeded with a seed derived from this seed and the node's label, so that the result does not
+            depend on the number of workers.
+        """
+        self._seed = seed
+
+    def set_balanced(self, b_balanced):
+        """ Sets whether the points of each node are partitioned into clusters of equal size (up to one point),
+            see balance_partition. In this case the hierarchy has as many levels as _cal_levels predicts.
+        """
+        self._b_balanced = b_balanced
+
+    def set_max_levels(self, max_levels):
+        """ Limits the number of levels of the hierarchy (None for as many levels as the points allow). """
+        self._max_levels = max_levels
+
+    def set_time_budget(self, time_budget):
+        """ Sets a time budget in seconds for the clustering (None for no limit). The hierarchy is computed
+            level by level, and no further level is started if it is predicted to exceed the budget.
+            The first level is always computed.
+        """
+        self._time_budget = time_budget
+
+    def set_num_workers(self, num_workers):
+        """ Sets the number of threads that partition the nodes of a level in parallel. """
+        self._num_workers = max(1, num_workers)
+
+    def get_clustering_stats(self):
+        """ Returns the time spent on clustering and the sum of the inertias (sums of squared distances
+            of the weighted points to their cluster centers) of all clusterings.
+        """
+        return {'time': self._clustering_time, 'inertia': self._inertia}
 
-    def _get_partition_labels(self, points, branch_factor):
+    def _cal_levels(self):
+        num_first_level_points = max(1, self._point_n / self._first_level_factor)
+        self._level_n = int(math.log(num_first_level_points, self._branch_factor)) - 1
+        if self._max_levels is not None:
+            self._level_n = min(self._level_n, self._max_levels)
+        # Small point clouds still get one level, see _compute_hfts
+        self._level_n = max(1, self._level_n)
+
+    def _get_partition_labels(self, points, branch_factor, random_state=None):
         points = np.array(points)
         if points.shape[0] < branch_factor:
             rospy.loginfo('HFTS generation finished')
             return None
-        estimator = sklearn.cluster.KMeans(n_clusters=branch_factor)
         points[:, :3] *= self._pos_weight
-        estimator.fit(points)
-        return estimator.labels_
-
-    def _compute_hfts(self, curr_points, level=0):
-        # TODO This implementation suffers from very unbalanced point clouds.
-        # TODO The hierarchy's depth is governed by the number of points in the smallest cluster.
-        if level >= self._level_n:
-            return
-        idx = curr_points[:, 0].astype(int)
-        if level == 0:
-            b_factor = self._branch_factor * self._first_level_factor
+        start_time = time.time()
+        if self._clustering_method == 'lloyd':
+            max_iter = self._clustering_max_iter if self._clustering_max_iter is not None else 20
+            labels, inertia, centers = kmeans_lloyd(points, branch_factor, max_iter=max_iter,
+                                                    random_state=random_state)
         else:
-            b_factor = self._branch_factor
-        points_6D = curr_points[:, 1:]
-        curr_labels = self._get_partition_labels(points_6D, b_factor)
-        if curr_labels is None:
-            self._level_n = level - 1
-            return
-        self._hfts[idx, level] = curr_labels
-        for label in range(b_factor):
-            l_idx = np.where(curr_labels == label)[0]
-            sub_points = curr_points[l_idx, :]
-            self._compute_hfts(sub_points, level + 1)
+            kwargs = {'n_clusters': branch_factor, 'random_state': random_state}
+            if self._clustering_n_init is not None:
+                kwargs['n_init'] = self._clustering_n_init
+            if self._clustering_max_iter is not None:
+                kwargs['max_iter'] = self._clustering_max_iter
+            if self._clustering_method == 'kmeans':
+                estimator = sklearn.cluster.KMeans(**kwargs)
+            else:
+                estimator = sklearn.cluster.MiniBatchKMeans(**kwargs)
+            estimator.fit(points)
+            labels, inertia, centers = estimator.labels_, estimator.inertia_, estimator.cluster_centers_
+        if self._b_balanced:
+            labels, inertia = balance_partition(points, centers, labels)
+        with self._stats_lock:
+            self._clustering_time += time.time() - start_time
+            self._inertia += inertia
+        return labels
+
+    def _create_node_random_state(self, label):
+        # The random state of a node only depends on the seed and the node's label, so that the result
+        # does not depend on the order in which nodes are processed.
+        if self._seed is None:
+            return None
+        return np.random.RandomState([self._seed] + list(label))
+
+    def _compute_hfts(self):
+        # TODO Unless balanced partitions are enabled (see set_balanced), this implementation suffers from very
+        # TODO unbalanced point clouds. The hierarchy's depth is governed by the number of points in the smallest
+        # TODO cluster.
+        # The hierarchy is computed level by level. The partitions of all nodes on one level are independent,
+        # and are computed by a pool of worker threads (clustering mostly runs in numpy/sklearn code that
+        # releases the GIL).
+        pool = ThreadPool(self._num_workers) if self._num_workers > 1 else None
+        start_time = time.time()
+        try:
+            # each node is a tuple (label, points)
+            nodes = [((), self._points)]
+            for level in range(self._level_n):
+                level_start_time = time.time()
+                if level == 0:
+                    b_factor = self._branch_factor * self._first_level_factor
+                else:
+                    b_factor = self._branch_factor
+
+                def partition(node):
+                    return self._get_partition_labels(node[1][:, 1:], b_factor,
+                                                      self._create_node_random_state(node[0]))
+                if pool is not None:
+                    nodes_labels = pool.map(partition, nodes)
+                else:
+                    nodes_labels = map(partition, nodes)
+                if any(labels is None for labels in nodes_labels):
+                    if level > 0:
+                        # some node has too few points to be partitioned, keep the complete levels
+                        self._level_n = level
+                        return
+                    # there are fewer points than clusters, so put every point in a cluster of its own
+                    nodes_labels = [np.arange(self._point_n)]
+                child_nodes = []
+                for (label, curr_points), curr_labels in itertools.izip(nodes, nodes_labels):
+                    self._hfts[curr_points[:, 0].astype(int), level] = curr_labels
+                    for child in range(b_factor):
+                        child_nodes.append((label + (child,), curr_points[curr_labels == child]))
+                nodes = child_nodes
+                # every level partitions all points, so the next level takes about as long as this one
+                if self._time_budget is not None and level + 1 < self._level_n and \
+                        2.0 * time.time() - level_start_time - start_time > self._time_budget:
+                    rospy.loginfo('HFTS generation stopped after %i levels due to the time budget' % (level + 1))
+                    self._level_n = level + 1
+                    return
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
 
     def run(self):
         if self._hfts is not None:
@@ -230,9 +824,9 @@ class HFTSGenerator:
         if self._level_n is None:
             self._cal_levels()
 
-        rospy.loginfo('Generating HFTS')
+        rospy.loginfo('Generating HFTS (clustering method %s)' % self._clustering_method)
         self._hfts = np.empty([self._point_n, self._level_n])
-        self._compute_hfts(self._points)
+        self._compute_hfts()
         self._hfts = self._hfts[:, :self._level_n]
         self._hfts_param = np.empty(self._level_n)
 
@@ -241,6 +835,14 @@ class HFTSGenerator:
                 self._hfts_param[i] = self._branch_factor * self._first_level_factor
             else:
                 self._hfts_param[i] = self._branch_factor
+        # Sort points by their labels, so that every node of the hierarchy is a contiguous block of points
+        if self._level_n > 0:
+            order = np.argsort(compute_node_indices(self._hfts, self._hfts_param)[-1], kind='mergesort')
+            self._points = self._points[order]
+            self._hfts = self._hfts[order]
+        self._hfts_offsets = compute_hfts_offsets(self.get_hfts(), self._hfts_param)
+        rospy.loginfo('HFTS with %i levels generated, clustering took %fs, total inertia %f' %
+                      (self._level_n, self._clustering_time, self._inertia))
 
     def save_hfts(self, hfts_file, hfts_param_file, com_file):
         data = np.c_[self._points[:, 1:], self._hfts]
@@ -258,18 +860,21 @@ class HFTSGenerator:
             self.run()
         return self._hfts_param
 
+    def get_hfts_offsets(self):
+        """ Returns the offsets table of the (label-sorted) hfts, see compute_hfts_offsets. """
+        if self._hfts_offsets is None:
+            self.run()
+        return self._hfts_offsets
 
-def or_render_hfts(or_env_drawer, hfts, hfts_params, level, transform=None, b_normals=False, size=0.0005):
-    bfactors = []
-    level = max(0, min(len(hfts_params), level))
-    for l in range(level + 1):
-        bfactors.append(range(int(hfts_params[l])))
 
-    labels = itertools.product(*bfactors)
-    hfts_labels = hfts[:, 6:7 + level]
-    for label in labels:
-        idx = np.where((hfts_labels == label).all(axis=1))[0]
-        cluster_points = hfts[idx, :6]
+def or_render_hfts(or_env_drawer, hfts, hfts_params, level, transform=None, b_normals=False, size=0.0005,
+                   offsets=None):
+    level = max(0, min(len(hfts_params) - 1, level))
+    if offsets is None:
+        offsets = compute_hfts_offsets(hfts, hfts_params)
+    level_offsets = offsets[level]
+    for node_idx in range(len(level_offsets) - 1):
+        cluster_points = hfts[level_offsets[node_idx]:level_offsets[node_idx + 1], :6]
         color = [0, 0, 0, 1]
         color[:3] = np.random.rand(3, 1)
         or_render_points(or_env_drawer, cluster_points, transform, b_normals=b_normals,
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+""" This module contains a versioned single-file container for HFTS models.
+    A model file consists of
+        - the magic string MAGIC,
+        - the length of the header as little-endian uint32,
+        - a JSON header containing the format version, branching factors, object center of mass,
+          the parameters the HFTS was generated with, a checksum of the source mesh and the
+          layout of the data blocks,
+        - the data blocks, each aligned to DATA_ALIGNMENT bytes: the hfts array (rows [position, normal, labels])
+          and the concatenated per-level offsets tables (see hfts_generation.compute_hfts_offsets).
+    The data blocks are memory-mapped read-only, so that processes that load the same model share
+    the page cache.
+    Additionally, this module contains a cache for the intermediate results of the HFTS generation (StageCache).
+"""
+
+import glob
+import hashlib
+import json
+import os
+import struct
+import zipfile
+import numpy as np
+
+MAGIC = b'HFTSMDL\x00'
+FORMAT_VERSION = 1
+DATA_ALIGNMENT = 64
+# Number of results per stage a StageCache keeps by default
+DEFAULT_MAX_STAGE_ENTRIES = 4
+
+
+class HFTSModel(object):
+    """ An HFTS model as stored in a model file. """
+    def __init__(self, hfts, hfts_param, obj_com, offsets, generation_params=None, mesh_checksum=None):
+        self._hfts = hfts
+        self._hfts_param = np.asarray(hfts_param, dtype=int)
+        self._obj_com = np.asarray(obj_com, dtype=float)
+        self._offsets = offsets
+        self._generation_params = generation_params
+        self._mesh_checksum = mesh_checksum
+
+    def get_hfts(self):
+        return self._hfts
+
+    def get_hfts_param(self):
+        return self._hfts_param
+
+    def get_obj_com(self):
+        return self._obj_com
+
+    def get_hfts_offsets(self):
+        return self._offsets
+
+    def get_generation_params(self):
+        return self._generation_params
+
+    def get_mesh_checksum(self):
+        return self._mesh_checksum
+
+    def get_memory_size(self):
+        """ Returns the number of bytes occupied by the arrays of this model. """
+        return self._hfts.nbytes + sum(level_offsets.nbytes for level_offsets in self._offsets)
+
+    def is_up_to_date(self, mesh_checksum, generation_params):
+        """ Returns whether this model was generated from a mesh with the given checksum and
+            with the given generation parameters.
+        """
+        return self._mesh_checksum == mesh_checksum and self._generation_params == generation_params
+
+
+def compute_file_checksum(file_name, block_size=1 << 20):
+    """ Returns the sha1 hex digest of the content of the given file. """
+    hasher = hashlib.sha1()
+    with open(file_name, 'rb') as input_file:
+        block = input_file.read(block_size)
+        while block:
+            hasher.update(block)
+            block = input_file.read(block_size)
+    return hasher.hexdigest()
+
+
+def _align(position):
+    return (position + DATA_ALIGNMENT - 1) // DATA_ALIGNMENT * DATA_ALIGNMENT
+
+
+def write_hfts_model(file_name, model):
+    """ Writes the given HFTSModel to file_name. The file is first written to a temporary file
+        and then renamed, so that concurrent readers never see a partially written model.
+    """
+    hfts = np.ascontiguousarray(model.get_hfts(), dtype='<f8')
+    if len(model.get_hfts_offsets()) > 0:
+        offsets = np.concatenate(model.get_hfts_offsets()).astype('<i8')
+    else:
+        offsets = np.zeros(0, dtype='<i8')
+    header = {'version': FORMAT_VERSION,
+              'branching_factors': [int(b) for b in model.get_hfts_param()],
+              'obj_com': [float(c) for c in model.get_obj_com()],
+              'generation_params': model.get_generation_params(),
+              'mesh_checksum': model.get_mesh_checksum(),
+              'hfts': {'shape': list(hfts.shape), 'dtype': hfts.dtype.str},
+              'offsets': {'shape': list(offsets.shape), 'dtype': offsets.dtype.str}}
+    # The position of the data blocks depends on the header length, which in turn contains these positions.
+    # The header length can only grow with the positions, so iterate until it is stable.
+    header['hfts']['position'] = header['offsets']['position'] = 0
+    while True:
+        header_bytes = json.dumps(header, sort_keys=True).encode('utf-8')
+        hfts_position = _align(len(MAGIC) + 4 + len(header_bytes))
+        offsets_position = _align(hfts_position + hfts.nbytes)
+        if header['hfts']['position'] == hfts_position and header['offsets']['position'] == offsets_position:
+            break
+        header['hfts']['position'] = hfts_position
+        header['offsets']['position'] = offsets_position
+    tmp_file_name = file_name + '.tmp%i' % os.getpid()
+    with open(tmp_file_name, 'wb') as output_file:
+        output_file.write(MAGIC)
+        output_file.write(struct.pack('<I', len(header_bytes)))
+        output_file.write(header_bytes)
+        output_file.write(b'\x00' * (hfts_position - output_file.tell()))
+        output_file.write(hfts.tostring())
+        output_file.write(b'\x00' * (offsets_position - output_file.tell()))
+        output_file.write(offsets.tostring())
+    os.rename(tmp_file_name, file_name)
+
+
+def read_hfts_model(file_name):
+    """ Reads an HFTSModel from file_name. The hfts array of the returned model is a read-only memory map.
+        :raises ValueError if the file is not a model file or has an unsupported version
+    """
+    with open(file_name, 'rb') as input_file:
+        if input_file.read(len(MAGIC)) != MAGIC:
+            raise ValueError('[hfts_store::read_hfts_model] %s is not an HFTS model file' % file_name)
+        header_length = struct.unpack('<I', input_file.read(4))[0]
+        header = json.loads(input_file.read(header_length).decode('utf-8'))
+    if header['version'] != FORMAT_VERSION:
+        raise ValueError('[hfts_store::read_hfts_model] %s has version %s, supported is version %i' %
+                         (file_name, str(header['version']), FORMAT_VERSION))
+    hfts_shape = tuple(header['hfts']['shape'])
+    if hfts_shape[0] > 0:
+        hfts = np.memmap(file_name, dtype=header['hfts']['dtype'], mode='r',
+                         offset=header['hfts']['position'], shape=hfts_shape)
+    else:
+        # numpy can not map empty arrays
+        hfts = np.zeros(hfts_shape, dtype=header['hfts']['dtype'])
+    # The offsets tables are small, read them into memory
+    with open(file_name, 'rb') as input_file:
+        input_file.seek(header['offsets']['position'])
+        flat_offsets = np.fromfile(input_file, dtype=header['offsets']['dtype'],
+                                   count=header['offsets']['shape'][0]).astype(int)
+    offsets = []
+    num_nodes = 1
+    position = 0
+    for branching_factor in header['branching_factors']:
+        num_nodes *= branching_factor
+        offsets.append(flat_offsets[position:position + num_nodes + 1])
+        position += num_nodes + 1
+    return HFTSModel(hfts, header['branching_factors'], header['obj_com'], offsets,
+                     generation_params=header['generation_params'], mesh_checksum=header['mesh_checksum'])
+
+
+def compute_stage_key(parent_key, params):
+    """ Returns a key for the result of a generation stage, which is computed from the result identified by
+        parent_key using the given parameters.
+    """
+    return hashlib.sha1(json.dumps([parent_key, params], sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class StageCache(object):
+    """ Caches the results of the stages of the HFTS generation (e.g. sampled points, filtered points, labels)
+        in a directory. Each result is a dictionary of arrays stored under a key (see compute_stage_key).
+        For each stage only the max_entries_per_stage most recently stored results are kept.
+    """
+    def __init__(self, cache_dir, max_entries_per_stage=DEFAULT_MAX_STAGE_ENTRIES):
+        self._cache_dir = cache_dir
+        self._max_entries_per_stage = max_entries_per_stage
+
+    def load(self, stage, key):
+        """ Returns the result of the given stage stored under key as dictionary or None if there is none. """
+        file_name = self._get_file_name(stage, key)
+        if not os.path.isfile(file_name):
+            return None
+        try:
+            data = np.load(file_name)
+            try:
+                return dict((name, data[name]) for name in data.files)
+            finally:
+                data.close()
+        except (IOError, ValueError, zipfile.BadZipfile):
+            return None
+
+    def save(self, stage, key, **arrays):
+        """ Stores the given arrays as result of the given stage under key. Errors are ignored,
+            since the cache is only an optimization.
+        """
+        file_name = self._get_file_name(stage, key)
+        tmp_file_name = file_name + '.tmp%i' % os.getpid()
+        try:
+            if not os.path.isdir(self._cache_dir):
+                os.makedirs(self._cache_dir)
+            with open(tmp_file_name, 'wb') as output_file:
+                np.savez(output_file, **arrays)
+            os.rename(tmp_file_name, file_name)
+            # remove the least recently stored results
+            stage_files = sorted(glob.glob(os.path.join(self._cache_dir, stage + '_*.npz')), key=os.path.getmtime)
+            for old_file_name in stage_files[:-self._max_entries_per_stage]:
+                os.remove(old_file_name)
+        except (IOError, OSError):
+            pass
+
+    def _get_file_name(self, stage, key):
+        return os.path.join(self._cache_dir, '%s_%s.npz' % (stage, key))
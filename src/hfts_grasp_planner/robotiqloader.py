@@ -3,7 +3,7 @@ import transformations
 import math
 import os
 import logging
-from scipy.spatial import KDTree
+from spatial_index import load_or_build_index
 from utils import vec_angel_diff, dist_in_range
 
 # TODO this should be specified in a configuration file
@@ -197,12 +197,18 @@ class RobotiqHandKDTreeManifold:
         self._codes = None
         self._hand_configurations = None
         self._kd_tree = None
+        self._index_params = {}
         self._code_position_scale = 10.0
         self._com_center_weight = 1.0
 
-    def set_parameters(self, com_center_weight=None):
+    def set_parameters(self, com_center_weight=None, index_params=None):
         if com_center_weight is not None:
             self._com_center_weight = com_center_weight
+        if index_params is not None:
+            # see spatial_index.SpatialIndex for available parameters
+            self._index_params = index_params
+            if self._codes is not None:
+                self._kd_tree = load_or_build_index(self._codes, self._get_index_cache_prefix(), **self._index_params)
 
     def load(self):
         if os.path.exists(self._cache_file_name):
@@ -215,9 +221,13 @@ class RobotiqHandKDTreeManifold:
             self._sample_configuration_space()
             data = np.concatenate((self._codes, self._hand_configurations), axis=1)
             np.save(self._cache_file_name, data)
-        self._kd_tree = KDTree(self._codes)
+        self._kd_tree = load_or_build_index(self._codes, self._get_index_cache_prefix(), **self._index_params)
         # self.test_manifold()
 
+    def _get_index_cache_prefix(self):
+        # The KD tree is cached next to the sample data set
+        return os.path.splitext(self._cache_file_name)[0] + '_index'
+
     def _sample_configuration_space(self):
         lower_limits, upper_limits = self._or_robot.GetDOFLimits()
         #TODO can this be done in a niceer way? closing the hand all the way does not make sense
@@ -300,11 +310,55 @@ class RobotiqHandKDTreeManifold:
         normal_diff = np.linalg.norm(contact_0[3:] - contact_1[3:])
         return np.array([position_diff * self._code_position_scale, normal_diff])
 
+    def encode_grasp_batch(self, grasps):
+        """
+            Encodes the given grasps, see encode_grasp.
+            :param grasps: Array of shape (n, 3, 6) containing n grasps
+            :return: Array of shape (n, CODE_DIMENSION) containing the codes
+        """
+        grasps = np.asarray(grasps)
+        codes = np.empty((grasps.shape[0], self.CODE_DIMENSION))
+        codes[:, 0:2] = self.encode_contact_pair_batch(grasps[:, 0], grasps[:, 1])
+        codes[:, 2:4] = self.encode_contact_pair_batch(grasps[:, 0], grasps[:, 2])
+        codes[:, 4:6] = self.encode_contact_pair_batch(grasps[:, 1], grasps[:, 2])
+        return codes
+
+    def encode_contact_pair_batch(self, contacts_0, contacts_1):
+        """
+            Encodes the contact pairs (contacts_0[i], contacts_1[i]), see encode_contact_pair.
+            :param contacts_0: Array of shape (n, 6)
+            :param contacts_1: Array of shape (n, 6)
+            :return: Array of shape (n, 2)
+        """
+        position_diff = np.linalg.norm(contacts_0[:, :3] - contacts_1[:, :3], axis=1)
+        normal_diff = np.linalg.norm(contacts_0[:, 3:] - contacts_1[:, 3:], axis=1)
+        return np.column_stack((position_diff * self._code_position_scale, normal_diff))
+
     def predict_hand_conf(self, code):
+        if code is None or np.isnan(code).any():
+            # the contacts are degenerate, see RobotiqHandVirtualManifold.predict_hand_conf
+            return float('inf'), None
         distance, index = self._kd_tree.query(code)
         hand_conf = self._hand_configurations[index]
         return distance, hand_conf
 
+    def predict_hand_conf_batch(self, codes):
+        """
+            Predicts hand configurations for the given codes with a single KD tree query.
+            Like predict_hand_conf, codes containing NaN are invalid. Their distance is inf and their
+            hand configuration NaN.
+            :param codes: Array of shape (n, CODE_DIMENSION)
+            :return: tuple (distances, hand_confs) of arrays of shape (n,) and (n, DOF)
+        """
+        codes = np.asarray(codes)
+        b_valid = np.logical_not(np.isnan(codes).any(axis=1))
+        distances = np.full(codes.shape[0], np.inf)
+        hand_confs = np.full((codes.shape[0], self._hand_configurations.shape[1]), np.nan)
+        valid_distances, indices = self._kd_tree.query(codes[b_valid])
+        distances[b_valid] = valid_distances
+        hand_confs[b_valid] = self._hand_configurations[indices]
+        return distances, hand_confs
+
     def compute_grasp_quality(self, obj_com, grasp):
         """
         Computes a grasp quality for the given grasp.
@@ -326,6 +380,20 @@ class RobotiqHandKDTreeManifold:
         triangle_center = np.sum(grasp, 0)[:3] / 3.0
         return triangle_area - self._com_center_weight * np.linalg.norm(obj_com - triangle_center)
 
+    def compute_grasp_quality_batch(self, obj_com, grasps):
+        """
+        Computes the grasp quality (see compute_grasp_quality) for the given grasps.
+        :param obj_com: The center of mass of the object.
+        :param grasps: Array of shape (n, 3, 6) containing n grasps
+        :return: Array of shape (n,) containing the qualities
+        """
+        grasps = np.asarray(grasps)
+        vec_01 = grasps[:, 1, :3] - grasps[:, 0, :3]
+        vec_02 = grasps[:, 2, :3] - grasps[:, 0, :3]
+        triangle_area = np.linalg.norm(np.cross(vec_01, vec_02), axis=1)
+        triangle_center = np.sum(grasps[:, :, :3], axis=1) / 3.0
+        return triangle_area - self._com_center_weight * np.linalg.norm(obj_com - triangle_center, axis=1)
+
     def draw_contacts(self, poses, handles):
         # TODO this is hard coded for three contacts
         colors = [[1, 0, 0, 1], [0, 1, 0, 1], [0, 0, 1, 1]]
@@ -391,7 +459,8 @@ class RobotiqHandVirtualManifold:
                 and config a hand configuration that achieves the grasp, if it is feasible,
                 else config is a configuration at joint limits.
         """
-        if q is None:
+        if q is None or np.isnan(q).any():
+            # the contacts are degenerate (e.g. they have no normals)
             return float('inf'), None
         pos_residual0 = dist_in_range(q[0], self._distance_range_0)
         pos_residual1 = dist_in_range(q[1], self._distance_range_1)
@@ -419,6 +488,29 @@ class RobotiqHandVirtualManifold:
             raise ValueError('[RobotiqHandVirtualMainfold::predictHandConf] grasp encoding is incorrect')
         # Return the configuration and compute the residual of the grasp
         return self.get_pred_res(q), [joint0, joint1]
+
+    def predict_hand_conf_batch(self, codes):
+        """
+            Vectorized version of predict_hand_conf. Codes containing NaN are invalid, their residual
+            is inf and their configuration NaN.
+            :param codes - array of shape (n, 6) of encoded grasps, see encode_grasp for details.
+            :return tuple (res, configs), where res is an array of shape (n,) and configs
+                an array of shape (n, 2), see predict_hand_conf.
+        """
+        codes = np.asarray(codes)
+        b_valid = np.logical_not(np.isnan(codes).any(axis=1))
+        residuals = np.full(codes.shape[0], np.inf)
+        residuals[b_valid] = self.get_pred_res_batch(codes[b_valid])
+        configs = np.empty((codes.shape[0], 2))
+        distance_ranges = [self._distance_range_0, self._distance_range_1]
+        lin_factors = [self._lin_factor_0, self._lin_factor_1]
+        for j in range(2):
+            q = codes[:, j]
+            configs[:, j] = self._lower_limits[j] + (distance_ranges[j][1] - q) * lin_factors[j]
+            configs[q < distance_ranges[j][0], j] = self._upper_limits[j]
+            configs[q > distance_ranges[j][1], j] = self._lower_limits[j]
+        configs[np.logical_not(b_valid)] = np.nan
+        return residuals, configs
     
     def compute_grasp_quality(self, obj_com, grasp):
         """
@@ -456,7 +548,21 @@ class RobotiqHandVirtualManifold:
         # # and at the same time would like to spread the contacts apart, so that
         # # we have a high resistance against external torques.
         # return dist_10 + dist_c2 - self._com_center_weight * d
-        
+
+    def compute_grasp_quality_batch(self, obj_com, grasps):
+        """
+        Computes the grasp quality (see compute_grasp_quality) for the given grasps.
+        :param obj_com: The center of mass of the object.
+        :param grasps: Array of shape (n, 3, 6) containing n grasps
+        :return: Array of shape (n,) containing the qualities
+        """
+        grasps = np.asarray(grasps)
+        vec_01 = grasps[:, 1, :3] - grasps[:, 0, :3]
+        vec_02 = grasps[:, 2, :3] - grasps[:, 0, :3]
+        triangle_area = np.linalg.norm(np.cross(vec_01, vec_02), axis=1)
+        triangle_center = np.sum(grasps[:, :, :3], axis=1) / 3.0
+        return triangle_area - self._com_center_weight * np.linalg.norm(obj_com - triangle_center, axis=1)
+
     def get_pred_res(self, q):
         # pos_residual0 = dist_in_range(q[0], self._distance_range_0)
         # pos_residual1 = dist_in_range(q[1], self._distance_range_1)
@@ -473,6 +579,23 @@ class RobotiqHandVirtualManifold:
         assert r >= 0.0
         return r
 
+    def get_pred_res_batch(self, codes):
+        """
+            Vectorized version of get_pred_res.
+            :param codes: array of shape (n, 6) of encoded grasps
+            :return: array of shape (n,) of residuals
+        """
+        codes = np.asarray(codes)
+        pos_residual0 = self.exp_distance_range_batch(codes[:, 0], self._distance_range_0)
+        pos_residual1 = self.exp_distance_range_batch(codes[:, 1], self._distance_range_1)
+        r = self._pos_reach_weight * (pos_residual0 + pos_residual1) + \
+            self._f01_parallelism_weight * (1.0 - codes[:, 2]) + \
+            self._grasp_symmetry_weight * (1.0 + codes[:, 3]) + \
+            self._grasp_flatness_weight * np.abs(codes[:, 4]) + \
+            self._f2_centralism_weight * np.abs(codes[:, 5])
+        assert np.all(r >= 0.0)
+        return r
+
     @staticmethod
     def encode_grasp(grasp):
         """
@@ -520,6 +643,39 @@ class RobotiqHandVirtualManifold:
         # angle_diff_201 = vec_angel_diff(grasp[2, 3:], -avg_normal_01)
         # return [distance_10, distance_c2, angle_diff_01, angle_diff_201]
 
+    @staticmethod
+    def encode_grasp_batch(grasps):
+        """
+            Vectorized version of encode_grasp.
+        :param grasps: Array of shape (n, 3, 6) containing n grasps, see encode_grasp.
+        :return: Array of shape (n, 6) containing the grasp encodings, see encode_grasp.
+        """
+        grasps = np.asarray(grasps)
+        positions, normals = grasps[:, :, :3], grasps[:, :, 3:]
+        vec_01 = positions[:, 1] - positions[:, 0]
+        vec_02 = positions[:, 2] - positions[:, 0]
+        center_01 = (positions[:, 0] + positions[:, 1]) / 2.0
+        vec_c2 = positions[:, 2] - center_01
+        avg_normal_01 = (normals[:, 0] + normals[:, 1]) / 2.
+        codes = np.empty((grasps.shape[0], 6))
+        distance_10 = np.linalg.norm(vec_01, axis=1)
+        codes[:, 0] = distance_10
+        codes[:, 1] = np.linalg.norm(vec_c2, axis=1)
+        codes[:, 2] = np.sum(normals[:, 0] * normals[:, 1], axis=1)
+        codes[:, 3] = np.sum(normals[:, 2] * avg_normal_01, axis=1)
+        helper_normals = np.cross(normals[:, 0], normals[:, 1])
+        # If normals 0 and 1 are in the same plane, use normal 0 instead
+        b_coplanar = np.linalg.norm(helper_normals, axis=1) == 0.0
+        helper_normals[b_coplanar] = normals[b_coplanar, 0]
+        codes[:, 4] = np.sum(helper_normals * normals[:, 2], axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            codes[:, 5] = np.sum(vec_01 / distance_10[:, np.newaxis] * vec_02, axis=1) / distance_10 - 0.5
+        # Same NaN handling as in encode_grasp
+        b_nan = np.isnan(codes[:, 4])
+        codes[b_nan, 4] = codes[b_nan, 2] + codes[b_nan, 3]
+        codes[np.isnan(codes[:, 5]), 5] = 0.0
+        return codes
+
     @staticmethod
     def exp_distance_range(dist, distance_range):
         if dist < distance_range[0]:
@@ -528,3 +684,14 @@ class RobotiqHandVirtualManifold:
             return math.exp(dist - distance_range[1]) - 1.0
         else:
             return 0.0
+
+    @staticmethod
+    def exp_distance_range_batch(dists, distance_range):
+        """ Vectorized version of exp_distance_range. """
+        dists = np.asarray(dists)
+        result = np.zeros(dists.shape)
+        b_below = dists < distance_range[0]
+        b_above = dists > distance_range[1]
+        result[b_below] = np.exp(-(dists[b_below] - distance_range[0])) - 1.0
+        result[b_above] = np.exp(dists[b_above] - distance_range[1]) - 1.0
+        return result
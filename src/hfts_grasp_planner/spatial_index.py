@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+""" This module contains a nearest neighbor index with selectable backends
+    that is used for object point clouds and hand manifolds. """
+
+import cPickle as pickle
+import glob
+import hashlib
+import logging
+import os
+import numpy as np
+import scipy
+import scipy.spatial
+
+# Version of the on-disk format of cached indices, see load_or_build_index
+INDEX_CACHE_VERSION = 3
+
+DEFAULT_INDEX_PARAMS = {'backend': 'ckdtree',
+                        'leaf_size': 16,
+                        'workers': -1}
+
+# Name of the parallelization keyword of each cKDTree query method, see _get_parallel_keyword
+_parallel_keywords = {}
+
+
+def _get_parallel_keyword(tree, method_name, probe_args):
+    """ Returns the name of the keyword argument that sets the number of threads of the given cKDTree
+        method: 'workers' for scipy >= 1.6, 'n_jobs' for older versions, or None if it is not supported.
+        The keyword is determined once per process by a query with the valid arguments probe_args,
+        which can therefore only fail due to the keyword.
+    """
+    if method_name not in _parallel_keywords:
+        method = getattr(tree, method_name)
+        _parallel_keywords[method_name] = None
+        for keyword in ['workers', 'n_jobs']:
+            try:
+                method(*probe_args, **{keyword: 1})
+            except TypeError:
+                continue
+            _parallel_keywords[method_name] = keyword
+            break
+    return _parallel_keywords[method_name]
+
+
+class SpatialIndex(object):
+    """ Nearest neighbor index over a set of points.
+        Supported backends are:
+            'ckdtree' - scipy.spatial.cKDTree (compiled, queries of many points run in parallel)
+            'kdtree' - scipy.spatial.KDTree (pure Python, mainly for comparison)
+        Both backends support the same query interface as scipy.spatial.KDTree.
+    """
+    BACKENDS = ['ckdtree', 'kdtree']
+
+    def __init__(self, points, backend=None, leaf_size=None, workers=None, tree=None):
+        """ Builds a new index.
+            :param points: (n, d) array of points
+            :param backend: (optional) name of the backend to use, see BACKENDS
+            :param leaf_size: (optional) maximal number of points in a leaf of the tree
+            :param workers: (optional) number of threads to use for queries of multiple points (-1 for all cores),
+                only used by the 'ckdtree' backend
+            :param tree: (optional) a tree of the given backend that is already built over points (see load)
+        """
+        if backend is None:
+            backend = DEFAULT_INDEX_PARAMS['backend']
+        if leaf_size is None:
+            leaf_size = DEFAULT_INDEX_PARAMS['leaf_size']
+        if workers is None:
+            workers = DEFAULT_INDEX_PARAMS['workers']
+        self._points = np.asarray(points, dtype=float)
+        # whether the points are memory-mapped from a file and hence shared between processes (see load)
+        self._b_mapped = False
+        self._backend = backend
+        self._leaf_size = leaf_size
+        self._workers = workers
+        if tree is not None:
+            self._tree = tree
+        elif backend == 'ckdtree':
+            self._tree = scipy.spatial.cKDTree(self._points, leafsize=leaf_size)
+        elif backend == 'kdtree':
+            self._tree = scipy.spatial.KDTree(self._points, leafsize=leaf_size)
+        else:
+            raise ValueError('[SpatialIndex] Unknown backend %s. Supported are %s' % (str(backend),
+                                                                                     str(self.BACKENDS)))
+        self._init_parallel_kwargs()
+
+    def get_backend(self):
+        return self._backend
+
+    def get_leaf_size(self):
+        return self._leaf_size
+
+    def save(self, file_prefix):
+        """ Saves this index to the files file_prefix.npy (points) and file_prefix.tree (tree structure, i.e.
+            the state of the cKDTree without its points). Files are first written to temporary files and then
+            renamed, so that concurrent readers never see partially written files.
+            Only the 'ckdtree' backend can be saved.
+        """
+        if self._backend != 'ckdtree':
+            raise ValueError('[SpatialIndex::save] Only the ckdtree backend can be saved')
+        state = list(self._tree.__getstate__())
+        # the points are stored separately, so that they can be memory-mapped on load
+        data_pos = [i for i, value in enumerate(state) if isinstance(value, np.ndarray) and
+                    value.shape == self._points.shape and np.array_equal(value, self._points)][0]
+        state[data_pos] = None
+        for file_name, write_fn in [(file_prefix + '.npy',
+                                     lambda f: np.save(f, np.ascontiguousarray(self._points, dtype=float))),
+                                    (file_prefix + '.tree',
+                                     lambda f: pickle.dump((self._leaf_size, data_pos, state), f,
+                                                           pickle.HIGHEST_PROTOCOL))]:
+            tmp_file_name = file_name + '.tmp%i' % os.getpid()
+            with open(tmp_file_name, 'wb') as tmp_file:
+                write_fn(tmp_file)
+            os.rename(tmp_file_name, file_name)
+
+    @staticmethod
+    def load(file_prefix, workers=None):
+        """ Loads an index saved with save without rebuilding the tree. The points are memory-mapped
+            (copy-on-write, since cKDTree requires writable data) and the tree is bound to them, so that
+            processes that load the same index share the points. Only the tree structure is private.
+            :param file_prefix: prefix of the files the index was saved to
+            :param workers: (optional) see __init__
+        """
+        points = np.load(file_prefix + '.npy', mmap_mode='c')
+        with open(file_prefix + '.tree', 'rb') as tree_file:
+            leaf_size, data_pos, state = pickle.load(tree_file)
+        state[data_pos] = points
+        tree = scipy.spatial.cKDTree.__new__(scipy.spatial.cKDTree)
+        tree.__setstate__(tuple(state))
+        index = SpatialIndex(points, backend='ckdtree', leaf_size=leaf_size, workers=workers, tree=tree)
+        # some scipy versions copy the data when restoring a tree
+        index._b_mapped = np.may_share_memory(tree.data, points)
+        return index
+
+    def get_points(self):
+        return self._points
+
+    def get_memory_size(self):
+        """ Returns the approximate number of bytes private to this process, i.e. the tree structure
+            (about one index per point) and the points, unless they are memory-mapped.
+        """
+        tree_size = self._points.shape[0] * np.dtype(np.intp).itemsize
+        if self._b_mapped:
+            return tree_size
+        return tree_size + self._points.nbytes
+
+    def query(self, x, k=1, distance_upper_bound=np.inf):
+        """ Returns the distances to and indices of the k nearest neighbors of x.
+            :param x: a single point or an (m, d) array of points
+            :param k: number of neighbors
+            :param distance_upper_bound: only return neighbors within this distance
+            :return: tuple (distances, indices) as returned by scipy.spatial.KDTree.query
+        """
+        return self._tree.query(x, k=k, distance_upper_bound=distance_upper_bound, **self._parallel_kwargs['query'])
+
+    def query_ball_point(self, x, r):
+        """ Returns the indices of all points within distance r of x.
+            :param x: a single point or an (m, d) array of points
+            :param r: radius
+            :return: a list of indices if x is a single point, else an array of m such lists
+        """
+        return self._tree.query_ball_point(x, r, **self._parallel_kwargs['query_ball_point'])
+
+    def _init_parallel_kwargs(self):
+        # keyword arguments that set the number of threads of each query method
+        self._parallel_kwargs = {'query': {}, 'query_ball_point': {}}
+        if self._backend != 'ckdtree' or self._points.shape[0] == 0:
+            return
+        probe_point = np.array(self._points[0])
+        for method_name, probe_args in [('query', (probe_point, 1)), ('query_ball_point', (probe_point, 0.0))]:
+            keyword = _get_parallel_keyword(self._tree, method_name, probe_args)
+            if keyword is not None:
+                self._parallel_kwargs[method_name] = {keyword: self._workers}
+
+
+def compute_index_key(points, backend, leaf_size):
+    """ Computes a hash of the given points and index parameters that identifies a cached index. """
+    points = np.ascontiguousarray(points, dtype=float)
+    hasher = hashlib.sha1(points)
+    hasher.update(str((INDEX_CACHE_VERSION, points.shape, backend, leaf_size, scipy.__version__)).encode('utf-8'))
+    return hasher.hexdigest()
+
+
+def load_or_build_index(points, cache_prefix=None, **index_params):
+    """ Returns a SpatialIndex for the given points. If cache_prefix is given, the index is loaded from the
+        files cache_prefix_<key>.npy/.tree (see SpatialIndex.load), where key is a hash of the points and the
+        index parameters. If no such files exist, the index is built and saved there (replacing indices of
+        outdated data). Only the 'ckdtree' backend is cached.
+        :param points: (n, d) array of points
+        :param cache_prefix: (optional) path and file name prefix for cached indices
+        :param index_params: parameters for SpatialIndex
+        :return: SpatialIndex
+    """
+    backend = index_params.get('backend', None) or DEFAULT_INDEX_PARAMS['backend']
+    if cache_prefix is None or backend != 'ckdtree':
+        return SpatialIndex(points, **index_params)
+    leaf_size = index_params.get('leaf_size', None) or DEFAULT_INDEX_PARAMS['leaf_size']
+    file_prefix = cache_prefix + '_' + compute_index_key(points, backend, leaf_size)
+    if os.path.exists(file_prefix + '.npy') and os.path.exists(file_prefix + '.tree'):
+        try:
+            return SpatialIndex.load(file_prefix, workers=index_params.get('workers', None))
+        except Exception as e:
+            logging.warn('[spatial_index::load_or_build_index] Could not load cached index %s: %s' %
+                         (file_prefix, str(e)))
+    index = SpatialIndex(points, **index_params)
+    try:
+        for old_file_name in glob.glob(cache_prefix + '_*.npy') + glob.glob(cache_prefix + '_*.tree'):
+            os.remove(old_file_name)
+        index.save(file_prefix)
+    except (IOError, OSError, AttributeError, IndexError) as e:
+        # AttributeError and IndexError if the cKDTree of this scipy version can not be pickled
+        logging.warn('[spatial_index::load_or_build_index] Could not save index %s: %s' % (file_prefix, str(e)))
+    return index
@@ -6,7 +6,8 @@ from geometry_msgs.msg import Point32
 import std_msgs.msg
 import rospy
 from sklearn.cluster import KMeans as KMeans
-import math, copy, os, itertools
+import math, copy, os, itertools, hashlib, time, mmap
+from collections import OrderedDict
 import matplotlib.pyplot as plt
 from sklearn.neighbors import KDTree
 from stl import mesh as stl_mesh_module
@@ -14,6 +15,7 @@ from abc import ABCMeta, abstractmethod
 import openravepy as orpy
 import hfts_grasp_planner.external.transformations as transformations
 import hfts_grasp_planner.hfts_generation as hfts_generation
+import hfts_grasp_planner.hfts_store as hfts_store
 from scipy.spatial import ConvexHull
 
 DEFAULT_HFTS_GENERATION_PARAMS = {'max_normal_variance': 0.2,
@@ -22,7 +24,157 @@ DEFAULT_HFTS_GENERATION_PARAMS = {'max_normal_variance': 0.2,
                                   'max_num_points': 10000,
                                   'position_weight': 2,
                                   'branching_factor': 4,
-                                  'first_level_branching_factor': 3}
+                                  'first_level_branching_factor': 3,
+                                  'sampling_method': 'slices',
+                                  'sampling_seed': 0,
+                                  'interpolate_normals': False,
+                                  'down_sampling_method': 'random',
+                                  'clustering_method': 'kmeans',
+                                  'clustering_n_init': None,
+                                  'clustering_max_iter': None,
+                                  'clustering_seed': None,
+                                  'balanced_clusters': False}
+
+# The HFTS generation consists of the stages sampling (mesh -> points), filtering (points -> filtered points) and
+# clustering (filtered points -> labels). These are the parameters each stage depends on.
+SAMPLING_PARAMS = ['contact_density', 'sampling_method', 'sampling_seed', 'interpolate_normals']
+FILTERING_PARAMS = ['min_contact_patch_radius', 'max_normal_variance', 'max_num_points', 'down_sampling_method']
+CLUSTERING_PARAMS = ['position_weight', 'branching_factor', 'first_level_branching_factor', 'clustering_method',
+                     'clustering_n_init', 'clustering_max_iter', 'clustering_seed', 'balanced_clusters']
+
+# Objects given as point clouds (see ObjectFileIO.add_point_cloud) get ids with this prefix
+POINT_CLOUD_ID_PREFIX = 'pointCloud_'
+# Default maximal number of levels and time budget in seconds of HFTS generated from point clouds
+DEFAULT_POINT_CLOUD_MAX_LEVELS = 3
+DEFAULT_POINT_CLOUD_TIME_BUDGET = 1.0
+
+# Default memory budget in bytes of the ObjectFileIO cache of HFTS models
+DEFAULT_HFTS_CACHE_SIZE = 256 * 1024 * 1024
+
+
+class LRUCache(object):
+    """ A least recently used cache with a memory budget.
+        Every entry has a size (e.g. in bytes). Whenever the total size of all entries exceeds the budget,
+        the least recently used entries are evicted. The most recently added entry is never evicted,
+        even if it alone exceeds the budget.
+    """
+    def __init__(self, max_size, on_evict=None):
+        """
+            :param max_size: the memory budget
+            :param on_evict: (optional) function on_evict(key, value) that is called for every evicted
+                or removed entry
+        """
+        self._max_size = max_size
+        self._on_evict = on_evict
+        self._entries = OrderedDict()
+        self._total_size = 0
+        self._num_hits = 0
+        self._num_misses = 0
+        self._num_evictions = 0
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def keys(self):
+        """ Returns the keys of all entries, from least to most recently used. """
+        return list(self._entries.keys())
+
+    def items(self):
+        """ Returns (key, value) pairs of all entries, from least to most recently used.
+            Entries are not marked as used.
+        """
+        return [(key, value) for key, (value, size) in self._entries.items()]
+
+    def get(self, key, default=None):
+        """ Returns the value stored for key and marks it as most recently used.
+            Returns default if there is no such entry.
+        """
+        if key not in self._entries:
+            self._num_misses += 1
+            return default
+        self._num_hits += 1
+        value, size = self._entries.pop(key)
+        self._entries[key] = (value, size)
+        return value
+
+    def put(self, key, value, size=0):
+        """ Adds the given value as most recently used entry, replacing any previous entry for key. """
+        if key in self._entries:
+            self.remove(key)
+        self._entries[key] = (value, size)
+        self._total_size += size
+        self._evict()
+
+    def update_size(self, key, size):
+        """ Sets the size of the entry for key (e.g. after its value grew) and marks it as most recently used. """
+        if key in self._entries:
+            value, old_size = self._entries.pop(key)
+            self._entries[key] = (value, size)
+            self._total_size += size - old_size
+            self._evict()
+
+    def remove(self, key):
+        """ Removes the entry for key, if there is any. """
+        if key in self._entries:
+            value, size = self._entries.pop(key)
+            self._total_size -= size
+            if self._on_evict is not None:
+                self._on_evict(key, value)
+
+    def clear(self):
+        for key in self.keys():
+            self.remove(key)
+
+    def set_max_size(self, max_size):
+        self._max_size = max_size
+        self._evict()
+
+    def get_max_size(self):
+        return self._max_size
+
+    def get_size(self):
+        return self._total_size
+
+    def get_stats(self):
+        """ Returns a dictionary with the number of hits, misses and evictions, the number of entries and
+            their total size.
+        """
+        return {'hits': self._num_hits, 'misses': self._num_misses, 'evictions': self._num_evictions,
+                'num_entries': len(self._entries), 'size': self._total_size}
+
+    def _evict(self):
+        while self._total_size > self._max_size and len(self._entries) > 1:
+            self._num_evictions += 1
+            self.remove(next(iter(self._entries)))
+
+
+def is_memory_mapped(array):
+    """ Returns whether the given numpy array is (a view of) a memory-mapped file. """
+    while array is not None:
+        if isinstance(array, (np.memmap, mmap.mmap)):
+            return True
+        array = getattr(array, 'base', None)
+    return False
+
+
+def compute_memory_size(*values):
+    """ Returns the number of bytes of all numpy arrays in the given values, which may be
+        arrays or (nested) lists, tuples and dictionaries of arrays. Other values are ignored.
+        Memory-mapped arrays are not counted, since their pages are shared and owned by whoever mapped them.
+    """
+    size = 0
+    for value in values:
+        if isinstance(value, np.ndarray):
+            if not is_memory_mapped(value):
+                size += value.nbytes
+        elif isinstance(value, (list, tuple)):
+            size += compute_memory_size(*value)
+        elif isinstance(value, dict):
+            size += compute_memory_size(*value.values())
+    return size
 
 
 class ObjectIO(object):
@@ -36,11 +188,41 @@ class ObjectIO(object):
     def get_openrave_file_name(self, obj_id):
         pass
 
+    def get_stored_hfts(self, obj_id, b_reload=False):
+        """ Returns the hfts of the given object as it was last provided by get_hfts, without checking whether
+            it is up to date or generating it. This is used by processes that share the data base with the one
+            that generates hftss, e.g. the workers of HFTSSampler.sample_grasps.
+            :param b_reload: if True, the hfts is not taken from an in-memory cache
+        """
+        return self.get_hfts(obj_id)
+
+    def get_index_cache_prefix(self, obj_id):
+        """ Returns a path and file name prefix under which spatial indices of the object
+            can be cached (see spatial_index.load_or_build_index) or None, if they should not be cached.
+        """
+        return None
+
+    def get_grasp_simulations_file_name(self, obj_id):
+        """ Returns the file name under which the results of grasp simulations on the object can be
+            persisted (see HFTSSampler.set_parameters) or None, if they should not be persisted.
+        """
+        return None
+
 
 class ObjectFileIO(ObjectIO):
     def __init__(self, data_path, var_filter=True,
                  hfts_generation_parameters=DEFAULT_HFTS_GENERATION_PARAMS,
-                 max_num_points=10000):
+                 max_num_points=10000, hfts_cache_size=DEFAULT_HFTS_CACHE_SIZE, num_generation_workers=1,
+                 num_filter_processes=None):
+        """
+            :param data_path: path to the object data base
+            :param var_filter: whether to filter points with high normal variance before generating an hfts
+            :param hfts_generation_parameters: see DEFAULT_HFTS_GENERATION_PARAMS
+            :param hfts_cache_size: memory budget in bytes for hfts models kept in memory
+            :param num_generation_workers: number of threads used to generate an hfts
+            :param num_filter_processes: number of processes used to filter points, see
+                hfts_generation.filter_unsmooth_points (None for its default)
+        """
         self._data_path = data_path
         self._b_var_filter = var_filter
         self._hfts_generation_params = hfts_generation_parameters
@@ -48,41 +230,85 @@ class ObjectFileIO(ObjectIO):
         self._last_obj_id = None
         self._last_hfts = None
         self._last_hfts_param = None
+        self._last_hfts_offsets = None
         self._last_obj_com = None
+        self._hfts_cache = LRUCache(hfts_cache_size)
+        self._num_generation_workers = num_generation_workers
+        self._num_filter_processes = num_filter_processes
 
     def get_points(self, obj_id, b_filter=None):
+        points, com, key = self._get_staged_points(obj_id, b_filter)
+        return points, com
+
+    def _get_staged_points(self, obj_id, b_filter=None, mesh_checksum=None):
+        """ Returns the (filtered) contact points of the given object, its center of mass and a key
+            that identifies the points. The results of sampling and filtering are cached per object,
+            keyed by the mesh and the parameters they depend on.
+        """
         if b_filter is None:
             b_filter = self._b_var_filter
+        if mesh_checksum is None:
+            mesh_checksum = self._compute_mesh_checksum(obj_id)
+        if mesh_checksum is None:
+            rospy.logerr('[ObjectFileIO] Failed to load mesh for object ' + obj_id)
+            return None, None, None
+        stage_cache = self._get_stage_cache(obj_id)
+        key = hfts_store.compute_stage_key(mesh_checksum, self._get_generation_params(SAMPLING_PARAMS))
+        cached_result = stage_cache.load('points', key)
+        if cached_result is not None:
+            points = cached_result['points']
+        else:
+            points = self._sample_points(obj_id)
+            if points is None:
+                return None, None, None
+            stage_cache.save('points', key, points=points)
+        com = np.mean(points[:, :3], axis=0)
+        if b_filter:
+            key = hfts_store.compute_stage_key(key, self._get_generation_params(FILTERING_PARAMS))
+            cached_result = stage_cache.load('filtered', key)
+            if cached_result is not None:
+                points = cached_result['points']
+            else:
+                points = self._filter_points(points)
+                stage_cache.save('filtered', key, points=points)
+        return points, com, key
+
+    def _filter_points(self, points):
+        """ Removes points with high normal variance and down samples the remaining ones. """
+        patch_size = extract_hfts_gen_parameter(self._hfts_generation_params, 'min_contact_patch_radius')
+        max_variance = extract_hfts_gen_parameter(self._hfts_generation_params, 'max_normal_variance')
+        points = hfts_generation.filter_unsmooth_points(points, radius=patch_size, max_variance=max_variance,
+                                                        num_processes=self._num_filter_processes)
+        max_num_points = extract_hfts_gen_parameter(self._hfts_generation_params, 'max_num_points')
+        down_sampling_method = extract_hfts_gen_parameter(self._hfts_generation_params, 'down_sampling_method')
+        return hfts_generation.down_sample_points(points, max_num_points, method=down_sampling_method)
+
+    def _sample_points(self, obj_id):
         obj_file = self._data_path + '/' + obj_id + '/objectModel'
         file_extension = self.get_obj_file_extension(obj_id)
         points = None
         contact_density = extract_hfts_gen_parameter(self._hfts_generation_params, 'contact_density')
+        sampling_method = extract_hfts_gen_parameter(self._hfts_generation_params, 'sampling_method')
+        sampling_seed = extract_hfts_gen_parameter(self._hfts_generation_params, 'sampling_seed')
         if file_extension == '.ply':
+            b_interpolate_normals = extract_hfts_gen_parameter(self._hfts_generation_params, 'interpolate_normals')
             points = hfts_generation.create_contact_points_from_ply(file_name=obj_file + file_extension,
-                                                                    density=contact_density)
+                                                                    density=contact_density,
+                                                                    method=sampling_method, seed=sampling_seed,
+                                                                    b_interpolate_normals=b_interpolate_normals)
         elif file_extension == '.stl':
             points = hfts_generation.create_contact_points_from_stl(file_name=obj_file + file_extension,
-                                                                    density=contact_density)
+                                                                    density=contact_density,
+                                                                    method=sampling_method, seed=sampling_seed)
         # TODO read point cloud if there no files stored.
         # rospy.logwarn('No previous file found in the database, will proceed with raw point cloud instead.')
-
-        if points is not None:
-            com = np.mean(points[:, :3], axis=0)
-            if b_filter:
-                patch_size = extract_hfts_gen_parameter(self._hfts_generation_params,
-                                                        'min_contact_patch_radius')
-                max_variance = extract_hfts_gen_parameter(self._hfts_generation_params,
-                                                          'max_normal_variance')
-                points = hfts_generation.filter_unsmooth_points(points,
-                                                                radius=patch_size,
-                                                                max_variance=max_variance)
-                max_num_points = extract_hfts_gen_parameter(self._hfts_generation_params, 'max_num_points')
-                points = hfts_generation.down_sample_points(points, max_num_points)
-        else:
+        if points is None:
             rospy.logerr('[ObjectFileIO] Failed to load mesh from ' + str(file_extension) +
                          ' file for object ' + obj_id)
-            com = None
-        return points, com
+        return points
+
+    def _get_stage_cache(self, obj_id):
+        return hfts_store.StageCache(self._data_path + '/' + obj_id + '/hftsStages')
 
     def get_obj_file_extension(self, obj_id):
         obj_file = self._data_path + '/' + obj_id + '/objectModel'
@@ -95,7 +321,13 @@ class ObjectFileIO(ObjectIO):
         rospy.logerr('[ObjectFileIO::get_obj_file_extension] No compatible file found with prefix name ' + obj_file)
         return None
 
+    def get_index_cache_prefix(self, obj_id):
+        return self._data_path + '/' + obj_id + '/objectIndex'
+
     def get_openrave_file_name(self, obj_id):
+        if self._is_point_cloud(obj_id):
+            # point clouds have no mesh
+            return None
         file_extension = self.get_obj_file_extension(obj_id)
         if file_extension is not None:
             return self._data_path + '/' + obj_id + '/' + 'objectModel' + file_extension
@@ -106,28 +338,153 @@ class ObjectFileIO(ObjectIO):
         return None
 
     def get_hfts(self, obj_id, force_new=False):
-        # Check whether we have an HFTS for this object in memory
-        if self._last_obj_id != obj_id or force_new:
-            # If not, update
-            b_success = self._update_hfts(obj_id, force_new)
-            if not b_success:
+        if not self._load_hfts(obj_id, force_new):
+            return None, None, None
+        return self._last_hfts, self._last_hfts_param.astype(int), self._last_obj_com
+
+    def get_stored_hfts(self, obj_id, b_reload=False):
+        model = None if b_reload else self._hfts_cache.get(obj_id)
+        if model is None:
+            model_file = self.get_hfts_model_file_name(obj_id)
+            try:
+                model = hfts_store.read_hfts_model(model_file)
+            except (ValueError, KeyError, IOError) as e:
+                rospy.logerr('[ObjectFileIO::get_stored_hfts] Could not read HFTS model %s: %s' %
+                             (model_file, str(e)))
                 return None, None, None
+            self._hfts_cache.put(obj_id, model, size=model.get_memory_size())
+        self._set_last_hfts(obj_id, model)
         return self._last_hfts, self._last_hfts_param.astype(int), self._last_obj_com
 
-    def _read_hfts(self, obj_id, hfts_file, hfts_param_file, obj_com_file):
+    def get_hfts_offsets(self, obj_id, force_new=False):
+        """ Returns the offsets table of the hfts of the given object, see hfts_generation.compute_hfts_offsets.
+            The rows of the hfts returned by get_hfts are sorted by labels, so that the points of the node
+            with flat index i on level l are hfts[offsets[l][i]:offsets[l][i + 1]].
+        """
+        if not self._load_hfts(obj_id, force_new):
+            return None
+        return self._last_hfts_offsets
+
+    def get_cache_stats(self):
+        """ Returns statistics of the hfts cache, see LRUCache.get_stats. """
+        return self._hfts_cache.get_stats()
+
+    def set_cache_size(self, max_size):
+        """ Sets the memory budget in bytes for hfts models kept in memory. """
+        self._hfts_cache.set_max_size(max_size)
+
+    def is_hfts_up_to_date(self, obj_id):
+        """ Returns whether the database contains an hfts of the given object that was generated from its
+            current mesh with the current generation parameters.
+        """
+        model_file = self.get_hfts_model_file_name(obj_id)
+        if not os.path.isfile(model_file):
+            return False
+        try:
+            model = hfts_store.read_hfts_model(model_file)
+        except (ValueError, KeyError, IOError):
+            return False
+        if self._is_point_cloud(obj_id):
+            # the id of a point cloud is derived from its generation parameters, see add_point_cloud
+            return True
+        return model.is_up_to_date(self._compute_mesh_checksum(obj_id), self._get_generation_params())
+
+    def get_hfts_model_file_name(self, obj_id):
+        return self._data_path + '/' + obj_id + '/hftsModel.hfts'
+
+    def get_grasp_simulations_file_name(self, obj_id):
+        return self._data_path + '/' + obj_id + '/graspSimulations.pkl'
+
+    def get_hfts_generation_parameters(self):
+        """ Returns all hfts generation parameters, including defaults for parameters that are not set. """
+        return self._get_generation_params()
+
+    def _load_hfts(self, obj_id, force_new=False):
+        """ Makes the hfts of the given object the current one. The hfts is taken from the cache,
+            if possible, else it is read from the database or generated.
+        """
+        model = None
+        if not force_new:
+            model = self._hfts_cache.get(obj_id)
+        if model is None:
+            model = self._update_hfts(obj_id, force_new)
+            if model is None:
+                return False
+            self._hfts_cache.put(obj_id, model, size=model.get_memory_size())
+        self._set_last_hfts(obj_id, model)
+        return True
+
+    def _read_hfts(self, obj_id, model_file, mesh_checksum, generation_params):
+        """ Reads the HFTS model of the given object from model_file. If there is no model file, but
+            hfts files of older versions (hfts.npy, hftsParam.npy, objCOM.npy), these are migrated to a model file.
+            :return HFTSModel or None, if there is no (readable) model
+        """
+        if os.path.exists(model_file) and os.path.isfile(model_file):
+            try:
+                return hfts_store.read_hfts_model(model_file)
+            except (ValueError, KeyError, IOError) as e:
+                rospy.logwarn('[ObjectFileIO::_read_hfts] Could not read HFTS model %s: %s' % (model_file, str(e)))
+                return None
+        hfts_file = self._data_path + '/' + obj_id + '/hfts.npy'
+        hfts_param_file = self._data_path + '/' + obj_id + '/hftsParam.npy'
+        obj_com_file = self._data_path + '/' + obj_id + '/objCOM.npy'
         if os.path.exists(hfts_file) and os.path.isfile(hfts_file) \
                 and os.path.exists(hfts_param_file) and os.path.isfile(hfts_param_file) \
                 and os.path.exists(obj_com_file) and os.path.isfile(obj_com_file):
-            self._last_obj_id = obj_id
-            self._last_hfts = np.load(hfts_file)
-            self._last_hfts_param = np.load(hfts_param_file)
-            self._last_obj_com = np.load(obj_com_file)
-            return True
-        return False
+            # Old versions neither stored the generation parameters nor the mesh the hfts was generated from,
+            # so we have to assume the hfts is up to date.
+            rospy.logwarn('[ObjectFileIO::_read_hfts] Migrating HFTS files of object %s to %s. ' % (obj_id, model_file) +
+                          'Delete them to regenerate the HFTS with the current parameters.')
+            hfts = np.load(hfts_file)
+            hfts_param = np.load(hfts_param_file)
+            # HFTS files written by older versions are not sorted by labels
+            if not hfts_generation.is_hfts_sorted(hfts, hfts_param):
+                hfts = hfts_generation.sort_hfts(hfts, hfts_param)
+            model = hfts_store.HFTSModel(hfts, hfts_param, np.load(obj_com_file),
+                                         hfts_generation.compute_hfts_offsets(hfts, hfts_param),
+                                         generation_params=generation_params, mesh_checksum=mesh_checksum)
+            return self._write_hfts(model_file, model)
+        return None
+
+    def _write_hfts(self, model_file, model):
+        """ Writes the given model to model_file and returns the memory-mapped model.
+            If writing fails, the given model is returned.
+        """
+        try:
+            hfts_store.write_hfts_model(model_file, model)
+            return hfts_store.read_hfts_model(model_file)
+        except (IOError, OSError) as e:
+            rospy.logwarn('[ObjectFileIO::_write_hfts] Could not write HFTS model %s: %s' % (model_file, str(e)))
+            return model
+
+    def _get_generation_params(self, names=None):
+        """ Returns the parameters with the given names or, by default, all parameters that influence
+            the hfts generation.
+        """
+        if names is not None:
+            return dict((name, extract_hfts_gen_parameter(self._hfts_generation_params, name)) for name in names)
+        params = self._get_generation_params(DEFAULT_HFTS_GENERATION_PARAMS.keys())
+        params['var_filter'] = self._b_var_filter
+        return params
+
+    def _is_point_cloud(self, obj_id):
+        """ Returns whether the given object was added with add_point_cloud, i.e. has no mesh. """
+        return obj_id.startswith(POINT_CLOUD_ID_PREFIX)
+
+    def _compute_mesh_checksum(self, obj_id):
+        if self._is_point_cloud(obj_id):
+            return None
+        file_extension = self.get_obj_file_extension(obj_id)
+        if file_extension is None:
+            return None
+        return hfts_store.compute_file_checksum(self._data_path + '/' + obj_id + '/objectModel' + file_extension)
 
     def set_hfts_generation_parameters(self, params):
         if type(params) is not dict:
             raise TypeError('ObjectFileIO::set_hfts_generation_parameters] Expected a dictionary, received ' + str(type(params)))
+        if params != self._hfts_generation_params:
+            # cached models were generated with different parameters
+            self._hfts_cache.clear()
         self._hfts_generation_params = params
 
     def show_hfts(self, level, or_drawer, object_transform=None, b_normals=False):
@@ -144,7 +501,8 @@ class ObjectFileIO(ObjectIO):
         if level > len(self._last_hfts_param) - 1:
             raise ValueError('[objectFileIO::showHFTS] level ' + str(level) + ' does not exist')
         hfts_generation.or_render_hfts(or_drawer, self._last_hfts, self._last_hfts_param,
-                                       level, transform=object_transform, b_normals=b_normals)
+                                       level, transform=object_transform, b_normals=b_normals,
+                                       offsets=self._last_hfts_offsets)
         # b_factors = []
         # for i in range(level + 1):
         #     b_factors.append(np.arange(self._last_hfts_param[i]))
@@ -159,34 +517,139 @@ class ObjectFileIO(ObjectIO):
         # plt.show()
 
     def _update_hfts(self, obj_id, force_new=False):
-        """ Updates the cached hfts """
-        hfts_file = self._data_path + '/' + obj_id + '/hfts.npy'
-        hfts_param_file = self._data_path + '/' + obj_id + '/hftsParam.npy'
-        obj_com_file = self._data_path + '/' + obj_id + '/objCOM.npy'
+        """ Reads the hfts of the given object from the database. The hfts is regenerated if there is none in
+            the database, or if the stored one was generated from a different mesh or with different generation
+            parameters. Point clouds (see add_point_cloud) can not be regenerated, as only their hfts is stored,
+            hence their stored hfts is returned even if force_new is set.
+            :return HFTSModel or None, if no hfts could be generated
+        """
+        model_file = self.get_hfts_model_file_name(obj_id)
+        if self._is_point_cloud(obj_id):
+            model = self._read_hfts(obj_id, model_file, None, None)
+            if model is None:
+                rospy.logerr('[ObjectFileIO::_update_hfts] HFTS of point cloud %s is not available, ' % obj_id +
+                             'add the point cloud again')
+            return model
+        mesh_checksum = self._compute_mesh_checksum(obj_id)
+        generation_params = self._get_generation_params()
         # If it does not need to be regenerated, try to load it from file
         if not force_new:
-            b_hfts_read = self._read_hfts(obj_id, hfts_file, hfts_param_file, obj_com_file)
-            if b_hfts_read:
-                return True
-            rospy.logwarn('HFTS is not available in the database')
-
-        # If we reached this point, we have to generate a new HFTS from mesh/point cloud
-        points, com = self.get_points(obj_id)
+            model = self._read_hfts(obj_id, model_file, mesh_checksum, generation_params)
+            if model is None:
+                rospy.logwarn('HFTS is not available in the database')
+            elif not model.is_up_to_date(mesh_checksum, generation_params):
+                rospy.logwarn('HFTS in the database is outdated (mesh or generation parameters changed)')
+            else:
+                return model
+
+        # If we reached this point, we have to generate a new HFTS from mesh/point cloud.
+        # Only the stages whose parameters changed are recomputed, but clustering is repeated if force_new is set.
+        points, com, points_key = self._get_staged_points(obj_id, mesh_checksum=mesh_checksum)
         if points is None:
             rospy.logerr('Could not generate HFTS for object ' + obj_id)
-            return False
+            return None
+        stage_cache = self._get_stage_cache(obj_id)
+        hfts_key = hfts_store.compute_stage_key(points_key, self._get_generation_params(CLUSTERING_PARAMS))
+        cached_result = None if force_new else stage_cache.load('hfts', hfts_key)
+        if cached_result is not None:
+            hfts, hfts_param = cached_result['hfts'], cached_result['hfts_param']
+            offsets = hfts_generation.compute_hfts_offsets(hfts, hfts_param)
+            model = hfts_store.HFTSModel(hfts, hfts_param, com, offsets,
+                                         generation_params=generation_params, mesh_checksum=mesh_checksum)
+            return self._write_hfts(model_file, model)
         # If we have points, generate an hfts
+        hfts_gen = self._create_hfts_generator(points, com)
+        hfts_gen.run()
+        stage_cache.save('hfts', hfts_key, hfts=hfts_gen.get_hfts(), hfts_param=hfts_gen.get_hfts_param())
+        model = hfts_store.HFTSModel(hfts_gen.get_hfts(), hfts_gen.get_hfts_param(), com,
+                                     hfts_gen.get_hfts_offsets(), generation_params=generation_params,
+                                     mesh_checksum=mesh_checksum)
+        return self._write_hfts(model_file, model)
+
+    def _create_hfts_generator(self, points, com):
         hfts_gen = hfts_generation.HFTSGenerator(points, com)
         hfts_gen.set_branch_factor(extract_hfts_gen_parameter(self._hfts_generation_params, 'branching_factor'))
         hfts_gen.set_position_weight(extract_hfts_gen_parameter(self._hfts_generation_params, 'position_weight'))
+        hfts_gen.set_clustering_method(extract_hfts_gen_parameter(self._hfts_generation_params, 'clustering_method'),
+                                       n_init=extract_hfts_gen_parameter(self._hfts_generation_params,
+                                                                         'clustering_n_init'),
+                                       max_iter=extract_hfts_gen_parameter(self._hfts_generation_params,
+                                                                           'clustering_max_iter'))
+        hfts_gen.set_random_seed(extract_hfts_gen_parameter(self._hfts_generation_params, 'clustering_seed'))
+        hfts_gen.set_balanced(extract_hfts_gen_parameter(self._hfts_generation_params, 'balanced_clusters'))
+        hfts_gen.set_num_workers(self._num_generation_workers)
+        return hfts_gen
+
+    def add_point_cloud(self, positions, num_neighbors=hfts_generation.DEFAULT_NORMAL_NUM_NEIGHBORS,
+                        max_levels=DEFAULT_POINT_CLOUD_MAX_LEVELS, time_budget=DEFAULT_POINT_CLOUD_TIME_BUDGET):
+        """ Generates an hfts for an object that is only given as point cloud, e.g. a sensor_msgs/PointCloud.
+            Normals are estimated from the points (see hfts_generation.estimate_normals), the points are filtered
+            and down sampled like points sampled from meshes, and a shallow hierarchy is built within the
+            given time budget. The hfts is stored under an id that is derived from a hash of the point cloud
+            and the generation parameters, so that adding the same point cloud again returns the stored hfts.
+            :param positions: numpy array of shape (n, 3) with the points in the object frame
+            :param num_neighbors: number of neighbors used to estimate normals
+            :param max_levels: maximal number of levels of the hierarchy
+            :param time_budget: approximate time budget in seconds for the generation (None for no limit)
+            :return the id of the object to pass to get_hfts or None, if no hfts could be generated
+        """
+        start_time = time.time()
+        positions = np.ascontiguousarray(np.asarray(positions, dtype=float)[:, :3])
+        generation_params = self._get_generation_params()
+        cloud_params = dict(generation_params)
+        cloud_params.update({'num_neighbors': num_neighbors, 'max_levels': max_levels})
+        obj_id = POINT_CLOUD_ID_PREFIX + hfts_store.compute_stage_key(hashlib.sha1(positions).hexdigest(),
+                                                                      cloud_params)
+        model_file = self.get_hfts_model_file_name(obj_id)
+        if obj_id in self._hfts_cache or os.path.isfile(model_file):
+            rospy.loginfo('[ObjectFileIO::add_point_cloud] Point cloud %s is already known' % obj_id)
+            return obj_id
+        points = hfts_generation.create_contact_points_from_point_cloud(positions, num_neighbors)
+        com = np.mean(positions, axis=0)
+        if self._b_var_filter:
+            points = self._filter_points(points)
+        if points.shape[0] == 0:
+            rospy.logerr('[ObjectFileIO::add_point_cloud] No points left after filtering the point cloud')
+            return None
+        hfts_gen = self._create_hfts_generator(points, com)
+        hfts_gen.set_max_levels(max_levels)
+        if time_budget is not None:
+            hfts_gen.set_time_budget(max(0.0, time_budget - (time.time() - start_time)))
         hfts_gen.run()
+        # Point clouds have no mesh, hence the model is only valid as long as the generation parameters are the same
+        model = hfts_store.HFTSModel(hfts_gen.get_hfts(), hfts_gen.get_hfts_param(), com,
+                                     hfts_gen.get_hfts_offsets(), generation_params=generation_params,
+                                     mesh_checksum=None)
+        try:
+            if not os.path.isdir(os.path.dirname(model_file)):
+                os.makedirs(os.path.dirname(model_file))
+        except OSError as e:
+            rospy.logwarn('[ObjectFileIO::add_point_cloud] Could not create directory for %s: %s' % (obj_id, str(e)))
+        model = self._write_hfts(model_file, model)
+        self._hfts_cache.put(obj_id, model, size=model.get_memory_size())
+        rospy.loginfo('[ObjectFileIO::add_point_cloud] Generated HFTS for point cloud %s in %fs' %
+                      (obj_id, time.time() - start_time))
+        return obj_id
+
+    def _set_last_hfts(self, obj_id, model):
         self._last_obj_id = obj_id
-        self._last_hfts = hfts_gen.get_hfts()
-        self._last_hfts_param = hfts_gen.get_hfts_param()
-        self._last_obj_com = com
-        hfts_gen.save_hfts(hfts_file=hfts_file, hfts_param_file=hfts_param_file,
-                           com_file=obj_com_file)
-        return True
+        self._last_hfts = model.get_hfts()
+        self._last_hfts_param = model.get_hfts_param()
+        self._last_hfts_offsets = model.get_hfts_offsets()
+        self._last_obj_com = model.get_obj_com()
+
+
+def create_hfts_generation_params(planner_config):
+    """ Returns the hfts generation parameters defined by a configuration of the hfts planner node
+        (see cfg/hfts_planner.cfg). Parameters not defined there take their default values.
+    """
+    return {'max_normal_variance': planner_config['max_normal_variance'],
+            'contact_density': planner_config['contact_density'],
+            'min_contact_patch_radius': planner_config['min_contact_patch_radius'],
+            'max_num_points': planner_config['max_num_points'],
+            'position_weight': planner_config['hfts_position_weight'],
+            'branching_factor': planner_config['hfts_branching_factor'],
+            'first_level_branching_factor': planner_config['hfts_first_level_branching_factor']}
 
 
 def extract_hfts_gen_parameter(param_dict, name):
@@ -271,45 +734,68 @@ def position_distance(pos_values_a, pos_values_b):
     return d
 
 
-def generate_wrench_cone(contact, normal, mu, center, face_n):
-    ref_vec = np.array([0, 0, 1])
-    center = np.array(center)
-    contact = np.array(contact)
-    normal = np.array(normal)
-    forces = []
-    angle_step = float(2 * math.pi) / face_n
-
-    # create face_n cone edges
-    for i in range(face_n):
-        angle = angle_step * i
-        x = mu * math.cos(angle)
-        y = mu * math.sin(angle)
-        z = 1
-        forces.append([x, y, z])
-
-    forces = np.asarray(forces)
-    rot_angle = transformations.angle_between_vectors(ref_vec, normal)
-    axis = np.cross(ref_vec, normal)
+# Cache of friction cone edges around the z-axis, see get_friction_cone_template
+_FRICTION_CONE_TEMPLATES = {}
+
+
+def get_friction_cone_template(mu, face_n):
+    """ Returns the face_n edges of a linearized friction cone with friction coefficient mu
+        around the z-axis as a (face_n, 3) matrix. Templates are cached.
+    """
+    key = (float(mu), int(face_n))
+    if key not in _FRICTION_CONE_TEMPLATES:
+        angles = np.arange(face_n) * (float(2 * math.pi) / face_n)
+        _FRICTION_CONE_TEMPLATES[key] = np.column_stack((mu * np.cos(angles), mu * np.sin(angles), np.ones(face_n)))
+    return _FRICTION_CONE_TEMPLATES[key]
+
+
+def compute_rotations_from_z(normals):
+    """ Computes for each given normal a rotation matrix that rotates the z-axis onto it (Rodrigues' formula).
+        As in the original per-contact implementation, normals (almost) parallel to the z-axis are mapped
+        to the identity or a rotation by pi around the x-axis.
+        :param normals - (n, 3) matrix of normals
+        :return (n, 3, 3) array of rotation matrices
+    """
+    normals = np.asarray(normals, dtype=float)
+    num_normals = normals.shape[0]
+    unit_normals = normals / np.linalg.norm(normals, axis=1)[:, np.newaxis]
     # take care of axis aligned normals
-    if np.linalg.norm(axis) > 0.01:
-        r_mat = transformations.rotation_matrix(rot_angle, axis)[:3, :3]
-    else:
-        if np.dot(ref_vec, normal) > 0:
-            r_mat = np.identity(3, float)
-        else:
-            r_mat = np.identity(3, float)
-            r_mat[1,1] = -1.
-            r_mat[2,2] = -1.
+    b_aligned = np.linalg.norm(normals[:, :2], axis=1) <= 0.01  # == norm(cross(z, normal))
+    # axis = cross(z, n) = [-n_y, n_x, 0], cos(angle) = n_z
+    skew = np.zeros((num_normals, 3, 3))
+    skew[:, 0, 2] = unit_normals[:, 0]
+    skew[:, 1, 2] = unit_normals[:, 1]
+    skew[:, 2, 0] = -unit_normals[:, 0]
+    skew[:, 2, 1] = -unit_normals[:, 1]
+    cos_angles = unit_normals[:, 2]
+    factors = np.zeros(num_normals)
+    factors[~b_aligned] = 1.0 / (1.0 + cos_angles[~b_aligned])
+    rotations = np.empty((num_normals, 3, 3))
+    rotations[:] = np.identity(3)
+    rotations += skew + factors[:, np.newaxis, np.newaxis] * np.einsum('nij,njk->nik', skew, skew)
+    rotations[b_aligned] = np.identity(3)
+    b_flipped = np.logical_and(b_aligned, normals[:, 2] <= 0)
+    rotations[b_flipped] = np.diag([1., -1., -1.])
+    return rotations
+
+
+def generate_wrench_cones(contacts, normals, mu, center, face_n):
+    """ Generates the linearized wrench cones for all given contacts at once.
+        :param contacts - (n, 3) matrix of contact positions
+        :param normals - (n, 3) matrix of contact normals
+        :param mu - friction coefficient
+        :param center - point w.r.t. which torques are computed
+        :param face_n - number of wrench cone faces
+        :return (n, face_n, 6) array, where entry [i, j] is the wrench of cone edge j at contact i
+    """
+    contacts = np.asarray(contacts, dtype=float)
+    forces = np.einsum('nij,fj->nfi', compute_rotations_from_z(normals), get_friction_cone_template(mu, face_n))
+    torques = np.cross((contacts - np.asarray(center))[:, np.newaxis, :], forces)
+    return np.concatenate((forces, torques), axis=2)
+
 
-    forces = np.dot(r_mat, np.transpose(forces))
-    forces = np.transpose(forces)
-    # compute wrenches
-    wrenches = []
-    for i in range(face_n):
-        torque = np.cross((contact - center), forces[i])
-        wrenches.append(np.append(forces[i], torque))
-    wrenches = np.asarray(wrenches)
-    return wrenches
+def generate_wrench_cone(contact, normal, mu, center, face_n):
+    return generate_wrench_cones(np.array([contact]), np.array([normal]), mu, center, face_n)[0]
 
 
 def compute_grasp_stability(grasp_contacts, mu, com=None, face_n=8):
@@ -319,19 +805,31 @@ def compute_grasp_stability(grasp_contacts, mu, com=None, face_n=8):
         :param com - center of mass of the grasped object (assumed to be [0,0,0], if None)
         :param face_n - number of wrench cone faces
     """
+    return compute_grasp_stability_batch(np.asarray(grasp_contacts)[np.newaxis], mu, com=com, face_n=face_n)[0]
+
+
+def compute_grasp_stability_batch(grasps, mu, com=None, face_n=8):
+    """ Computes Canny's grasp quality metric for many grasps at once.
+        The wrench cones of all contacts of all grasps are generated in one vectorized step,
+        only the convex hull computation is done per grasp.
+        :param grasps - An mxnx6 array containing m grasps, each of which consists of n contacts (position, normal)
+        :param mu - friction coefficient
+        :param com - center of mass of the grasped object (assumed to be [0,0,0], if None)
+        :param face_n - number of wrench cone faces
+        :return array of shape (m,) containing the quality of each grasp
+    """
     if com is None:
         com = [0, 0, 0]
-    wrenches = []
-    grasp = np.asarray(grasp_contacts)
-    # iterate over each contact
-    for i in range(len(grasp)):
-        wrench_cone = generate_wrench_cone(grasp[i, :3], grasp[i, 3:], mu, com, face_n)
-        for wrench in wrench_cone:
-            wrenches.append(list(wrench))
-    wrenches = np.asarray(wrenches)
-    hull = ConvexHull(wrenches, incremental=False, qhull_options='Pp QJ')
-    offsets = -hull.equations[:, -1]
-    return min(offsets)
+    grasps = np.asarray(grasps, dtype=float)
+    num_grasps, num_contacts = grasps.shape[0], grasps.shape[1]
+    contacts = grasps.reshape((num_grasps * num_contacts, 6))
+    wrenches = generate_wrench_cones(contacts[:, :3], contacts[:, 3:], mu, com, face_n)
+    wrenches = wrenches.reshape((num_grasps, num_contacts * face_n, 6))
+    qualities = np.empty(num_grasps)
+    for i in range(num_grasps):
+        hull = ConvexHull(wrenches[i], incremental=False, qhull_options='Pp QJ')
+        qualities[i] = min(-hull.equations[:, -1])
+    return qualities
 
 
 class OpenRAVEDrawer: